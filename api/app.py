@@ -1,6 +1,51 @@
-from flask import Flask
+import json
+import logging
+import os
+import sys
+import time
+
+# Imports resolve from the repository root, whichever directory this is run from
+if __name__ == "__main__":
+    sys.path[0] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+from flask import Flask, Response, g, request, stream_with_context
 from flask_restx import Api, Resource, fields, reqparse
-from src.compute_cow import compute_cowiness_detailed, compute_cowiness_simple
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from api.src.compute_cow import (
+    ENGINES,
+    compute_cowiness_batch,
+    compute_cowiness_detailed,
+    compute_cowiness_simple,
+)
+from api.src.export import decode_cursor, get_export_store
+from api.src.stats import INTERVALS, get_stats_store
+from utils import metrics
+from utils.admission import AdmissionController, Rejected
+from utils.config import config
+
+# Debug logging of the decoding hot loop is only formatted when LOG_LEVEL=DEBUG
+logging.basicConfig(level=config.get("LOG_LEVEL", "INFO"))
+logger = logging.getLogger(__name__)
+
+# Size of the worker pool computing the settlements of a batch request, and the largest batch accepted
+BATCH_WORKERS = config.get_int("BATCH_WORKERS", 8)
+BATCH_MAX_TX = config.get_int("BATCH_MAX_TX", 500)
+
+# Threads computing cowiness at once, how many more requests may wait and for how many seconds, and the
+# Retry-After of the 429 and 503 responses of requests turned away. A batch request counts one thread per worker.
+ADMISSION = {
+    "limit": config.get_int("API_CONCURRENCY", 16),
+    "queue_size": config.get_int("API_QUEUE_SIZE", 64),
+    "queue_timeout": config.get_int("API_QUEUE_TIMEOUT", 10),
+    "retry_after": config.get_int("API_RETRY_AFTER", 1),
+}
+admission = AdmissionController(**ADMISSION)
+
+# Characters of newline-delimited JSON written per chunk of an export
+EXPORT_CHUNK_SIZE = config.get_int("EXPORT_CHUNK_SIZE", 65536)
+
+# Most hours, days or weeks a stats request may span
+STATS_MAX_BUCKETS = config.get_int("STATS_MAX_BUCKETS", 2000)
 
 app = Flask(__name__)
 api = Api(
@@ -13,9 +58,68 @@ api = Api(
 )
 app.config.SWAGGER_UI_DOC_EXPANSION = "list"
 
+
+@app.before_request
+def start_request_metrics():
+    g.request_metrics, g.request_metrics_token = metrics.start_request()
+
+
+@app.after_request
+def add_server_timing(response):
+    server_timing = g.request_metrics.server_timing()
+    if server_timing:
+        response.headers["Server-Timing"] = server_timing
+    return response
+
+
+@app.teardown_request
+def finish_request_metrics(exception):
+    if "request_metrics" in g:
+        metrics.finish_request(g.request_metrics, g.request_metrics_token)
+
+
+@app.route("/metrics")
+def prometheus_metrics():
+    """Expose stage latency histograms and upstream call counters to Prometheus"""
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
+
 ns = api.namespace("cowiness", description="CoW operations")
 
 
+class AdmittedResource(Resource):
+    """
+    A resource computing cowiness from upstream data, whose requests go through admission control.
+    """
+
+    def weight(self):
+        """
+        Returns the admission slots a request takes, the threads it keeps busy.
+        """
+        return 1
+
+    def dispatch_request(self, *args, **kwargs):
+        try:
+            weight = admission.acquire(self.weight())
+        except Rejected as e:
+            return {"message": e.message}, e.status, {"Retry-After": str(e.retry_after)}
+        try:
+            return super().dispatch_request(*args, **kwargs)
+        finally:
+            admission.release(weight)
+
+
+def batch_weight(payload):
+    """
+    Returns the admission slots of a batch request: its distinct settlements are computed on up to BATCH_WORKERS
+    threads.
+    """
+    tx_hashes = payload.get("batch_txs") if isinstance(payload, dict) else None
+    if not isinstance(tx_hashes, list):
+        return 1
+    return max(min(len(set(map(str, tx_hashes))), BATCH_WORKERS), 1)
+
+
 cowiness_model = api.model(
     "Cowiness",
     {
@@ -62,6 +166,124 @@ batch_model = api.model(
             description="The transaction hash of the batch settlement",
             example="0xe9bb32f7ae553ebad727d2b6020b4298cb71c6f2dc96fa07f8a9ab056a93def2",
         ),
+        "block_number": fields.Integer(
+            description="The block of the batch settlement", example=17000000
+        ),
+    },
+)
+batch_request_model = api.model(
+    "BatchRequest",
+    {
+        "batch_txs": fields.List(
+            fields.String,
+            required=True,
+            description="Transaction hashes of the settlements",
+            example=[
+                "0xe9bb32f7ae553ebad727d2b6020b4298cb71c6f2dc96fa07f8a9ab056a93def2"
+            ],
+        ),
+        "engine": fields.String(
+            enum=list(ENGINES),
+            description="Engine extracting the volumes, defaults to COW_ENGINE",
+        ),
+    },
+)
+batch_result_model = api.model(
+    "BatchResult",
+    {
+        "tx_hash": fields.String(
+            description="The transaction hash of the batch settlement"
+        ),
+        "result": fields.Nested(
+            batch_model,
+            allow_null=True,
+            skip_none=True,
+            description="The cowiness details of the batch, if it could be computed",
+        ),
+        "error": fields.String(
+            description="The reason the cowiness of the batch could not be computed"
+        ),
+    },
+)
+batch_results_model = api.model(
+    "BatchResults",
+    {"results": fields.List(fields.Nested(batch_result_model, skip_none=True))},
+)
+stats_bucket_model = api.model(
+    "StatsBucket",
+    {
+        "start": fields.Integer(
+            description="Unix timestamp of the start of the interval",
+            example=1685577600,
+        ),
+        "end": fields.Integer(
+            description="Unix timestamp of the end of the interval, exclusive",
+            example=1685664000,
+        ),
+        "settlements": fields.Integer(
+            description="Number of settlements with computed cowiness", example=412
+        ),
+        "averageCowiness": fields.Float(
+            description="Mean cowiness of the settlements", example=0.12
+        ),
+        "volumeWeightedCowiness": fields.Float(
+            description="CoW volume over volume in, in USD", example=0.08
+        ),
+        "cowVolumeUsd": fields.Float(
+            description="Volume in USD settled without external liquidity",
+            example=1250000.5,
+        ),
+        "volumeInUsd": fields.Float(
+            description="Total volume in USD sold by traders", example=15600000.0
+        ),
+        "volumeOutUsd": fields.Float(
+            description="Total volume in USD routed to external liquidity",
+            example=14349999.5,
+        ),
+    },
+)
+export_row_model = api.model(
+    "ExportRow",
+    {
+        "txHash": fields.String(
+            description="The transaction hash of the batch settlement",
+            example="0xe9bb32f7ae553ebad727d2b6020b4298cb71c6f2dc96fa07f8a9ab056a93def2",
+        ),
+        "firstTradeTimestamp": fields.Integer(
+            description="Unix timestamp of the first trade of the settlement",
+            example=1685577600,
+        ),
+        "cowValue": fields.Float(description="The cowiness of the batch", example=1),
+        "totalVolumeInUsd": fields.Float(
+            description="The total volume in USD of all tokens bought in the batch",
+            example=291.07484530376996,
+        ),
+        "totalVolumeOutUsd": fields.Float(
+            description="The total volume in USD of all tokens sold in the batch",
+            example=0,
+        ),
+        "volumeInUsd": fields.Raw(
+            description="The USD value of each token bought in the batch"
+        ),
+        "volumeOutUsd": fields.Raw(
+            description="The USD value of each token sold in the batch"
+        ),
+        "cursor": fields.String(
+            description="Token resuming the export after this settlement"
+        ),
+    },
+)
+stats_model = api.model(
+    "Stats",
+    {
+        "interval": fields.String(description="Aggregation interval", example="day"),
+        "buckets": fields.List(
+            fields.Nested(stats_bucket_model),
+            description="Aggregates of each interval with settlements, in time order",
+        ),
+        "total": fields.Nested(
+            stats_bucket_model, description="Aggregates over the whole range"
+        ),
     },
 )
 txhash_parser = reqparse.RequestParser()
@@ -76,10 +298,43 @@ batch_parser = reqparse.RequestParser()
 batch_parser.add_argument(
     "batch_tx", type=str, help="Transaction hash of the settlement", required=True
 )
+for parser in [txhash_parser, batch_parser]:
+    parser.add_argument(
+        "engine",
+        type=str,
+        choices=list(ENGINES),
+        help="Engine extracting the volumes, defaults to COW_ENGINE",
+    )
+
+export_parser = reqparse.RequestParser()
+export_parser.add_argument(
+    "start", type=int, help="Unix timestamp of the start of the range", required=True
+)
+export_parser.add_argument(
+    "end", type=int, help="Unix timestamp of the end of the range, defaults to now"
+)
+export_parser.add_argument(
+    "cursor", type=str, help="Cursor of the last row received, to resume an export"
+)
+
+stats_parser = reqparse.RequestParser()
+stats_parser.add_argument(
+    "interval",
+    type=str,
+    choices=["hour", "day", "week"],
+    default="day",
+    help="Aggregation interval",
+)
+stats_parser.add_argument(
+    "start", type=int, help="Unix timestamp of the start of the range", required=True
+)
+stats_parser.add_argument(
+    "end", type=int, help="Unix timestamp of the end of the range, defaults to now"
+)
 
 
 @ns.route("/v1/")
-class Cowiness(Resource):
+class Cowiness(AdmittedResource):
     @ns.doc(
         parser=txhash_parser,
         description="Calculate the CoW of a given batch auction on CowSwap",
@@ -87,11 +342,13 @@ class Cowiness(Resource):
     @ns.expect(txhash_parser)
     @ns.response(200, "Success", cowiness_model)
     @ns.response(400, "Bad Request")
+    @ns.response(429, "Too many requests queued, retry after Retry-After seconds")
+    @ns.response(503, "No capacity freed up in time, retry after Retry-After seconds")
     def get(self):
         """Get the CoW value for a given transaction hash of a settled batch auction"""
         args = txhash_parser.parse_args()
         txhash = args["batch_tx"]
-        result = compute_cowiness_simple(txhash)
+        result = compute_cowiness_simple(txhash, args["engine"])
         if result:
             cowiness = result
             return {"cowiness": cowiness}
@@ -100,7 +357,7 @@ class Cowiness(Resource):
 
 
 @ns.route("/v1/extended")
-class CowinessExtended(Resource):
+class CowinessExtended(AdmittedResource):
     @ns.doc(
         parser=batch_parser,
         description="Calculate the cowiness of a given batch auction on CowSwap and return additional details",
@@ -108,16 +365,139 @@ class CowinessExtended(Resource):
     @ns.expect(batch_parser)
     @ns.response(200, "Success", batch_model)
     @ns.response(400, "Bad Request")
+    @ns.response(429, "Too many requests queued, retry after Retry-After seconds")
+    @ns.response(503, "No capacity freed up in time, retry after Retry-After seconds")
     def get(self):
         """Get the cowiness value, total volume in USD, total volume out USD, and auction details of a given batch auction"""
         args = batch_parser.parse_args()
         batch_id = args["batch_tx"]
-        result = compute_cowiness_detailed(batch_id)
+        result = compute_cowiness_detailed(batch_id, args["engine"])
         if result:
             return result
         else:
             return {"message": "Error computing CoW value"}, 500
 
 
+def ndjson_lines(rows, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yields rows as lines of JSON, in chunks of about chunk_size characters after the first row, which is sent alone.
+
+    A failure once the response has started is reported as a last line with an error, since the status can no longer
+    change, and the cursor of the last row sent resumes the export.
+    """
+    lines = []
+    size = chunk_size
+    try:
+        for row in rows:
+            line = json.dumps(row) + "\n"
+            lines.append(line)
+            size += len(line)
+            if size >= chunk_size:
+                yield "".join(lines)
+                lines = []
+                size = 0
+    except Exception as e:
+        logger.warning("Export failed: %s", e)
+        lines.append(
+            json.dumps({"error": "Export failed, resume it from the last cursor"})
+            + "\n"
+        )
+    yield "".join(lines)
+
+
+@ns.route("/v1/export")
+class CowinessExport(Resource):
+    @ns.doc(
+        parser=export_parser,
+        description="Stream the stored cowiness of every settlement of a time range as newline-delimited JSON",
+    )
+    @ns.expect(export_parser)
+    @ns.response(200, "Success, one row per line", export_row_model)
+    @ns.response(400, "Bad Request")
+    @ns.response(503, "Export is not configured")
+    def get(self):
+        """Get the cowiness, volumes in USD and a resume cursor of each settlement of a time range, in time order"""
+        args = export_parser.parse_args()
+        start = args["start"]
+        end = args["end"] if args["end"] is not None else int(time.time())
+        # Rows are read from the settlements the ETL computed, so exports need MONGODB_URI
+        export_store = get_export_store()
+        if export_store is None:
+            return {"message": "Export needs MONGODB_URI to be set"}, 503
+        if end <= start:
+            return {"message": "end must be after start"}, 400
+        after = None
+        if args["cursor"] is not None:
+            try:
+                after = decode_cursor(args["cursor"])
+            except ValueError as e:
+                return {"message": str(e)}, 400
+        # Rows are written as they are read, in a chunked response without a length
+        return Response(
+            stream_with_context(ndjson_lines(export_store.rows(start, end, after))),
+            mimetype="application/x-ndjson",
+        )
+
+
+@ns.route("/v1/batch")
+class CowinessBatch(AdmittedResource):
+    def weight(self):
+        return batch_weight(request.get_json(silent=True))
+
+    @ns.doc(
+        description="Calculate the cowiness of many batch auctions on CowSwap at once",
+    )
+    @ns.expect(batch_request_model, validate=True)
+    @ns.response(200, "Success", batch_results_model)
+    @ns.response(400, "Bad Request")
+    @ns.response(429, "Too many requests queued, retry after Retry-After seconds")
+    @ns.response(503, "No capacity freed up in time, retry after Retry-After seconds")
+    def post(self):
+        """Get the cowiness details of each given batch auction, with errors reported per transaction hash"""
+        tx_hashes = api.payload["batch_txs"]
+        if len(tx_hashes) > BATCH_MAX_TX:
+            return {"message": f"At most {BATCH_MAX_TX} transactions per batch"}, 400
+        return {
+            "results": compute_cowiness_batch(
+                tx_hashes, BATCH_WORKERS, api.payload.get("engine")
+            )
+        }
+
+
+@ns.route("/v1/stats")
+class CowinessStats(Resource):
+    @ns.doc(
+        parser=stats_parser,
+        description="Aggregate the cowiness of settled batch auctions per hour, day or week over a time range",
+    )
+    @ns.expect(stats_parser)
+    @ns.response(200, "Success", stats_model)
+    @ns.response(400, "Bad Request")
+    @ns.response(503, "Stats are not configured")
+    def get(self):
+        """Get the settlement count, average cowiness and CoW volume in USD of each interval of a time range"""
+        args = stats_parser.parse_args()
+        interval = args["interval"]
+        start = args["start"]
+        end = args["end"] if args["end"] is not None else int(time.time())
+        # Aggregates are read from the rollups the ETL maintains, so stats need MONGODB_URI
+        stats_store = get_stats_store()
+        if stats_store is None:
+            return {"message": "Stats need MONGODB_URI to be set"}, 503
+        if end <= start:
+            return {"message": "end must be after start"}, 400
+        if (end - start) / INTERVALS[interval] > STATS_MAX_BUCKETS:
+            return {
+                "message": f"At most {STATS_MAX_BUCKETS} {interval}s per request"
+            }, 400
+        return {"interval": interval, **stats_store.get(interval, start, end)}
+
+
 if __name__ == "__main__":
-    app.run(debug=True)
+    # Each request is served in its own thread, and admission control bounds those computing. The debugger and
+    # reloader are enabled with FLASK_DEBUG=1.
+    app.run(
+        host=config.get("API_HOST", "127.0.0.1"),
+        port=config.get_int("API_PORT", 5000),
+        threaded=True,
+    )
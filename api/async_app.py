@@ -0,0 +1,307 @@
+"""
+Serves the routes of api/app.py on aiohttp's web server, with the same Swagger models and validation. Computations
+await their upstream I/O on the server's event loop instead of holding a thread each, and requests waiting for
+admission await their turn the same way.
+
+Run it instead of api/app.py, with the same environment:
+
+    python api/async_app.py
+"""
+import asyncio
+import contextvars
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+# Imports resolve from the repository root, whichever directory this is run from
+if __name__ == "__main__":
+    sys.path[0] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+import flask_restx
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from werkzeug.exceptions import HTTPException
+
+from api.app import (
+    ADMISSION,
+    BATCH_MAX_TX,
+    BATCH_WORKERS,
+    STATS_MAX_BUCKETS,
+    api as restx_api,
+    app as flask_app,
+    batch_parser,
+    batch_request_model,
+    batch_weight,
+    export_parser,
+    ndjson_lines,
+    stats_parser,
+    txhash_parser,
+)
+from api.src.compute_cow import (
+    compute_cowiness_batch,
+    compute_cowiness_detailed_shared_async,
+)
+from api.src.export import decode_cursor, get_export_store
+from api.src.stats import INTERVALS, get_stats_store
+from utils import metrics
+from utils.admission import AsyncAdmissionController, Rejected
+from utils.aio import create_session
+from utils.config import config
+
+# Threads running what cannot be awaited: receipt fetches, MongoDB reads and writes, and batch requests, which each
+# hold one while their workers compute
+API_THREADS = config.get_int("API_THREADS", 32)
+
+admission = AsyncAdmissionController(**ADMISSION)
+
+
+class BadRequest(Exception):
+    """
+    Raised with the body and status of the response to a request that failed validation.
+    """
+
+    def __init__(self, data, status=400):
+        super().__init__(data.get("message"))
+        self.data = data
+        self.status = status
+
+
+def parse_query(parser, request):
+    """
+    Parses the query string of a request with a RequestParser of api/app.py, raising BadRequest with its errors.
+    """
+    with flask_app.test_request_context(query_string=request.query_string):
+        try:
+            return parser.parse_args()
+        except HTTPException as e:
+            raise BadRequest(e.data, e.code)
+
+
+async def parse_payload(model, request):
+    """
+    Returns the JSON payload of a request validated against a Swagger model of api/app.py, raising BadRequest with
+    its errors.
+    """
+    try:
+        payload = await request.json()
+    except ValueError as e:
+        raise BadRequest({"message": f"Failed to decode JSON object: {e}"})
+    with flask_app.test_request_context():
+        try:
+            model.validate(payload)
+        except HTTPException as e:
+            raise BadRequest(e.data, e.code)
+    return payload
+
+
+@asynccontextmanager
+async def admitted(weight=1):
+    """
+    Runs the enclosed block once the request is admitted, raising Rejected if it is not.
+    """
+    weight = await admission.acquire(weight)
+    try:
+        yield
+    finally:
+        await admission.release(weight)
+
+
+async def run_in_thread(fn, *args):
+    """
+    Awaits fn(*args) run on a server thread, in a copy of the request's context so its timings add up on it.
+    """
+    return await asyncio.get_running_loop().run_in_executor(
+        None, contextvars.copy_context().run, fn, *args
+    )
+
+
+@web.middleware
+async def request_metrics(request, handler):
+    request_metrics, token = metrics.start_request()
+    try:
+        try:
+            response = await handler(request)
+        except BadRequest as e:
+            response = web.json_response(e.data, status=e.status)
+        except Rejected as e:
+            response = web.json_response(
+                {"message": e.message},
+                status=e.status,
+                headers={"Retry-After": str(e.retry_after)},
+            )
+        except web.HTTPException:
+            raise
+        except Exception:
+            # Logged with its traceback like any error of an aiohttp handler, and answered like flask-restx does
+            request.app.logger.exception("Error handling %s", request.path)
+            response = web.json_response(
+                {"message": "Internal Server Error"}, status=500
+            )
+
+        server_timing = request_metrics.server_timing()
+        if server_timing and not response.prepared:
+            response.headers["Server-Timing"] = server_timing
+        return response
+    finally:
+        metrics.finish_request(request_metrics, token)
+
+
+async def cowiness(request):
+    args = parse_query(txhash_parser, request)
+    async with admitted():
+        result = await compute_cowiness_detailed_shared_async(
+            request.app["session"], args["batch_tx"], args["engine"]
+        )
+    if result["cow_value"]:
+        return web.json_response({"cowiness": result["cow_value"]})
+    else:
+        return web.json_response({"message": "Error computing CoW value"}, status=500)
+
+
+async def cowiness_extended(request):
+    args = parse_query(batch_parser, request)
+    async with admitted():
+        result = await compute_cowiness_detailed_shared_async(
+            request.app["session"], args["batch_tx"], args["engine"]
+        )
+    if result:
+        return web.json_response(result)
+    else:
+        return web.json_response({"message": "Error computing CoW value"}, status=500)
+
+
+async def cowiness_batch(request):
+    payload = await parse_payload(batch_request_model, request)
+    tx_hashes = payload["batch_txs"]
+    if len(tx_hashes) > BATCH_MAX_TX:
+        return web.json_response(
+            {"message": f"At most {BATCH_MAX_TX} transactions per batch"}, status=400
+        )
+    # The batch is computed on a pool of BATCH_WORKERS threads, which it is admitted for
+    async with admitted(batch_weight(payload)):
+        results = await run_in_thread(
+            compute_cowiness_batch, tx_hashes, BATCH_WORKERS, payload.get("engine")
+        )
+    return web.json_response({"results": results})
+
+
+async def cowiness_export(request):
+    args = parse_query(export_parser, request)
+    start = args["start"]
+    end = args["end"] if args["end"] is not None else int(time.time())
+    # Rows are read from the settlements the ETL computed, so exports need MONGODB_URI
+    export_store = get_export_store()
+    if export_store is None:
+        return web.json_response(
+            {"message": "Export needs MONGODB_URI to be set"}, status=503
+        )
+    if end <= start:
+        return web.json_response({"message": "end must be after start"}, status=400)
+    after = None
+    if args["cursor"] is not None:
+        try:
+            after = decode_cursor(args["cursor"])
+        except ValueError as e:
+            return web.json_response({"message": str(e)}, status=400)
+
+    # Rows are written as they are read, in a chunked response without a length, each chunk read on a thread
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await response.prepare(request)
+    chunks = ndjson_lines(export_store.rows(start, end, after))
+    try:
+        while True:
+            chunk = await run_in_thread(next, chunks, None)
+            if chunk is None:
+                break
+            if chunk:
+                await response.write(chunk.encode())
+    finally:
+        chunks.close()
+    await response.write_eof()
+    return response
+
+
+async def cowiness_stats(request):
+    args = parse_query(stats_parser, request)
+    interval = args["interval"]
+    start = args["start"]
+    end = args["end"] if args["end"] is not None else int(time.time())
+    # Aggregates are read from the rollups the ETL maintains, so stats need MONGODB_URI
+    stats_store = get_stats_store()
+    if stats_store is None:
+        return web.json_response(
+            {"message": "Stats need MONGODB_URI to be set"}, status=503
+        )
+    if end <= start:
+        return web.json_response({"message": "end must be after start"}, status=400)
+    if (end - start) / INTERVALS[interval] > STATS_MAX_BUCKETS:
+        return web.json_response(
+            {"message": f"At most {STATS_MAX_BUCKETS} {interval}s per request"},
+            status=400,
+        )
+    buckets = await run_in_thread(stats_store.get, interval, start, end)
+    return web.json_response({"interval": interval, **buckets})
+
+
+async def prometheus_metrics(request):
+    """Expose stage latency histograms and upstream call counters to Prometheus"""
+    return web.Response(
+        body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST}
+    )
+
+
+def swagger_context(request):
+    # The Swagger UI and spec are rendered by the flask-restx Api of api/app.py, with links to this server
+    return flask_app.test_request_context(
+        "/", base_url=f"{request.scheme}://{request.host}"
+    )
+
+
+async def swagger_ui(request):
+    with swagger_context(request):
+        return web.Response(text=restx_api.render_doc(), content_type="text/html")
+
+
+async def swagger_spec(request):
+    with swagger_context(request):
+        return web.Response(
+            text=json.dumps(restx_api.__schema__), content_type="application/json"
+        )
+
+
+async def upstream_session(app):
+    # One session for every computation, so its connection pool caps the upstream requests of the whole server
+    app["session"] = create_session()
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=API_THREADS)
+    )
+    yield
+    await app["session"].close()
+
+
+def create_app():
+    app = web.Application(middlewares=[request_metrics])
+    app.cleanup_ctx.append(upstream_session)
+    app.router.add_get("/", swagger_ui)
+    app.router.add_get("/specs.json", swagger_spec)
+    app.router.add_static(
+        "/swaggerui", os.path.join(os.path.dirname(flask_restx.__file__), "static")
+    )
+    app.router.add_get("/metrics", prometheus_metrics)
+    app.router.add_get("/cowiness/v1/", cowiness)
+    app.router.add_get("/cowiness/v1/extended", cowiness_extended)
+    app.router.add_post("/cowiness/v1/batch", cowiness_batch)
+    app.router.add_get("/cowiness/v1/export", cowiness_export)
+    app.router.add_get("/cowiness/v1/stats", cowiness_stats)
+    return app
+
+
+if __name__ == "__main__":
+    web.run_app(
+        create_app(),
+        host=config.get("API_HOST", "127.0.0.1"),
+        port=config.get_int("API_PORT", 5000),
+    )
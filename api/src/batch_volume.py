@@ -0,0 +1,428 @@
+import gc
+import math
+from contextlib import contextmanager
+from itertools import chain, repeat
+from operator import attrgetter, itemgetter
+
+import numpy as np
+
+from .records import token_table
+from api.utils.helpers import build_hop_index, follow_hops
+
+TRADE = 0
+INTERACTION = 1
+OTHER = 2
+
+KINDS = {"trade": TRADE, "interaction": INTERACTION}
+
+# Every power of ten an ERC20 can declare as decimals, as exact floats so scaling matches float(volume) / 10 ** decimals
+POWERS_OF_TEN = np.array([float(10**decimals) for decimals in range(256)])
+
+# Amounts are placed after their token rank as log10(amount) / AMOUNT_SCALE, which stays below 1 for any uint256
+AMOUNT_SCALE = 80
+
+# Hops whose amounts are this close to the tolerance boundary in float are resolved exactly, swap by swap
+BOUNDARY_EPSILON = 1e-9
+
+
+class SwapColumns:
+    """
+    The swaps of many settlements as parallel arrays with one row per swap, in settlement then swap order.
+
+    Tokens are token table ids, and tokens[id] the lowercase address of each; offsets[i]:offsets[i + 1] are the
+    rows of settlement i.
+    """
+
+    def __init__(self, swaps_per_settlement, tokens=token_table):
+        self.swaps_per_settlement = swaps_per_settlement
+        swaps = list(chain.from_iterable(swaps_per_settlement))
+
+        # Records already hold interned token ids, so every column is read straight off the swaps
+        self.tokens = list(tokens.lowercase)
+        self.sell_token = np.fromiter(
+            map(attrgetter("sell_token"), swaps), dtype=np.int64, count=len(swaps)
+        )
+        self.buy_token = np.fromiter(
+            map(attrgetter("buy_token"), swaps), dtype=np.int64, count=len(swaps)
+        )
+        self.kind = np.fromiter(
+            map(KINDS.get, map(attrgetter("kind"), swaps), repeat(OTHER)),
+            dtype=np.int8,
+            count=len(swaps),
+        )
+        self.sell_amount = np.fromiter(
+            map(float, map(attrgetter("sell_amount"), swaps)),
+            dtype=np.float64,
+            count=len(swaps),
+        )
+        self.buy_amount = np.fromiter(
+            map(float, map(attrgetter("buy_amount"), swaps)),
+            dtype=np.float64,
+            count=len(swaps),
+        )
+
+        lengths = np.fromiter(
+            map(len, swaps_per_settlement),
+            dtype=np.int64,
+            count=len(swaps_per_settlement),
+        )
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)])
+        self.settlement = np.repeat(np.arange(len(lengths)), lengths)
+
+    def __len__(self):
+        return len(self.swaps_per_settlement)
+
+
+def find_hop_edges(columns, rows, tolerance=0.01):
+    """
+    Finds the next hop of each interaction, as compute_volume would: an interaction of the same settlement selling
+    its buy token for an amount within tolerance of its buy amount.
+
+    Returns for each of the given interaction rows the position in rows of its next hop, or -1, and the
+    settlements where that is ambiguous (several candidates, or amounts too close to the tolerance boundary
+    in float) and which must be resolved swap by swap.
+    """
+    n_tokens = len(columns.tokens)
+    settlement = columns.settlement[rows]
+    sell_keys = settlement * n_tokens + columns.sell_token[rows]
+    buy_keys = settlement * n_tokens + columns.buy_token[rows]
+    sell_amount = columns.sell_amount[rows]
+    buy_amount = columns.buy_amount[rows]
+
+    # Sort (settlement, sell token, sell amount) on one axis: the dense rank of the key, plus the log of the amount
+    # as a fraction below 1
+    unique_keys, sell_ranks = np.unique(sell_keys, return_inverse=True)
+    sell_positions = sell_ranks + np.log10(np.maximum(sell_amount, 1)) / AMOUNT_SCALE
+    order = np.argsort(sell_positions, kind="stable")
+    sell_positions = sell_positions[order]
+
+    buy_ranks = np.minimum(np.searchsorted(unique_keys, buy_keys), len(unique_keys) - 1)
+    has_key = unique_keys[buy_ranks] == buy_keys
+
+    # Within tolerance means a sell amount in [buy * (1 - t), buy / (1 - t)]; the band is widened so every match
+    # falls in it, and candidates are checked exactly below
+    margin = -math.log10(1 - tolerance) + 1e-6
+    log_buy = np.log10(np.maximum(buy_amount, 1))
+    low = np.searchsorted(
+        sell_positions, buy_ranks + (log_buy - margin) / AMOUNT_SCALE, "left"
+    )
+    high = np.searchsorted(
+        sell_positions, buy_ranks + (log_buy + margin) / AMOUNT_SCALE, "right"
+    )
+    candidates = np.where(has_key, high - low, 0)
+
+    next_hop = np.full(len(rows), -1, dtype=np.int64)
+    single = np.flatnonzero(candidates == 1)
+    other = order[low[single]]
+    difference = np.abs(buy_amount[single] - sell_amount[other])
+    bound = np.maximum(buy_amount[single], sell_amount[other]) * tolerance
+    within = (difference <= bound) & (other != single)
+    next_hop[single[within]] = other[within]
+
+    near_boundary = np.abs(difference - bound) <= BOUNDARY_EPSILON * np.maximum(
+        buy_amount[single], sell_amount[other]
+    )
+    ambiguous = np.concatenate(
+        [settlement[candidates > 1], settlement[single[near_boundary]]]
+    )
+
+    # An interaction that is the next hop of several others depends on the visiting order
+    hops = next_hop[next_hop >= 0]
+    in_degree = np.bincount(hops, minlength=len(rows))
+    ambiguous = np.concatenate([ambiguous, settlement[in_degree > 1]])
+    return next_hop, np.unique(ambiguous)
+
+
+def find_counted_interactions(swaps, tolerance=0.01):
+    """
+    Returns the IDs of the interactions whose sell amount compute_volume counts in volume out, skipping the
+    later hops of multi-hop swaps.
+    """
+    hop_index = build_hop_index(swaps)
+    visited = set()
+    counted = []
+    for id, swap in enumerate(swaps):
+        if swap.kind == "interaction" and id not in visited:
+            counted.append(id)
+            follow_hops(hop_index, swaps, id, visited, tolerance)
+    return counted
+
+
+def find_counted_rows(columns, tolerance=0.01):
+    """
+    Returns a mask of the rows counted in volume out.
+
+    When every interaction has at most one next hop and is the next hop of at most one other, hops form disjoint
+    chains and cycles, and compute_volume counts exactly the interactions that come before all the interactions
+    leading to them. That minimum is found for all chains at once by pointer jumping. Other settlements are
+    resolved swap by swap.
+    """
+    counted = columns.kind == INTERACTION
+    rows = np.flatnonzero(counted)
+    if len(rows) == 0:
+        return counted
+
+    next_hop, ambiguous = find_hop_edges(columns, rows, tolerance)
+
+    # previous[i] is the interaction whose next hop is i, and first[i] the lowest position among the interactions
+    # leading to i; each round doubles the length of the chain covered
+    previous = np.full(len(rows), -1, dtype=np.int64)
+    has_hop = next_hop >= 0
+    previous[next_hop[has_hop]] = np.flatnonzero(has_hop)
+    first = np.where(previous >= 0, previous, len(rows))
+    longest = int(np.max(np.diff(columns.offsets))) if len(columns) else 0
+    for _ in range(max(longest, 1).bit_length()):
+        has_previous = previous >= 0
+        first[has_previous] = np.minimum(
+            first[has_previous], first[previous[has_previous]]
+        )
+        previous[has_previous] = previous[previous[has_previous]]
+
+    # In a cycle the chain leads back to the interaction itself, which then only counts if it comes first
+    counted[rows] = first >= np.arange(len(rows))
+
+    for index in ambiguous.tolist():
+        start, end = columns.offsets[index], columns.offsets[index + 1]
+        counted[start:end] = False
+        ids = find_counted_interactions(columns.swaps_per_settlement[index], tolerance)
+        counted[start + np.array(ids, dtype=np.int64)] = True
+    return counted
+
+
+def group_volumes(columns, mask):
+    """
+    Sums the sell amounts of the masked rows per (settlement, token), and returns the sorted settlement * tokens +
+    token key and the summed amount of each group.
+    """
+    keys = columns.settlement[mask] * len(columns.tokens) + columns.sell_token[mask]
+    groups, inverse = np.unique(keys, return_inverse=True)
+    sums = np.bincount(
+        inverse, weights=columns.sell_amount[mask], minlength=len(groups)
+    )
+    return groups, sums
+
+
+@contextmanager
+def paused_gc():
+    # Results are hundreds of thousands of acyclic dicts, so collections triggered while building them free nothing
+    # and only rescan the heap
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+class TokenVolumes:
+    """
+    The USD volume of each (settlement, token) group on one side of many settlements, sorted by settlement.
+    Groups point at their token and price in the SettlementPrices they were priced with.
+    """
+
+    def __init__(self, groups, prices, n_settlements):
+        keys, sums = groups
+        self.settlement = keys // prices.n_tokens
+        self.positions = np.searchsorted(prices.keys, keys)
+        self.amount = sums / prices.scale[self.positions]
+        self.usd_value = self.amount * prices.price_usd[self.positions]
+        self.offsets = np.searchsorted(self.settlement, np.arange(n_settlements + 1))
+        self.totals = np.bincount(
+            self.settlement, weights=self.usd_value, minlength=n_settlements
+        )
+
+    def to_dicts(self, prices):
+        """
+        Returns the volumes of each settlement as calculate_usd_volume does.
+        """
+        positions = self.positions.tolist()
+        tokens = list(map(prices.tokens.__getitem__, positions))
+        entries = [
+            {"amount": amount, "usd_value": usd_value, "token": prices.prices[position]}
+            for amount, usd_value, position in zip(
+                self.amount.tolist(), self.usd_value.tolist(), positions
+            )
+        ]
+        offsets = self.offsets.tolist()
+        return [
+            dict(zip(tokens[start:end], entries[start:end]))
+            for start, end in zip(offsets, offsets[1:])
+        ]
+
+
+# Stands in for the price of a token a settlement has no price for
+MISSING_PRICE = {"priceUsd": math.nan}
+
+
+class SettlementPrices:
+    """
+    The price of every (settlement, token) group on either side of many settlements, looked up once in the
+    settlement prices, with the scale turning summed amounts into token units. Groups missing a price are valued
+    at NaN.
+    """
+
+    def __init__(self, keys, tokens, usd_prices_per_settlement):
+        self.keys = keys
+        self.n_tokens = len(tokens)
+        settlements = (keys // self.n_tokens).tolist()
+        token_ids = keys % self.n_tokens
+        self.tokens = list(map(tokens.__getitem__, token_ids.tolist()))
+        # Tokens the subgraph has no price for are priced None
+        self.prices = [
+            usd_prices_per_settlement[settlement].get(token) or MISSING_PRICE
+            for settlement, token in zip(settlements, self.tokens)
+        ]
+        self.price_usd = np.fromiter(
+            map(float, map(itemgetter("priceUsd"), self.prices)),
+            dtype=np.float64,
+            count=len(self.prices),
+        )
+
+        # Decimals never change, so they are read once per token from the first settlement pricing it
+        decimals = np.zeros(self.n_tokens, dtype=np.int64)
+        priced = np.flatnonzero(~np.isnan(self.price_usd))
+        distinct, first = np.unique(token_ids[priced], return_index=True)
+        decimals[distinct] = [
+            int(self.prices[position]["decimals"])
+            for position in priced[first].tolist()
+        ]
+        self.scale = POWERS_OF_TEN[decimals[token_ids]]
+
+    def missing(self):
+        """
+        Returns the settlement index and token of every group without a price.
+        """
+        return [
+            (int(self.keys[position]) // self.n_tokens, self.tokens[position])
+            for position in np.flatnonzero(np.isnan(self.price_usd)).tolist()
+        ]
+
+
+class CowinessColumns:
+    """
+    The cowiness of many settlements as arrays: totals and CoW value per settlement, and the per-token volumes in
+    and out. Settlements that could not be computed have an entry in errors.
+    """
+
+    def __init__(self, tx_hashes, block_numbers, prices, volume_in, volume_out):
+        self.tx_hashes = tx_hashes
+        self.block_numbers = block_numbers
+        self.prices = prices
+        self.volume_in = volume_in
+        self.volume_out = volume_out
+        self.total_volume_in_usd = volume_in.totals
+        self.total_volume_out_usd = volume_out.totals
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.cow_value = (volume_in.totals - volume_out.totals) / volume_in.totals
+
+        self.errors = {}
+        for index, token in prices.missing():
+            self.errors.setdefault(index, f"missing USD price for token {token}")
+        for index in np.flatnonzero(volume_in.totals == 0).tolist():
+            self.errors.setdefault(index, "float division by zero")
+
+    def __len__(self):
+        return len(self.tx_hashes)
+
+    def results(self):
+        """
+        Returns a {"tx_hash", "result"} dict per settlement with the result of compute_cowiness_detailed, or a
+        {"tx_hash", "error"} dict, like compute_cowiness_batch.
+        """
+        with paused_gc():
+            output = [
+                {
+                    "tx_hash": tx_hash,
+                    "result": {
+                        "tx_hash": tx_hash,
+                        "block_number": block_number,
+                        "total_volume_in_usd": volume_in,
+                        "total_volume_out_usd": volume_out,
+                        "cow_value": cow_value,
+                        "volume_in_usd": volume_in_usd,
+                        "volume_out_usd": volume_out_usd,
+                    },
+                }
+                for (
+                    tx_hash,
+                    block_number,
+                    volume_in_usd,
+                    volume_out_usd,
+                    volume_in,
+                    volume_out,
+                    cow_value,
+                ) in zip(
+                    self.tx_hashes,
+                    self.block_numbers,
+                    self.volume_in.to_dicts(self.prices),
+                    self.volume_out.to_dicts(self.prices),
+                    self.total_volume_in_usd.tolist(),
+                    self.total_volume_out_usd.tolist(),
+                    self.cow_value.tolist(),
+                )
+            ]
+        for index, error in self.errors.items():
+            output[index] = {"tx_hash": self.tx_hashes[index], "error": error}
+        return output
+
+
+class SettlementVolumes:
+    """
+    The volumes in and out of many settlements before pricing: the summed sell amount of each (settlement, token),
+    with multi-hop swaps resolved as compute_volume does.
+    """
+
+    def __init__(self, swaps_per_settlement, tolerance=0.01):
+        self.columns = SwapColumns(swaps_per_settlement)
+        # Volume in is the sell side of every trade, volume out the sell side of every counted interaction
+        self.volume_in = group_volumes(self.columns, self.columns.kind == TRADE)
+        self.volume_out = group_volumes(
+            self.columns, find_counted_rows(self.columns, tolerance)
+        )
+
+    def __len__(self):
+        return len(self.columns)
+
+    def tokens(self):
+        """
+        Returns the lowercase addresses of the tokens each settlement has a volume in or out of.
+        """
+        n_tokens = len(self.columns.tokens)
+        keys = np.union1d(self.volume_in[0], self.volume_out[0])
+        offsets = np.searchsorted(keys // n_tokens, np.arange(len(self) + 1)).tolist()
+        tokens = list(map(self.columns.tokens.__getitem__, (keys % n_tokens).tolist()))
+        return [tokens[start:end] for start, end in zip(offsets, offsets[1:])]
+
+    def price(self, tx_hashes, usd_prices_per_settlement, block_numbers=None):
+        """
+        Prices the volumes with the prices of each settlement, and returns the CowinessColumns of the settlements.
+        """
+        prices = SettlementPrices(
+            np.union1d(self.volume_in[0], self.volume_out[0]),
+            self.columns.tokens,
+            usd_prices_per_settlement,
+        )
+        return CowinessColumns(
+            tx_hashes,
+            block_numbers or [None] * len(self),
+            prices,
+            TokenVolumes(self.volume_in, prices, len(self)),
+            TokenVolumes(self.volume_out, prices, len(self)),
+        )
+
+
+def compute_cowiness_columnar(settlements, tolerance=0.01):
+    """
+    Computes the cowiness of many settlements at once, matching compute_cowiness_detailed.
+
+    :param settlements: List of (tx_hash, swaps, usd_prices) tuples, with swaps as returned by get_swaps and
+        usd_prices covering every token of the swaps, as after fetch_missing_usd_prices
+    :param tolerance: Tolerance of the multi-hop amount matching (default: 0.01)
+    :return: CowinessColumns of the settlements, whose results() gives the detailed result dicts
+    """
+    volumes = SettlementVolumes([swaps for _, swaps, _ in settlements], tolerance)
+    return volumes.price(
+        [tx_hash for tx_hash, _, _ in settlements],
+        [usd_prices for _, _, usd_prices in settlements],
+    )
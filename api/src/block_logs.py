@@ -0,0 +1,182 @@
+import requests
+from utils import metrics
+from utils.config import config
+from .web3 import get_block, get_logs, receipt_cache
+from utils.create_contracts import (
+    INTERACTION_TOPIC,
+    SETTLEMENT_ADDRESS,
+    SETTLEMENT_TOPIC,
+    TRADE_TOPIC,
+    TRANSFER_TOPIC,
+)
+
+# Blocks per eth_getLogs call to start with, and the most a window grows back to after being split
+GETLOGS_BLOCK_WINDOW = config.get_int("GETLOGS_BLOCK_WINDOW", 2000)
+# Most blocks a time range of settlements is fetched over; the receipts of settlements spread wider are fetched in
+# JSON-RPC batches instead
+RECEIPT_RANGE_MAX_BLOCKS = config.get_int(
+    "RECEIPT_RANGE_MAX_BLOCKS", GETLOGS_BLOCK_WINDOW
+)
+
+# Seconds between blocks since the merge, which block searches interpolate with
+BLOCK_TIME = 12
+
+SETTLEMENT_ADDRESS_TOPIC = "0x" + bytes(12).hex() + SETTLEMENT_ADDRESS[2:].lower()
+
+# The settlement's own events, and the ERC20 transfers from it and to it. Transfers between other addresses, such
+# as the hops of a route from pool to pool, change nothing the engines compute.
+SETTLEMENT_LOG_FILTERS = [
+    {
+        "address": SETTLEMENT_ADDRESS,
+        "topics": [
+            [
+                "0x" + topic.hex()
+                for topic in [TRADE_TOPIC, INTERACTION_TOPIC, SETTLEMENT_TOPIC]
+            ]
+        ],
+    },
+    {"topics": ["0x" + TRANSFER_TOPIC.hex(), SETTLEMENT_ADDRESS_TOPIC]},
+    {"topics": ["0x" + TRANSFER_TOPIC.hex(), None, SETTLEMENT_ADDRESS_TOPIC]},
+]
+
+
+def get_logs_in_range(filter_params, from_block, to_block, window=GETLOGS_BLOCK_WINDOW):
+    """
+    Returns the logs matching filter_params from from_block to to_block inclusive, in windows of up to window
+    blocks.
+
+    Nodes reject queries matching too many logs, or spanning too many blocks, with an error or a failed response.
+    A rejected window is split in half and retried, down to a single block, and the window doubles back toward its
+    size after each window that succeeds.
+    """
+    logs = []
+    size = window
+    start = from_block
+    while start <= to_block:
+        end = min(start + size - 1, to_block)
+        try:
+            metrics.count_upstream_call("rpc")
+            logs += get_logs({**filter_params, "fromBlock": start, "toBlock": end})
+        except (ValueError, requests.exceptions.RequestException):
+            if end == start:
+                raise
+            size = (end - start + 1) // 2
+            continue
+        start = end + 1
+        size = min(size * 2, window)
+    return logs
+
+
+def group_settlement_logs(logs):
+    """
+    Groups logs by transaction into receipts in the shape decode_receipt_logs and decode_flow_logs take, holding
+    only the given logs in log order. Returns the receipts of transactions that emitted a Settlement event, keyed
+    by lowercase tx hash in block order.
+    """
+    transactions = {}
+    for log in logs:
+        tx_hash = log["transactionHash"].hex().lower()
+        transactions.setdefault(tx_hash, {})[log["logIndex"]] = log
+
+    receipts = {}
+    for tx_hash, tx_logs in transactions.items():
+        settled = any(
+            log["address"] == SETTLEMENT_ADDRESS
+            and bytes(log["topics"][0]) == SETTLEMENT_TOPIC
+            for log in tx_logs.values()
+        )
+        if not settled:
+            continue
+        logs = [tx_logs[index] for index in sorted(tx_logs)]
+        receipts[tx_hash] = {
+            "transactionHash": tx_hash,
+            "blockNumber": logs[0]["blockNumber"],
+            "logs": logs,
+        }
+    return dict(
+        sorted(
+            receipts.items(),
+            key=lambda item: (
+                item[1]["blockNumber"],
+                item[1]["logs"][0]["transactionIndex"],
+            ),
+        )
+    )
+
+
+def get_settlement_receipts(from_block, to_block, window=GETLOGS_BLOCK_WINDOW):
+    """
+    Returns the receipts of every settlement from from_block to to_block inclusive as group_settlement_logs, with
+    one eth_getLogs call per filter and window of blocks instead of one receipt per settlement.
+    """
+    logs = []
+    for filter_params in SETTLEMENT_LOG_FILTERS:
+        logs += get_logs_in_range(filter_params, from_block, to_block, window)
+    return group_settlement_logs(logs)
+
+
+def prefetch_settlement_receipts(from_block, to_block, window=GETLOGS_BLOCK_WINDOW):
+    """
+    Fetches the receipts of every settlement from from_block to to_block inclusive into the receipt cache, where
+    computing their cowiness finds them. Returns their tx hashes in block order.
+    """
+    receipts = get_settlement_receipts(from_block, to_block, window)
+    for tx_hash, receipt in receipts.items():
+        receipt_cache.set(tx_hash, receipt)
+    return list(receipts)
+
+
+def block_at_timestamp(timestamp, latest):
+    """
+    Returns the number of the first block mined at or after timestamp, or the one after the latest block if none
+    was.
+
+    Block timestamps strictly increase, so a block t seconds away from timestamp is at most t blocks away from the
+    block searched for. Within those bounds, guesses are interpolated from the block time between the last two
+    blocks read, starting from BLOCK_TIME, and the range left is bisected after a guess that does not halve it.
+    """
+    if latest["timestamp"] < timestamp:
+        return latest["number"] + 1
+    low, high = 0, latest["number"]
+    block, previous = latest, None
+    bisect = False
+    while True:
+        width = high - low
+        if block["timestamp"] < timestamp:
+            low = max(low, block["number"] + 1)
+            high = min(high, block["number"] + timestamp - block["timestamp"])
+        else:
+            high = min(high, block["number"])
+            low = max(low, block["number"] - (block["timestamp"] - timestamp))
+        if low >= high:
+            return high
+        if bisect:
+            guess = (low + high) // 2
+        else:
+            block_time = BLOCK_TIME
+            if previous is not None:
+                block_time = (block["timestamp"] - previous["timestamp"]) / (
+                    block["number"] - previous["number"]
+                )
+            guess = block["number"] + round(
+                (timestamp - block["timestamp"]) / block_time
+            )
+            guess = min(max(guess, low), high - 1)
+        bisect = high - low > width // 2
+        block, previous = get_block(guess), block
+
+
+def prefetch_settlement_receipts_between(
+    start, end, max_blocks=RECEIPT_RANGE_MAX_BLOCKS
+):
+    """
+    Fetches the receipts of every settlement mined from the start to the end timestamp inclusive into the receipt
+    cache, like prefetch_settlement_receipts. Returns their tx hashes in block order, or None without fetching
+    anything if the range likely spans more than max_blocks blocks.
+    """
+    if (end - start) / BLOCK_TIME > max_blocks:
+        return None
+    latest = get_block("latest")
+    from_block = block_at_timestamp(start, latest)
+    to_block = block_at_timestamp(end + 1, latest) - 1
+    return prefetch_settlement_receipts(from_block, to_block)
@@ -1,39 +1,82 @@
-from .extract import get_swaps
-from utils.order_prices import get_usd_prices_for_tx, get_usd_price_for_token
-from ..utils.helpers import *
-
-
-# This function computes the volume of tokens traded in and out of a transaction
-def compute_volume(swaps):
-    # Initialize dictionaries to store volume in and volume out for each token
+import asyncio
+import contextvars
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from .extract import get_swaps, get_swaps_async
+from .graph_engine import get_flow_graph_async
+from .web3 import get_receipt_client, receipt_cache
+from .block_logs import prefetch_settlement_receipts_between
+from .records import token_table
+from .result_store import create_result_store
+from utils import metrics, replay
+from utils.config import config
+from utils.aio import run_with_session
+from utils.singleflight import AsyncSingleFlight, SingleFlight
+from utils.order_prices import (
+    get_usd_prices_for_tx,
+    get_usd_prices_for_tx_async,
+    get_usd_prices_for_tokens_async,
+)
+from api.utils.helpers import *
+
+# Version of the CoW computation; bump it whenever a change alters results so stored results get recomputed
+ALGORITHM_VERSION = 2
+# Version of the graph engine's computation, bumped the same way
+GRAPH_ALGORITHM_VERSION = 1
+
+# Engines extracting the volumes of a settlement, with the version results are stored under: "swaps" collapses
+# transfers into swaps and links multi-hop swaps by amount, "graph" takes the net flows of the settlement's
+# transfer graph
+ENGINES = {"swaps": ALGORITHM_VERSION, "graph": GRAPH_ALGORITHM_VERSION}
+
+# Engine used unless a request selects another one
+COW_ENGINE = config.get("COW_ENGINE", "swaps")
+if COW_ENGINE not in ENGINES:
+    raise ValueError(f"COW_ENGINE must be one of {', '.join(ENGINES)}")
+
+
+# Settled batch auctions never change, so detailed results of the default engine are stored once computed
+def get_result_store():
+    return config.client(
+        "result_store", lambda: create_result_store(COW_ENGINE, ENGINES[COW_ENGINE])
+    )
+
+
+# Requests for a settlement already being computed by the same engine wait for that computation and share its result
+computations = SingleFlight("compute_cowiness")
+# The same for requests served on an event loop, which await the computation in progress
+async_computations = AsyncSingleFlight("compute_cowiness")
+
+
+# This function computes the volume of tokens traded in and out of a transaction, keyed by lowercase token address
+def compute_volume(swaps, tokens=token_table):
+    # Initialize dictionaries to store volume in and volume out for each token id
     volume_in = {}
     volume_out = {}
 
     # Keep track of visited swaps to avoid double counting
     visited = set()
 
-    # Iterate over all swaps in the transaction
-    for id, swap in swaps.items():
+    # Index interactions by sell token so hops are found with a range lookup instead of a scan
+    hop_index = build_hop_index(swaps)
+
+    # Iterate over all swaps in the transaction, whose positions are their IDs
+    for id, swap in enumerate(swaps):
         # If the swap is a trade, add the sell amount to the volume in dictionary
-        if swap["kind"] == "trade":
-            add_to_volume(volume_in, swap["sell_token"], swap["sell_amount"])
+        if swap.kind == "trade":
+            add_to_volume(volume_in, swap.sell_token, swap.sell_amount)
         # If the swap is an interaction, add the sell amount to the volume out dictionary
-        elif swap["kind"] == "interaction":
+        elif swap.kind == "interaction":
             # Only add to volume out if this is the first time we're encountering this swap
             if id not in visited:
-                add_to_volume(volume_out, swap["sell_token"], swap["sell_amount"])
-                multi_hop = False
+                add_to_volume(volume_out, swap.sell_token, swap.sell_amount)
 
-                # Check if there are any subsequent swaps that should be added to volume out
-                for other_id, other_swap in swaps.items():
-                    if should_add_to_visited(id, other_id, swap, other_swap, visited):
-                        multi_hop = True
-                        visited.add(other_id)
-                        break
+                # Mark every subsequent hop of a multi-hop swap as visited so it is not counted again
+                follow_hops(hop_index, swaps, id, visited)
 
-    # Convert all token names to lowercase for consistency
-    volume_in = {k.lower(): v for k, v in volume_in.items()}
-    volume_out = {k.lower(): v for k, v in volume_out.items()}
+    # Key the volumes by lowercase token address
+    volume_in = {tokens.lowercase[k]: v for k, v in volume_in.items()}
+    volume_out = {tokens.lowercase[k]: v for k, v in volume_out.items()}
 
     # Return the volume in and volume out dictionaries
     return volume_in, volume_out
@@ -41,11 +84,12 @@ def compute_volume(swaps):
 
 def compute_cowiness(tx_hash):
     swaps, blockNumber = get_swaps(tx_hash)
-    swaps = {id: swap for id, swap in enumerate(swaps)}
     volume_in, volume_out = compute_volume(swaps)
-    print(volume_in, volume_out)
 
     usd_prices = get_usd_prices_for_tx(tx_hash)
+    run_with_session(
+        fetch_missing_usd_prices, blockNumber, [volume_in, volume_out], usd_prices
+    )
 
     volume_in_usd = calculate_usd_volume(blockNumber, volume_in, usd_prices)
     print(f"Total Volume In in USD: {volume_in_usd}")
@@ -56,12 +100,11 @@ def compute_cowiness(tx_hash):
 
 # This function calculates the USD value of a given volume of tokens, using the token's price in USD
 def calculate_usd_value(blockNumber, token, volume, usd_prices):
-    # Check if the token's price is already in the usd_prices dictionary
+    # Prices are fetched beforehand with fetch_missing_usd_prices, which leaves None for tokens the subgraph cannot
+    # price; fetching one here would start an event loop inside the one computing the settlement
     price = usd_prices.get(token)
     if price is None:
-        # If not, get the token's price from the blockchain and add it to the dictionary
-        price = get_usd_price_for_token(blockNumber, token)
-        usd_prices[token] = price
+        raise ValueError(f"missing USD price for token {token}")
 
     # Calculate the USD value of the volume using the token's price in USD
     amount = float(volume) / 10 ** int(price["decimals"])
@@ -71,6 +114,20 @@ def calculate_usd_value(blockNumber, token, volume, usd_prices):
     return {"amount": amount, "usd_value": usd_value, "token": price}
 
 
+# This function fetches the USD prices of all tokens of the given volume dictionaries missing from usd_prices at once
+async def fetch_missing_usd_prices(session, blockNumber, volume_dicts, usd_prices):
+    missing = [
+        token
+        for volume_dict in volume_dicts
+        for token in volume_dict
+        if token not in usd_prices
+    ]
+    if len(missing) > 0:
+        usd_prices.update(
+            await get_usd_prices_for_tokens_async(session, blockNumber, missing)
+        )
+
+
 # This function calculates the USD volume of each token in a given volume dictionary, using the token's price in USD
 def calculate_usd_volume(blockNumber, volume_dict, usd_prices):
     # Iterate over all tokens in the volume dictionary
@@ -81,48 +138,96 @@ def calculate_usd_volume(blockNumber, volume_dict, usd_prices):
 
 
 # This function computes the "Cow Index" of a given transaction, which is a measure of its profitability
-def compute_cowiness_simple(tx_hash):
-    # Get the swaps in the transaction and convert them to a dictionary with integer keys
-    swaps, blockNumber = get_swaps(tx_hash)
-    swaps = {id: swap for id, swap in enumerate(swaps)}
+def compute_cowiness_simple(tx_hash, engine=None):
+    # The Cow Index is part of the detailed result, which is served from the result store when available
+    return compute_cowiness_detailed(tx_hash, engine)["cow_value"]
 
-    # Compute the volume in and volume out dictionaries for the transaction
-    volume_in, volume_out = compute_volume(swaps)
 
-    # Get the USD prices for all tokens in the transaction
-    usd_prices = get_usd_prices_for_tx(tx_hash)
+# This function computes detailed information about the "Cow Index" of a given transaction
+def compute_cowiness_detailed(tx_hash, engine=None):
+    return computations.do(
+        (tx_hash.lower(), engine or COW_ENGINE),
+        run_with_session,
+        compute_cowiness_detailed_async,
+        tx_hash,
+        engine,
+    )
+
+
+# This function computes detailed information about the "Cow Index" of a given transaction on the running event loop,
+# sharing the computation in progress for it like compute_cowiness_detailed
+async def compute_cowiness_detailed_shared_async(session, tx_hash, engine=None):
+    return await async_computations.do(
+        (tx_hash.lower(), engine or COW_ENGINE),
+        compute_cowiness_detailed_async,
+        session,
+        tx_hash,
+        engine,
+    )
+
+
+# This function computes detailed information about the "Cow Index" of a given transaction, overlapping upstream calls
+async def compute_cowiness_detailed_async(session, tx_hash, engine=None):
+    engine = engine or COW_ENGINE
+    if engine not in ENGINES:
+        raise ValueError(f"unknown engine {engine}")
+
+    # Serve the result from the store if this settlement was already computed by the default engine, unless
+    # recording or replaying upstream responses, which needs the computation to run
+    stored = engine == COW_ENGINE and not replay.is_active()
+    if stored:
+        with metrics.span("result_store"):
+            result = await get_result_store().get_async(tx_hash)
+        if result is not None:
+            return result
+
+    # All upstream responses of the settlement are recorded in or replayed from its corpus
+    with replay.scope(tx_hash), metrics.span("compute_total"):
+        result = await compute_settlement_cowiness_async(session, tx_hash, engine)
+
+    if stored:
+        with metrics.span("result_store"):
+            await get_result_store().put_async(tx_hash, result)
+    return result
 
-    # Calculate the USD volume of each token in the volume in and volume out dictionaries
-    volume_in_usd = calculate_usd_volume(blockNumber, volume_in, usd_prices)
-    volume_out_usd = calculate_usd_volume(blockNumber, volume_out, usd_prices)
 
-    # Calculate the total USD volume of tokens traded in and out of the transaction
-    total_volume_out = sum([vol["usd_value"] for _, vol in volume_out_usd.items()])
-    total_volume_in = sum([vol["usd_value"] for _, vol in volume_in_usd.items()])
+# This function computes the volume in and volume out of a transaction with the given engine, and returns its block number
+async def compute_settlement_volume_async(session, tx_hash, engine):
+    if engine == "graph":
+        graph, blockNumber = await get_flow_graph_async(session, tx_hash)
+        with metrics.span("compute_volume"):
+            return graph.compute_volume(), blockNumber
 
-    # Calculate the Cow Index using the total USD volume of tokens traded in and out of the transaction
-    cow_value = (total_volume_in - total_volume_out) / total_volume_in
+    swaps, blockNumber = await get_swaps_async(session, tx_hash)
+    with metrics.span("compute_volume"):
+        return compute_volume(swaps), blockNumber
 
-    # Return the Cow Index
-    return cow_value
 
+# This function computes detailed information about the "Cow Index" of a given transaction from upstream data
+async def compute_settlement_cowiness_async(session, tx_hash, engine="swaps"):
+    # Compute the volume in and volume out dictionaries for the transaction and get the USD prices for all tokens
+    # in the transaction concurrently
+    ((volume_in, volume_out), blockNumber), usd_prices = await asyncio.gather(
+        compute_settlement_volume_async(session, tx_hash, engine),
+        get_usd_prices_for_tx_async(session, tx_hash),
+    )
 
-# This function computes detailed information about the "Cow Index" of a given transaction
-def compute_cowiness_detailed(tx_hash):
-    # Get the swaps in the transaction and convert them to a dictionary with integer keys
-    swaps, blockNumber = get_swaps(tx_hash)
-    swaps = {id: swap for id, swap in enumerate(swaps)}
+    # Get the USD prices of the tokens the settlement prices do not cover
+    with metrics.span("token_prices"):
+        await fetch_missing_usd_prices(
+            session, blockNumber, [volume_in, volume_out], usd_prices
+        )
 
-    # Compute the volume in and volume out dictionaries for the transaction
-    volume_in, volume_out = compute_volume(swaps)
+    # Calculate the USD volume of each token in the volume in and volume out dictionaries
+    with metrics.span("usd_volume"):
+        volume_in_usd = calculate_usd_volume(blockNumber, volume_in, usd_prices)
+        volume_out_usd = calculate_usd_volume(blockNumber, volume_out, usd_prices)
 
-    # Get the USD prices for all tokens in the transaction
-    usd_prices = get_usd_prices_for_tx(tx_hash)
+    return build_cowiness_result(tx_hash, volume_in_usd, volume_out_usd, blockNumber)
 
-    # Calculate the USD volume of each token in the volume in and volume out dictionaries
-    volume_in_usd = calculate_usd_volume(blockNumber, volume_in, usd_prices)
-    volume_out_usd = calculate_usd_volume(blockNumber, volume_out, usd_prices)
 
+# This function builds the detailed "Cow Index" result of a transaction from its USD volumes per token
+def build_cowiness_result(tx_hash, volume_in_usd, volume_out_usd, blockNumber=None):
     # Calculate the total USD volume of tokens traded in and out of the transaction
     total_volume_in_usd = sum([vol["usd_value"] for _, vol in volume_in_usd.items()])
     total_volume_out_usd = sum([vol["usd_value"] for _, vol in volume_out_usd.items()])
@@ -133,6 +238,7 @@ def compute_cowiness_detailed(tx_hash):
     # Create a dictionary with detailed information about the Cow Index and return it
     result = {
         "tx_hash": tx_hash,
+        "block_number": blockNumber,
         "total_volume_in_usd": total_volume_in_usd,
         "total_volume_out_usd": total_volume_out_usd,
         "cow_value": cow_value,
@@ -140,3 +246,161 @@ def compute_cowiness_detailed(tx_hash):
         "volume_out_usd": volume_out_usd,
     }
     return result
+
+
+# This function computes detailed results for many transactions concurrently, reporting errors per transaction.
+# Given the (start, end) timestamps the settlements were mined in, their receipts are fetched by block range.
+def compute_cowiness_batch(tx_hashes, max_workers=8, engine=None, time_range=None):
+    # Orders and token prices looked up by one settlement are shared with the rest of the batch through
+    # the orderbook client and token price caches
+    engine = engine or COW_ENGINE
+
+    # Each distinct transaction hash is only computed once, in a copy of the caller's context so stage timings
+    # and upstream calls add up on the current request
+    unique_hashes = list(dict.fromkeys(tx_hashes))
+
+    # The receipts of settlements not held in memory by the result store are fetched up front, unless replaying,
+    # where receipts come from the corpus: by block range over the time range if given, and otherwise, or for those
+    # the range missed, in JSON-RPC batches
+    if replay.mode != replay.REPLAY:
+        stored = engine == COW_ENGINE and not replay.is_active()
+        result_store = get_result_store()
+        missing = [
+            tx_hash
+            for tx_hash in unique_hashes
+            if not (stored and result_store.key(tx_hash) in result_store.cache)
+        ]
+        if len(missing) > 0 and time_range is not None:
+            try:
+                prefetch_settlement_receipts_between(*time_range)
+            except (ValueError, requests.exceptions.RequestException):
+                # A range the node keeps failing on leaves its receipts to the JSON-RPC batches
+                pass
+        get_receipt_client().prefetch(
+            [tx_hash for tx_hash in missing if tx_hash.lower() not in receipt_cache]
+        )
+
+    # The volumes of the swaps engine are computed for the whole batch at once, unless recording or replaying
+    # upstream responses, which needs each settlement computed in its own corpus scope
+    if engine == "swaps" and not replay.is_active():
+        outcomes = compute_cowiness_columnar_batch(unique_hashes, max_workers)
+    else:
+        outcomes = {}
+        futures = map_with_pool(
+            compute_cowiness_detailed,
+            [(tx_hash, engine) for tx_hash in unique_hashes],
+            max_workers,
+        )
+        for tx_hash, future in zip(unique_hashes, futures):
+            try:
+                outcomes[tx_hash] = {"result": future.result()}
+            except Exception as e:
+                outcomes[tx_hash] = {"error": str(e)}
+
+    return [{"tx_hash": tx_hash, **outcomes[tx_hash]} for tx_hash in tx_hashes]
+
+
+# This function calls fn with each tuple of arguments on a thread pool, in copies of the caller's context, and returns
+# the futures of the calls once all are done
+def map_with_pool(fn, arguments, max_workers):
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return [
+            executor.submit(contextvars.copy_context().run, fn, *args)
+            for args in arguments
+        ]
+
+
+# This function awaits fn(session, *args) for each tuple of arguments, at most limit at a time, and returns the result
+# or the exception of each call
+async def gather_with_limit(session, fn, arguments, limit):
+    semaphore = asyncio.Semaphore(limit)
+
+    async def call(args):
+        async with semaphore:
+            return await fn(session, *args)
+
+    return await asyncio.gather(
+        *[call(args) for args in arguments], return_exceptions=True
+    )
+
+
+# This function fetches the swaps, block number and settlement prices of a transaction
+async def fetch_settlement_swaps_async(session, tx_hash):
+    (swaps, blockNumber), usd_prices = await asyncio.gather(
+        get_swaps_async(session, tx_hash),
+        get_usd_prices_for_tx_async(session, tx_hash),
+    )
+    return swaps, blockNumber, usd_prices
+
+
+# This function computes detailed results of the swaps engine for many transactions with the columnar engine, and
+# returns a {"result"} or {"error"} dict per transaction
+def compute_cowiness_columnar_batch(tx_hashes, max_workers=8):
+    # NumPy takes a large share of the import time, and is only needed once a batch is computed
+    from .batch_volume import SettlementVolumes
+
+    outcomes = {}
+
+    # Settlements already computed by the default engine are served from the result store
+    stored = COW_ENGINE == "swaps"
+    pending = []
+    for tx_hash in tx_hashes:
+        result = None
+        if stored:
+            with metrics.span("result_store"):
+                result = get_result_store().get(tx_hash)
+        if result is not None:
+            outcomes[tx_hash] = {"result": result}
+        else:
+            pending.append(tx_hash)
+
+    # Upstream data is fetched for max_workers settlements at a time, over the process's shared session
+    fetched = run_with_session(
+        gather_with_limit,
+        fetch_settlement_swaps_async,
+        [(tx_hash,) for tx_hash in pending],
+        max_workers,
+    )
+    settlements = []
+    for tx_hash, outcome in zip(pending, fetched):
+        if isinstance(outcome, BaseException):
+            outcomes[tx_hash] = {"error": str(outcome)}
+        else:
+            settlements.append((tx_hash, *outcome))
+
+    with metrics.span("compute_volume"):
+        volumes = SettlementVolumes([swaps for _, swaps, _, _ in settlements])
+
+    # Get the USD prices of the tokens the settlement prices do not cover
+    with metrics.span("token_prices"):
+        fetched = run_with_session(
+            gather_with_limit,
+            fetch_missing_usd_prices,
+            [
+                (blockNumber, [tokens], usd_prices)
+                for (_, _, blockNumber, usd_prices), tokens in zip(
+                    settlements, volumes.tokens()
+                )
+            ],
+            max_workers,
+        )
+        for (tx_hash, _, _, _), outcome in zip(settlements, fetched):
+            if isinstance(outcome, BaseException):
+                outcomes[tx_hash] = {"error": str(outcome)}
+
+    with metrics.span("usd_volume"):
+        results = volumes.price(
+            [tx_hash for tx_hash, _, _, _ in settlements],
+            [usd_prices for _, _, _, usd_prices in settlements],
+            [blockNumber for _, _, blockNumber, _ in settlements],
+        ).results()
+
+    for entry in results:
+        tx_hash = entry.pop("tx_hash")
+        if tx_hash in outcomes:
+            continue
+        outcomes[tx_hash] = entry
+        if stored and "result" in entry:
+            with metrics.span("result_store"):
+                get_result_store().put(tx_hash, entry["result"])
+    return outcomes
@@ -1,68 +1,50 @@
-from .swaps import get_swaps
+from .extract import get_swaps
+from .records import token_table
+from api.utils.helpers import build_hop_index, follow_hops
 from utils.order_prices import get_usd_prices_for_tx, get_usd_price_for_token
 import argparse
 import json
 
 
-def is_within_tolerance(value1, value2, tolerance=0.01):
-    return abs(value1 - value2) <= max(value1, value2) * tolerance
-
-
 def compute_volume(swaps):
     volume_in = {}
     volume_out = {}
 
     visited = set()
+    hop_index = build_hop_index(swaps)
 
-    for id, swap in swaps.items():
-        if swap["kind"] == "trade":
-            if swap["sell_token"] not in volume_in:
-                volume_in[swap["sell_token"]] = 0
+    for id, swap in enumerate(swaps):
+        if swap.kind == "trade":
+            if swap.sell_token not in volume_in:
+                volume_in[swap.sell_token] = 0
             # if swap["buy_token"] not in volume_out:
             #     volume_out[swap["buy_token"]] = 0
-            volume_in[swap["sell_token"]] += swap["sell_amount"]
+            volume_in[swap.sell_token] += swap.sell_amount
             # volume_out[swap["buy_token"]] += swap["buy_amount"]
 
             # volume_out += swap["buy_amount"]
-        elif swap["kind"] == "interaction":
+        elif swap.kind == "interaction":
             # volume_in += swap["sell_amount"]
             # volume_out += swap["buy_amount"]
-            if swap["sell_token"] not in volume_out:
-                volume_out[swap["sell_token"]] = 0
+            if swap.sell_token not in volume_out:
+                volume_out[swap.sell_token] = 0
             # if swap["buy_token"] not in volume_out:
             #     volume_out[swap["buy_token"]] = 0
             if id not in visited:
-                volume_out[swap["sell_token"]] += swap["sell_amount"]
-                multi_hop = False
-                for other_id, other_swap in swaps.items():
-                    if (
-                        other_id != id
-                        and other_swap["kind"] == "interaction"
-                        and other_swap["sell_token"] == swap["buy_token"]
-                    ):
-                        if is_within_tolerance(
-                            swap["buy_amount"], other_swap["sell_amount"]
-                        ):
-                            multi_hop = True
-                            visited.add(other_id)
-                            # volume_out[other_swap["buy_token"]] += other_swap[
-                            #     "buy_amount"
-                            # ]
-                            break
+                volume_out[swap.sell_token] += swap.sell_amount
+                follow_hops(hop_index, swaps, id, visited)
             # volume_out[swap["buy_token"]] += swap["buy_amount"]
 
             # make token address lower case in volume_in
-    volume_in = {k.lower(): v for k, v in volume_in.items()}
-    volume_out = {k.lower(): v for k, v in volume_out.items()}
+    volume_in = {token_table.lowercase[k]: v for k, v in volume_in.items()}
+    volume_out = {token_table.lowercase[k]: v for k, v in volume_out.items()}
     return volume_in, volume_out
 
 
 def compute_cowiness(tx_hash):
     swaps, blockNumber = get_swaps(tx_hash)
-    swaps = {id: swap for id, swap in enumerate(swaps)}
-    # print(json.dumps(swaps, indent=2))
+    # print(json.dumps([swap.to_dict() for swap in swaps], indent=2))
     volume_in, volume_out = compute_volume(swaps)
-    print(volume_in, volume_out)
     # Calculate USD values for Volume In and Volume Out
     usd_prices = get_usd_prices_for_tx(tx_hash)
 
@@ -93,7 +75,6 @@ def compute_cowiness(tx_hash):
 
 def compute_cowiness_simple(tx_hash):
     swaps, blockNumber = get_swaps(tx_hash)
-    swaps = {id: swap for id, swap in enumerate(swaps)}
     volume_in, volume_out = compute_volume(swaps)
 
     # Calculate USD values for Volume In
@@ -133,7 +114,6 @@ def compute_cowiness_simple(tx_hash):
 
 def compute_cowiness_detailed(tx_hash):
     swaps, blockNumber = get_swaps(tx_hash)
-    swaps = {id: swap for id, swap in enumerate(swaps)}
     volume_in, volume_out = compute_volume(swaps)
 
     # Calculate USD values for Volume In
@@ -0,0 +1,87 @@
+import base64
+import json
+
+from utils.config import config
+from etl.db.schema import EXPORT_PROJECTION
+
+
+def encode_cursor(settlement):
+    """
+    Returns the opaque token resuming an export right after the given settlement.
+    """
+    position = [settlement["firstTradeTimestamp"], settlement["_id"]]
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_cursor(token):
+    """
+    Returns the (firstTradeTimestamp, _id) position of a cursor token, raising ValueError for a malformed one.
+    """
+    try:
+        timestamp, id = json.loads(base64.urlsafe_b64decode(token.encode()))
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"invalid cursor {token!r}") from e
+    if not isinstance(timestamp, int) or not isinstance(id, str):
+        raise ValueError(f"invalid cursor {token!r}")
+    return timestamp, id
+
+
+class ExportStore:
+    """
+    Reads the cowiness the ETL stored on each settlement, over a time range, one settlement at a time.
+
+    Settlements are read in (firstTradeTimestamp, _id) order from a single Mongo cursor fetching batch_size documents
+    at a time, so memory does not grow with the range, and every row carries the cursor token resuming after it.
+    """
+
+    def __init__(self, collection, batch_size=500):
+        self.collection = collection
+        self.batch_size = batch_size
+
+    def rows(self, start, end, after=None):
+        """
+        Yields the stored cowiness of each settlement whose first trade is between the start and end timestamps, end
+        excluded, after the (firstTradeTimestamp, _id) position of a decoded cursor if given.
+        """
+        query = {
+            "cowiness": {"$exists": True},
+            "firstTradeTimestamp": {"$gte": start, "$lt": end},
+        }
+        if after is not None:
+            timestamp, id = after
+            query["$or"] = [
+                {"firstTradeTimestamp": {"$gt": timestamp}},
+                {"firstTradeTimestamp": timestamp, "_id": {"$gt": id}},
+            ]
+        settlements = (
+            self.collection.find(query, EXPORT_PROJECTION)
+            .sort([("firstTradeTimestamp", 1), ("_id", 1)])
+            .batch_size(self.batch_size)
+        )
+        for settlement in settlements:
+            yield {
+                "txHash": settlement["txHash"],
+                "firstTradeTimestamp": settlement["firstTradeTimestamp"],
+                **settlement["cowiness"],
+                "cursor": encode_cursor(settlement),
+            }
+
+
+def create_export_store():
+    """
+    Creates the export store from the configuration, or returns None without MONGODB_URI.
+    """
+    if not config.get("MONGODB_URI"):
+        return None
+    from etl.db.mongo import connect
+
+    collection = connect(
+        config.get("MONGODB_URI"),
+        config.get("MONGODB_DB_NAME"),
+        config.get("MONGODB_COLLECTION_NAME"),
+    )
+    return ExportStore(collection, batch_size=config.get_int("EXPORT_BATCH_SIZE", 500))
+
+
+def get_export_store():
+    return config.client("export_store", create_export_store)
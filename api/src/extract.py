@@ -1,59 +1,191 @@
-from .web3 import get_receipt_from_txhash
-import web3.exceptions
-from ...utils.instance_collect import fetch_order
-from ...utils.create_contracts import create_erc20_contract, create_settlement_contract
-from ...utils.helpers import *
+import asyncio
+import functools
+import logging
+from .records import Swap, Transfer, token_table
+from .web3 import get_receipt_from_txhash, receipt_cache
+from utils import metrics, replay
+from utils.aio import run_with_session
+from utils.config import config
+from utils.instance_collect import orderbook_client
+from utils.create_contracts import (
+    INTERACTION_TOPIC,
+    SETTLEMENT_ADDRESS,
+    TRADE_TOPIC,
+    TRANSFER_TOPIC,
+    get_erc20_contract,
+    get_settlement_contract,
+)
+from utils.helpers import *
+
+logger = logging.getLogger(__name__)
+
+
+class UnreadableLog(ValueError):
+    """
+    Raised by EventDecoder on a log it can't read word by word.
+    """
 
-# Create settlement and erc20 contracts
-settlement = create_settlement_contract()
-erc20 = create_erc20_contract()
 
+@functools.lru_cache(maxsize=65536)
+def checksum_address(address):
+    # Settlements keep touching the same tokens and pools, so checksums are cached by raw address
+    from eth_utils import to_checksum_address
 
-def process_log(log):
-    """
-    Processes a log and returns the processed log if successful, otherwise returns None.
-    """
-    processed_log = None
+    return to_checksum_address(address)
 
-    try:
-        processed_log = try_process_settlement_trade(log)
-    except web3.exceptions.MismatchedABI:
-        pass
 
-    if processed_log is None:
-        try:
-            processed_log = try_process_settlement_interaction(log)
-        except web3.exceptions.MismatchedABI:
-            pass
+def read_static(kind, size, word):
+    if kind == "address":
+        if any(word[:12]):
+            raise UnreadableLog("non-zero address padding")
+        return checksum_address(word[12:])
+    if kind == "uint":
+        value = int.from_bytes(word, "big")
+        if value >> size:
+            raise UnreadableLog(f"uint{size} out of range")
+        return value
+    if any(word[size:]):
+        raise UnreadableLog(f"non-zero bytes{size} padding")
+    return word[:size]
 
-    if processed_log is None:
-        try:
-            processed_log = try_process_erc20_transfer(log)
-        except web3.exceptions.MismatchedABI:
-            pass
 
-    return processed_log
+def read_bytes(data, word):
+    offset = int.from_bytes(word, "big")
+    if offset + 32 > len(data):
+        raise UnreadableLog("bytes offset out of range")
+    length = int.from_bytes(data[offset : offset + 32], "big")
+    end = offset + 32 + length
+    padded_end = offset + 32 + -(-length // 32) * 32
+    if padded_end > len(data) or any(data[end:padded_end]):
+        raise UnreadableLog("invalid bytes encoding")
+    return data[offset + 32 : end]
 
 
-def try_process_settlement_trade(log):
+def parse_type(kind):
+    """
+    Splits a static ABI type into the reader kind and its size (bits for uint, bytes for bytesN), or returns None
+    for types EventDecoder does not read.
     """
-    Attempts to process a settlement trade log and returns the processed log if successful, otherwise raises an exception.
+    if kind == "address":
+        return "address", 20
+    if kind.startswith("uint") and kind[4:].isdigit():
+        return "uint", int(kind[4:])
+    if kind.startswith("bytes") and kind[5:].isdigit():
+        return "bytes", int(kind[5:])
+    if kind == "bytes":
+        return "dynamic", None
+    return None
+
+
+class EventDecoder:
     """
-    return settlement.events.Trade().processLog(log)
+    Decodes the logs of one event straight from their 32-byte topic and data words into what the event's
+    processLog returns, for events whose inputs are addresses, uints, fixed bytes and bytes.
 
+    Logs it can't read that way, such as ones with non-zero padding, are left to processLog, so they are decoded or
+    rejected exactly as before.
+    """
 
-def try_process_settlement_interaction(log):
+    def __init__(self, event):
+        self.event = event
+        self.name = event.abi["name"]
+        inputs = [
+            (input["name"], input["indexed"], parse_type(input["type"]))
+            for input in event.abi["inputs"]
+        ]
+        self.readable = all(
+            kind is not None and not (indexed and kind[0] == "dynamic")
+            for _, indexed, kind in inputs
+        )
+        self.topic_inputs = [(name, kind) for name, indexed, kind in inputs if indexed]
+        self.data_inputs = [
+            (name, kind) for name, indexed, kind in inputs if not indexed
+        ]
+
+    def __call__(self, log):
+        if self.readable:
+            try:
+                return self.read(log)
+            except UnreadableLog:
+                pass
+        return self.event.processLog(log)
+
+    def read(self, log):
+        from web3.datastructures import AttributeDict
+
+        data = log["data"]
+        data = bytes.fromhex(data[2:]) if isinstance(data, str) else bytes(data)
+        if len(data) < 32 * len(self.data_inputs):
+            raise UnreadableLog("data too short")
+
+        args = {}
+        for (name, (kind, size)), topic in zip(self.topic_inputs, log["topics"][1:]):
+            args[name] = read_static(kind, size, bytes(topic))
+        for index, (name, (kind, size)) in enumerate(self.data_inputs):
+            word = data[32 * index : 32 * index + 32]
+            if kind == "dynamic":
+                args[name] = read_bytes(data, word)
+            else:
+                args[name] = read_static(kind, size, word)
+
+        return AttributeDict(
+            {
+                "args": AttributeDict(args),
+                "event": self.name,
+                "logIndex": log["logIndex"],
+                "transactionIndex": log["transactionIndex"],
+                "transactionHash": log["transactionHash"],
+                "address": log["address"],
+                "blockHash": log["blockHash"],
+                "blockNumber": log["blockNumber"],
+            }
+        )
+
+
+def build_log_decoders():
     """
-    Attempts to process a settlement interaction log and returns the processed log if successful, otherwise raises an exception.
+    Builds a registry mapping each known event topic0 to its emitting address (None for any address), the number
+    of topics its logs have, and its EventDecoder.
     """
-    return settlement.events.Interaction().processLog(log)
+    settlement = get_settlement_contract()
+    erc20 = get_erc20_contract()
+    decoders = {}
+    for topic, address, event in [
+        (TRADE_TOPIC, SETTLEMENT_ADDRESS, settlement.events.Trade()),
+        (INTERACTION_TOPIC, SETTLEMENT_ADDRESS, settlement.events.Interaction()),
+        (TRANSFER_TOPIC, None, erc20.events.Transfer()),
+    ]:
+        topics = 1 + sum(input["indexed"] for input in event.abi["inputs"])
+        decoders[topic] = (address, topics, EventDecoder(event))
+    return decoders
+
 
+def get_log_decoders():
+    # Decoders are built on first use and looked up by topic0 for every log
+    return config.client("log_decoders", build_log_decoders)
 
-def try_process_erc20_transfer(log):
+
+def process_log(log, decoders=None):
     """
-    Attempts to process an erc20 transfer log and returns the processed log if successful, otherwise raises an exception.
+    Processes a log and returns the processed log if successful, otherwise returns None.
     """
-    return erc20.events.Transfer().processLog(log)
+    topics = log["topics"]
+    if len(topics) == 0:
+        return None
+
+    decoder = (decoders or get_log_decoders()).get(bytes(topics[0]))
+    if decoder is None:
+        return None
+
+    address, topic_count, decode = decoder
+    if address is not None and log["address"] != address:
+        return None
+
+    # ERC721 Transfer shares its topic0 with ERC20 Transfer but indexes the token id
+    if len(topics) != topic_count:
+        return None
+
+    return decode(log)
 
 
 def collapse_interaction_transfers(accumulator, target, value, selector):
@@ -62,18 +194,10 @@ def collapse_interaction_transfers(accumulator, target, value, selector):
     """
     tokens = {}
 
-    for token_amount in accumulator["ins"]:
-        token = token_amount["token"]
-        amount = token_amount["amount"]
-        if token not in tokens.keys():
-            tokens[token] = 0
-        tokens[token] += amount
-    for token_amount in accumulator["outs"]:
-        token = token_amount["token"]
-        amount = token_amount["amount"]
-        if token not in tokens.keys():
-            tokens[token] = 0
-        tokens[token] -= amount
+    for transfer in accumulator["ins"]:
+        tokens[transfer.token] = tokens.get(transfer.token, 0) + transfer.amount
+    for transfer in accumulator["outs"]:
+        tokens[transfer.token] = tokens.get(transfer.token, 0) - transfer.amount
 
     id = f"{target} @{selector}"
     entries = tokens.items()
@@ -82,86 +206,170 @@ def collapse_interaction_transfers(accumulator, target, value, selector):
     elif len(entries) != 2:
         raise RuntimeError(
             f"can't collapse interaction {id} transfers into a swap, entries are \n:",
-            entries,
+            [(token_table.addresses[token], amount) for token, amount in entries],
             "\n",
         )
     elif value != 0:
         raise RuntimeError(f"can't collapse interaction {id} with Ether value")
 
-    tx0 = {"token": list(entries)[0][0], "amount": list(entries)[0][1]}
-    tx1 = {"token": list(entries)[1][0], "amount": list(entries)[1][1]}
-
-    if tx0["amount"] > 0:
-        swap = {
-            "sell_token": tx1["token"],
-            "sell_amount": -tx1["amount"],
-            "buy_token": tx0["token"],
-            "buy_amount": tx0["amount"],
-        }
-    else:
-        swap = {
-            "sell_token": tx1["token"],
-            "sell_amount": tx1["amount"],
-            "buy_token": tx0["token"],
-            "buy_amount": -tx0["amount"],
-        }
+    (token0, amount0), (token1, amount1) = entries
 
     return [
-        {
-            "kind": "interaction",
-            "target": target,
-            "selector": hex(int.from_bytes(selector, byteorder="big", signed=False)),
-            **swap,
-        }
+        Swap(
+            kind="interaction",
+            sell_token=token1,
+            sell_amount=-amount1 if amount0 > 0 else amount1,
+            buy_token=token0,
+            buy_amount=amount0 if amount0 > 0 else -amount0,
+            target=target,
+            selector=hex(int.from_bytes(selector, byteorder="big", signed=False)),
+        )
     ]
 
 
-def get_swaps(tx_hash):
+def get_order_uid(args):
     """
-    Returns a list of swaps and the block number for the given transaction hash.
+    Returns the hex encoded order UID of a decoded Trade log.
     """
-    receipt = get_receipt_from_txhash(tx_hash)
-    blockNumber = receipt["blockNumber"]
+    return "0x" + str(
+        hex(int.from_bytes(args["orderUid"], byteorder="big", signed=False))
+    )[2:].zfill(112)
+
 
+def decode_receipt_logs(receipt):
+    """
+    Returns the decoded Trade, Interaction and Transfer logs of the given receipt, in log order.
+    """
     logs = receipt["logs"]
-    print("logs found are:", len(logs))
+    logger.debug("logs found are: %d", len(logs))
+    decoders = get_log_decoders()
     processed_logs = []
     for log in logs:
         address = log["address"]
-        processed_log = process_log(log)
+        processed_log = process_log(log, decoders)
         if processed_log is not None:
             processed_logs.append({"address": address, **processed_log})
+    return processed_logs
+
 
+async def fetch_orders_async(session, tx_hash, processed_logs):
+    """
+    Returns the orders of all Trade logs keyed by order UID. Orders missing from the orderbook client cache are
+    resolved with one bulk lookup of the orders settled in the transaction, and any left over are fetched concurrently.
+    """
+    oids = list(
+        dict.fromkeys(
+            get_order_uid(log["args"])
+            for log in processed_logs
+            if log["event"] == "Trade"
+        )
+    )
+    if replay.mode == replay.REPLAY:
+        return {oid: replay.load("order", oid) for oid in oids}
+
+    orders = {}
+    for oid in oids:
+        order = orderbook_client.cache.get(oid)
+        if order is not None:
+            orders[oid] = order
+
+    if len(oids) - len(orders) > 1:
+        settled_orders = await orderbook_client.fetch_orders_for_tx_async(
+            session, tx_hash
+        )
+        for oid in oids:
+            if oid in settled_orders:
+                orders[oid] = settled_orders[oid]
+
+    missing = [oid for oid in oids if oid not in orders]
+    fetched = await asyncio.gather(
+        *[orderbook_client.fetch_order_async(session, oid) for oid in missing]
+    )
+    orders.update(zip(missing, fetched))
+    for oid, order in orders.items():
+        replay.record("order", oid, order)
+    return orders
+
+
+def get_swaps(tx_hash):
+    """
+    Returns a list of Swap records and the block number for the given transaction hash.
+    """
+    return run_with_session(get_swaps_async, tx_hash)
+
+
+async def get_swaps_async(session, tx_hash):
+    """
+    Returns a list of Swap records and the block number for the given transaction hash, fetching the orders of its
+    trades concurrently.
+    """
+    processed_logs, orders, blockNumber = await get_settlement_logs_async(
+        session, tx_hash
+    )
+    with metrics.span("build_swaps"):
+        swaps = build_swaps(processed_logs, orders)
+    return swaps, blockNumber
+
+
+async def get_settlement_logs_async(session, tx_hash, decode=decode_receipt_logs):
+    """
+    Returns the logs of the given transaction hash as decoded by decode, the orders of its trades keyed by UID, and
+    its block number. The receipt is fetched unless it was fetched ahead by block range.
+    """
+    loop = asyncio.get_running_loop()
+
+    async def fetch_receipt():
+        receipt = receipt_cache.get(tx_hash.lower())
+        if receipt is not None:
+            return receipt
+        metrics.count_upstream_call("rpc")
+        return await loop.run_in_executor(None, get_receipt_from_txhash, tx_hash)
+
+    with replay.scope(tx_hash):
+        with metrics.span("receipt"):
+            receipt = await replay.replayable_async("receipt", tx_hash, fetch_receipt)
+        with metrics.span("decode"):
+            processed_logs = decode(receipt)
+        with metrics.span("orders"):
+            orders = await fetch_orders_async(session, tx_hash, processed_logs)
+    return processed_logs, orders, receipt["blockNumber"]
+
+
+def build_swaps(processed_logs, orders):
+    """
+    Reconciles the decoded logs of a settlement into a list of Swap records, given the orders of its trades keyed
+    by UID.
+    """
     swaps = []
     accumulator = {}
     expected_transfers = set()
+    debug = logger.isEnabledFor(logging.DEBUG)
 
     for index, log in enumerate(processed_logs):
         args = log["args"]
         address = log["address"]
-        print("Log detected: ", log["event"], "\n log index is: ", index)
+        if debug:
+            logger.debug("Log detected: %s, log index is: %d", log["event"], index)
         if log["event"] == "Trade":
-            oid = "0x" + str(
-                hex(int.from_bytes(args["orderUid"], byteorder="big", signed=False))
-            )[2:].zfill(112)
-            order = fetch_order(oid)
+            oid = get_order_uid(args)
+            order = orders[oid]
             swaps.append(
-                {
-                    "kind": "trade",
-                    "id": oid,
-                    "sell_token": args["sellToken"],
-                    "sell_amount": args["sellAmount"],
-                    "buy_token": normalize_token(args["buyToken"]),
-                    "buy_amount": args["buyAmount"],
-                    "fee": args["feeAmount"],
-                    "is_liquidity_order": order["isLiquidityOrder"],
-                }
+                Swap(
+                    kind="trade",
+                    sell_token=token_table.intern(args["sellToken"]),
+                    sell_amount=args["sellAmount"],
+                    buy_token=token_table.intern(normalize_token(args["buyToken"])),
+                    buy_amount=args["buyAmount"],
+                    id=oid,
+                    fee=args["feeAmount"],
+                    is_liquidity_order=order["isLiquidityOrder"],
+                )
             )
             expected_transfers.add(
                 transferUid(
                     args["sellToken"],
                     args["owner"],
-                    settlement.address,
+                    SETTLEMENT_ADDRESS,
                     args["sellAmount"],
                 )
             )
@@ -173,7 +381,7 @@ def get_swaps(tx_hash):
             #     "\nowner: ",
             #     args["owner"],
             #     "\nsettlement: ",
-            #     settlement.address,
+            #     SETTLEMENT_ADDRESS,
             #     "\n amount:",
             #     args["sellAmount"],
             # )
@@ -181,7 +389,7 @@ def get_swaps(tx_hash):
                 expected_transfers.add(
                     transferUid(
                         args["buyToken"],
-                        settlement.address,
+                        SETTLEMENT_ADDRESS,
                         normalize_receiver(order["receiver"], args["owner"]),
                         args["buyAmount"],
                     )
@@ -189,7 +397,7 @@ def get_swaps(tx_hash):
                 # print(
                 #     "added expected transfer leaving: ",
                 #     args["buyToken"],
-                #     settlement.address,
+                #     SETTLEMENT_ADDRESS,
                 #     normalize_receiver(order["receiver"], args["owner"]),
                 #     args["buyAmount"],
                 # )
@@ -197,7 +405,7 @@ def get_swaps(tx_hash):
                 #     "added expected transfer leaving: ",
                 #     "sell token: ",
                 #     args["buyToken"],
-                #     "\settlement.address: ",
+                #     "\SETTLEMENT_ADDRESS: ",
                 #     args["owner"],
                 #     "\rreceiver: ",
                 #     normalize_receiver(order["receiver"], args["owner"]),
@@ -211,11 +419,11 @@ def get_swaps(tx_hash):
         #         expected_transfers.remove(t)
         #         print("removed expected transfer")
         #     else:
-        #         if args["to"] == settlement.address:
+        #         if args["to"] == SETTLEMENT_ADDRESS:
         #             accumulator["ins"].append(
         #                 {"token": address, "amount": args["value"]}
         #             )
-        #         if args["from"] == settlement.address:
+        #         if args["from"] == SETTLEMENT_ADDRESS:
         #             accumulator["outs"].append(
         #                 {"token": address, "amount": args["value"]}
         #             )
@@ -227,19 +435,16 @@ def get_swaps(tx_hash):
                 expected_transfers.remove(t)
             else:
                 counterpart = (
-                    args["to"] if args["to"] != settlement.address else args["from"]
+                    args["to"] if args["to"] != SETTLEMENT_ADDRESS else args["from"]
                 )
                 if counterpart not in accumulator:
                     accumulator[counterpart] = {"ins": [], "outs": []}
 
-                if args["to"] == settlement.address:
-                    accumulator[counterpart]["ins"].append(
-                        {"token": address, "amount": args["value"]}
-                    )
-                if args["from"] == settlement.address:
-                    accumulator[counterpart]["outs"].append(
-                        {"token": address, "amount": args["value"]}
-                    )
+                transfer = Transfer(token_table.intern(address), args["value"])
+                if args["to"] == SETTLEMENT_ADDRESS:
+                    accumulator[counterpart]["ins"].append(transfer)
+                if args["from"] == SETTLEMENT_ADDRESS:
+                    accumulator[counterpart]["outs"].append(transfer)
 
         elif log["event"] == "Interaction":
             for counterpart, acc in accumulator.items():
@@ -282,4 +487,4 @@ def get_swaps(tx_hash):
         #     )
         #     accumulator["ins"] = accumulator["ins"][:-1]
         #     accumulator["outs"] = accumulator["outs"][:-1]
-    return swaps, blockNumber
+    return swaps
@@ -0,0 +1,176 @@
+from hexbytes import HexBytes
+from utils import metrics
+from .extract import get_order_uid, get_settlement_logs_async
+from .records import token_table
+from api.utils.helpers import add_to_volume
+from utils.create_contracts import SETTLEMENT_ADDRESS, TRADE_TOPIC, TRANSFER_TOPIC
+from utils.helpers import normalize_receiver
+
+# Node id of the settlement contract in every flow graph
+SETTLEMENT = 0
+
+
+class FlowGraph:
+    """
+    Token flows between a settlement and its counterparties, as a multigraph with one edge per transfer.
+
+    Nodes are addresses interned to ids, with the settlement contract as node 0, and edges are parallel lists of
+    counterparty, token id and signed amount: positive when the settlement sends, negative when it receives.
+    Transfers between two counterparties, such as the legs of a route from pool to pool, leave the settlement's
+    flows unchanged and are not kept.
+    """
+
+    def __init__(self, tokens=token_table):
+        self.tokens = tokens
+        self.nodes = {SETTLEMENT_ADDRESS.lower(): SETTLEMENT}
+        self.traders = set()
+        self.sold = {}
+        self.counterparty = []
+        self.token = []
+        self.amount = []
+
+    def node(self, address):
+        """
+        Returns the id of an address, assigning the next one if it was never seen. Addresses differing only in
+        case are the same node.
+        """
+        id = self.nodes.get(address)
+        if id is None:
+            id = self.nodes.setdefault(address.lower(), len(self.nodes))
+            self.nodes[address] = id
+        return id
+
+    def add_trade(self, owner, receiver, sell_token, sell_amount):
+        """
+        Adds the sell side of a trade to the volume in. Its owner and receiver are traders, whose transfers with
+        the settlement are the trade itself rather than external liquidity.
+        """
+        self.traders.add(self.node(owner))
+        self.traders.add(self.node(receiver))
+        add_to_volume(self.sold, self.tokens.intern(sell_token), sell_amount)
+
+    def add_transfer(self, token, from_, to, value):
+        source = self.node(from_)
+        target = self.node(to)
+        if source == target:
+            return
+        if source == SETTLEMENT:
+            self.counterparty.append(target)
+            self.amount.append(value)
+        elif target == SETTLEMENT:
+            self.counterparty.append(source)
+            self.amount.append(-value)
+        else:
+            return
+        self.token.append(self.tokens.intern(token))
+
+    def compute_volume(self):
+        """
+        Returns the volume in and volume out of the settlement, keyed by lowercase token address like
+        compute_volume.
+
+        Flow is conserved through every route, so an intermediate token bought from one venue and sold to the next
+        cancels out however the route splits or merges, and so does any flow that returns to the settlement. What
+        is left of each token, the amount the settlement sends to external liquidity net of what it gets back,
+        is its volume out. This takes one pass over the edges.
+        """
+        traders = self.traders
+        net = {}
+        for counterparty, token, amount in zip(
+            self.counterparty, self.token, self.amount
+        ):
+            if counterparty not in traders:
+                net[token] = net.get(token, 0) + amount
+
+        lowercase = self.tokens.lowercase
+        volume_in = {lowercase[token]: amount for token, amount in self.sold.items()}
+        volume_out = {
+            lowercase[token]: amount for token, amount in net.items() if amount > 0
+        }
+        return volume_in, volume_out
+
+
+def topic_address(topic):
+    return "0x" + bytes(topic)[12:].hex()
+
+
+def decode_flow_logs(receipt):
+    """
+    Decodes the Trade and ERC20 Transfer logs of the given receipt, the only ones a flow graph needs, straight from
+    their topics and data. Returns them in log order shaped like decode_receipt_logs, with lowercase addresses in
+    the arguments.
+    """
+    processed_logs = []
+    for log in receipt["logs"]:
+        topics = log["topics"]
+        if len(topics) == 0:
+            continue
+        topic = bytes(topics[0])
+
+        # ERC721 Transfer shares its topic0 with ERC20 Transfer but indexes the token id as a fourth topic
+        if topic == TRANSFER_TOPIC and len(topics) == 3:
+            data = bytes(HexBytes(log["data"]))
+            if len(data) != 32:
+                continue
+            args = {
+                "from": topic_address(topics[1]),
+                "to": topic_address(topics[2]),
+                "value": int.from_bytes(data, "big"),
+            }
+            event = "Transfer"
+        elif (
+            topic == TRADE_TOPIC
+            and len(topics) == 2
+            and log["address"] == SETTLEMENT_ADDRESS
+        ):
+            data = bytes(HexBytes(log["data"]))
+            words = [data[start : start + 32] for start in range(0, 192, 32)]
+            offset = int.from_bytes(words[5], "big")
+            length = int.from_bytes(data[offset : offset + 32], "big")
+            args = {
+                "owner": topic_address(topics[1]),
+                "sellToken": "0x" + words[0][12:].hex(),
+                "buyToken": "0x" + words[1][12:].hex(),
+                "sellAmount": int.from_bytes(words[2], "big"),
+                "buyAmount": int.from_bytes(words[3], "big"),
+                "feeAmount": int.from_bytes(words[4], "big"),
+                "orderUid": data[offset + 32 : offset + 32 + length],
+            }
+            event = "Trade"
+        else:
+            continue
+        processed_logs.append({"address": log["address"], "event": event, "args": args})
+    return processed_logs
+
+
+def build_flow_graph(processed_logs, orders):
+    """
+    Builds the flow graph of a settlement from its logs as decoded by decode_flow_logs or decode_receipt_logs, given
+    the orders of its trades keyed by UID.
+    """
+    graph = FlowGraph()
+    for log in processed_logs:
+        args = log["args"]
+        if log["event"] == "Trade":
+            order = orders[get_order_uid(args)]
+            graph.add_trade(
+                args["owner"],
+                normalize_receiver(order["receiver"], args["owner"]),
+                args["sellToken"],
+                args["sellAmount"],
+            )
+        elif log["event"] == "Transfer":
+            graph.add_transfer(log["address"], args["from"], args["to"], args["value"])
+    return graph
+
+
+async def get_flow_graph_async(session, tx_hash):
+    """
+    Returns the flow graph and the block number for the given transaction hash.
+    """
+    processed_logs, orders, blockNumber = await get_settlement_logs_async(
+        session, tx_hash, decode_flow_logs
+    )
+    with metrics.span("build_flow_graph"):
+        graph = build_flow_graph(processed_logs, orders)
+    return graph, blockNumber
@@ -0,0 +1,102 @@
+import threading
+from collections import namedtuple
+
+
+class TokenTable:
+    """
+    Interns token addresses to small integer ids shared by every settlement, so swaps hold an int per token
+    instead of an address string.
+
+    Addresses differing only in case get the same id. The address of an id keeps the spelling it was first seen
+    with, and its lowercase form is what volumes are keyed by.
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.addresses = []
+        self.lowercase = []
+        self._lock = threading.Lock()
+
+    def intern(self, address):
+        """
+        Returns the id of the token address, assigning the next one if it was never seen.
+        """
+        id = self.ids.get(address)
+        if id is not None:
+            return id
+        with self._lock:
+            key = address.lower()
+            id = self.ids.get(key)
+            if id is None:
+                id = len(self.addresses)
+                self.addresses.append(address)
+                self.lowercase.append(key)
+                self.ids[key] = id
+            self.ids[address] = id
+        return id
+
+    def __len__(self):
+        return len(self.addresses)
+
+
+# Tokens are shared by all settlements, and ids never change once assigned
+token_table = TokenTable()
+
+
+class Transfer(namedtuple("Transfer", ["token", "amount"])):
+    """
+    A token amount sent to or from the settlement contract, with the token as a token table id.
+    """
+
+    __slots__ = ()
+
+
+class Swap(
+    namedtuple(
+        "Swap",
+        [
+            "kind",
+            "sell_token",
+            "sell_amount",
+            "buy_token",
+            "buy_amount",
+            "id",
+            "fee",
+            "is_liquidity_order",
+            "target",
+            "selector",
+        ],
+        defaults=[None] * 5,
+    )
+):
+    """
+    A trade or an interaction of a settlement, with tokens as token table ids. Trades set id, fee and
+    is_liquidity_order, and interactions set target and selector.
+    """
+
+    __slots__ = ()
+
+    def to_dict(self, tokens=token_table):
+        """
+        Returns the swap in the dict shape of the API, with token addresses.
+        """
+        if self.kind == "trade":
+            return {
+                "kind": self.kind,
+                "id": self.id,
+                "sell_token": tokens.addresses[self.sell_token],
+                "sell_amount": self.sell_amount,
+                "buy_token": tokens.addresses[self.buy_token],
+                "buy_amount": self.buy_amount,
+                "fee": self.fee,
+                "is_liquidity_order": self.is_liquidity_order,
+            }
+        return {
+            "kind": self.kind,
+            "target": self.target,
+            "selector": self.selector,
+            "sell_token": tokens.addresses[self.sell_token],
+            "sell_amount": self.sell_amount,
+            "buy_token": tokens.addresses[self.buy_token],
+            "buy_amount": self.buy_amount,
+        }
@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import time
+
+from utils.config import config
+from utils.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class ResultStore:
+    """
+    Stores detailed cowiness results of settled transactions, keyed by tx hash.
+
+    Results are kept in an in-process LRU in front of an optional Mongo collection. Every result is tagged
+    with the engine and algorithm version it was computed with, and results from another engine or version are
+    treated as missing so they get recomputed. Results stored before engines were tagged are from the swaps engine.
+    """
+
+    def __init__(self, engine, version, collection=None, maxsize=1024):
+        self.engine = engine
+        self.version = version
+        self.collection = collection
+        self.cache = LRUCache(maxsize)
+        self.db_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(tx_hash):
+        return tx_hash.lower()
+
+    def get(self, tx_hash):
+        """
+        Returns the stored result for the given transaction hash, or None if it has to be computed.
+        """
+        key = self.key(tx_hash)
+        result = self.cache.get(key)
+        if result is not None:
+            return result
+
+        if self.collection is not None:
+            from pymongo.errors import PyMongoError
+
+            try:
+                document = self.collection.find_one(
+                    {"_id": key, **self.tag()}, {"result": 1}
+                )
+            except PyMongoError as e:
+                logger.warning("Result store lookup failed for %s: %s", key, e)
+                document = None
+            if document is not None:
+                self.db_hits += 1
+                self.cache.set(key, document["result"])
+                return document["result"]
+
+        self.misses += 1
+        return None
+
+    async def get_async(self, tx_hash):
+        """
+        Like get, reading MongoDB off the running event loop when the result is not held in memory.
+        """
+        if self.collection is None or self.key(tx_hash) in self.cache:
+            return self.get(tx_hash)
+        return await asyncio.get_running_loop().run_in_executor(None, self.get, tx_hash)
+
+    async def put_async(self, tx_hash, result):
+        """
+        Like put, writing to MongoDB off the running event loop.
+        """
+        if self.collection is None:
+            return self.put(tx_hash, result)
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.put, tx_hash, result
+        )
+
+    def put(self, tx_hash, result):
+        """
+        Stores the result computed for the given transaction hash.
+        """
+        key = self.key(tx_hash)
+        self.cache.set(key, result)
+
+        if self.collection is not None:
+            from pymongo.errors import PyMongoError
+
+            try:
+                self.collection.replace_one(
+                    {"_id": key},
+                    {
+                        "_id": key,
+                        "engine": self.engine,
+                        "version": self.version,
+                        "computedAt": int(time.time()),
+                        "result": result,
+                    },
+                    upsert=True,
+                )
+            except PyMongoError as e:
+                logger.warning("Result store write failed for %s: %s", key, e)
+
+    def tag(self):
+        """
+        Returns the filter matching results of this store's engine and version.
+        """
+        if self.engine == "swaps":
+            return {"engine": {"$in": ["swaps", None]}, "version": self.version}
+        return {"engine": self.engine, "version": self.version}
+
+    def stats(self):
+        """
+        Returns the hit and miss counters of the store.
+        """
+        return {
+            "engine": self.engine,
+            "version": self.version,
+            "memory_hits": self.cache.hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "cached": len(self.cache),
+        }
+
+
+def create_result_store(engine, version):
+    """
+    Creates the result store from the configuration. Without MONGODB_URI results are only cached in memory.
+    """
+    collection = None
+    if config.get("MONGODB_URI"):
+        from etl.db.mongo import connect
+
+        collection = connect(
+            config.get("MONGODB_URI"),
+            config.get("MONGODB_DB_NAME"),
+            config.get("MONGODB_RESULTS_COLLECTION_NAME", "cowiness_results"),
+        )
+    return ResultStore(
+        engine,
+        version,
+        collection=collection,
+        maxsize=config.get_int("RESULT_CACHE_SIZE", 1024),
+    )
@@ -0,0 +1,48 @@
+from utils.config import config
+from etl.db.rollups import INTERVALS, read_rollups
+
+
+class StatsStore:
+    """
+    Serves aggregate cowiness over time ranges from the hourly and daily rollups maintained by the ETL.
+    """
+
+    def __init__(self, hourly_collection, daily_collection):
+        self.hourly_collection = hourly_collection
+        self.daily_collection = daily_collection
+
+    def get(self, interval, start, end):
+        """
+        Returns the aggregates of each hour, day or week between the start and end timestamps, and their total.
+        """
+        return read_rollups(
+            self.hourly_collection,
+            self.daily_collection,
+            INTERVALS[interval],
+            start,
+            end,
+        )
+
+
+def create_stats_store():
+    """
+    Creates the stats store from the configuration, or returns None without MONGODB_URI.
+    """
+    if not config.get("MONGODB_URI"):
+        return None
+    from etl.db.mongo import connect
+
+    hourly_collection = connect(
+        config.get("MONGODB_URI"),
+        config.get("MONGODB_DB_NAME"),
+        config.get("MONGODB_HOURLY_COLLECTION_NAME", "cowiness_hourly"),
+    )
+    daily_collection = hourly_collection.database[
+        config.get("MONGODB_DAILY_COLLECTION_NAME", "cowiness_daily")
+    ]
+    return StatsStore(hourly_collection, daily_collection)
+
+
+def get_stats_store():
+    # Created on the first stats request, so the API starts without connecting to MongoDB
+    return config.client("stats_store", create_stats_store)
@@ -1,15 +1,125 @@
-import os
-from web3 import Web3
-from dotenv import load_dotenv
+import requests
+from utils import metrics
+from utils.cache import LRUCache
+from utils.config import config
 
-load_dotenv(os.path.abspath(os.path.join(os.path.dirname(__file__), "../../", ".env")))
+# Receipts fetched ahead, by block range or in batches, keyed by lowercase tx hash until their settlement is computed
+receipt_cache = LRUCache(config.get_int("RECEIPT_CACHE_SIZE", 4096))
 
-w3 = Web3(Web3.HTTPProvider(os.getenv("WEB3_URL")))
+
+def create_w3():
+    # web3 is most of the import time of the API, so it is only imported once a client needs it
+    from web3 import Web3
+
+    return Web3(Web3.HTTPProvider(config.get("WEB3_URL")))
+
+
+def get_w3():
+    return config.client("w3", create_w3)
+
+
+class ReceiptClient:
+    """
+    Fetches transaction receipts with JSON-RPC batch requests over a keep-alive session.
+
+    Hashes are sent batch_size calls per request. Calls that fail in a batch, with an error or without a receipt,
+    are sent again in the next round, up to max_attempts times. Receipts are formatted as web3 returns them.
+    """
+
+    def __init__(self, url, batch_size=100, max_attempts=3, timeout=30):
+        self.url = url
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def post_batch(self, tx_hashes):
+        """
+        Sends one batch of eth_getTransactionReceipt calls, and returns the response entries keyed by position.
+        """
+        metrics.count_upstream_call("rpc")
+        response = self.session.post(
+            self.url,
+            json=[
+                {
+                    "jsonrpc": "2.0",
+                    "id": index,
+                    "method": "eth_getTransactionReceipt",
+                    "params": [tx_hash],
+                }
+                for index, tx_hash in enumerate(tx_hashes)
+            ],
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        entries = response.json()
+        # Nodes that reject a whole batch answer with a single error object
+        if not isinstance(entries, list):
+            return {}
+        return {entry.get("id"): entry for entry in entries}
+
+    def get_receipts(self, tx_hashes):
+        """
+        Returns the receipts of the given transaction hashes keyed by hash. Hashes whose receipt still failed after
+        max_attempts are left out.
+        """
+        from web3._utils.method_formatters import receipt_formatter
+        from web3.datastructures import AttributeDict
+
+        receipts = {}
+        pending = list(dict.fromkeys(tx_hashes))
+        for _ in range(self.max_attempts):
+            failed = []
+            for start in range(0, len(pending), self.batch_size):
+                batch = pending[start : start + self.batch_size]
+                try:
+                    entries = self.post_batch(batch)
+                except (ValueError, requests.exceptions.RequestException):
+                    failed += batch
+                    continue
+                for index, tx_hash in enumerate(batch):
+                    result = entries.get(index, {}).get("result")
+                    if result is None:
+                        failed.append(tx_hash)
+                    else:
+                        receipts[tx_hash] = AttributeDict.recursive(
+                            receipt_formatter(result)
+                        )
+            pending = failed
+            if len(pending) == 0:
+                break
+        return receipts
+
+    def prefetch(self, tx_hashes):
+        """
+        Fetches the receipts of the given transaction hashes into the receipt cache. Those that fail are left to be
+        fetched one at a time when computed.
+        """
+        for tx_hash, receipt in self.get_receipts(tx_hashes).items():
+            receipt_cache.set(tx_hash.lower(), receipt)
+
+
+def create_receipt_client():
+    return ReceiptClient(
+        config.get("WEB3_URL"), batch_size=config.get_int("RPC_BATCH_SIZE", 100)
+    )
+
+
+def get_receipt_client():
+    return config.client("receipt_client", create_receipt_client)
 
 
 def get_receipt_from_txhash(txhash):
-    return w3.eth.getTransactionReceipt(txhash)
+    return get_w3().eth.getTransactionReceipt(txhash)
+
+
+def get_logs(filter_params):
+    return get_w3().eth.get_logs(filter_params)
+
+
+def get_block(block_identifier):
+    return get_w3().eth.get_block(block_identifier)
 
 
 def create_contract(address, abi):
-    return w3.eth.contract(address=address, abi=abi)
+    return get_w3().eth.contract(address=address, abi=abi)
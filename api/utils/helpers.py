@@ -1,3 +1,6 @@
+from bisect import bisect_left, bisect_right
+
+
 def is_within_tolerance(value1, value2, tolerance=0.01):
     """
     Check if the difference between two values is within a specified tolerance.
@@ -23,21 +26,87 @@ def add_to_volume(volume_dict, token, amount):
     volume_dict[token] += amount
 
 
-def should_add_to_visited(id, other_id, swap, other_swap, visited):
+def build_hop_index(swaps):
+    """
+    Index the interactions of a settlement by sell token and sell amount.
+
+    :param swaps: List of swap records, whose positions are their swap IDs
+    :return: Dictionary mapping each sell token to a tuple of its ascending distinct sell amounts, the ascending
+        swap IDs selling each amount, and for each amount a cursor to its first ID not yet visited
+    """
+    entries = {}
+    for id, swap in enumerate(swaps):
+        if swap.kind == "interaction":
+            entries.setdefault(swap.sell_token, []).append((swap.sell_amount, id))
+
+    index = {}
+    for token, token_entries in entries.items():
+        token_entries.sort()
+        amounts = []
+        runs = []
+        for amount, id in token_entries:
+            if amounts and amounts[-1] == amount:
+                runs[-1].append(id)
+            else:
+                amounts.append(amount)
+                runs.append([id])
+        index[token] = (amounts, runs, [0] * len(amounts))
+    return index
+
+
+def find_next_hop(index, id, swap, visited, tolerance=0.01):
     """
-    Check if an interaction should be added to the visited set.
+    Find the interaction selling the buy token of a swap for an amount within tolerance of its buy amount.
 
+    Swaps never leave the visited set, so an index must only be used with one visited set that only grows: the
+    cursors of the index move past visited IDs for good.
+
+    :param index: Hop index built by build_hop_index
     :param id: Current swap ID
-    :param other_id: Other swap ID to compare
-    :param swap: Current swap
-    :param other_swap: Other swap to compare
+    :param swap: Current swap record
+    :param visited: Set containing visited swaps
+    :param tolerance: Tolerance value to check against (default: 0.01)
+    :return: The lowest matching unvisited swap ID, or None if there is no match
+    """
+    if swap.buy_token not in index:
+        return None
+    amounts, runs, cursors = index[swap.buy_token]
+
+    # Amounts within tolerance of the buy amount lie in [buy * (1 - t), buy / (1 - t)]; the band is widened
+    # slightly so float rounding never excludes a match, and every amount is checked exactly
+    buy_amount = swap.buy_amount
+    low = bisect_left(amounts, buy_amount * (1 - tolerance) * (1 - 1e-9))
+    high = bisect_right(amounts, buy_amount / (1 - tolerance) * (1 + 1e-9))
+
+    next_id = None
+    for position in range(low, high):
+        if not is_within_tolerance(buy_amount, amounts[position], tolerance):
+            continue
+        # IDs of an amount are ascending, so its lowest unvisited ID is the first one past the visited ones
+        run = runs[position]
+        cursor = cursors[position]
+        while cursor < len(run) and run[cursor] in visited:
+            cursor += 1
+        cursors[position] = cursor
+        while cursor < len(run) and (run[cursor] == id or run[cursor] in visited):
+            cursor += 1
+        if cursor < len(run) and (next_id is None or run[cursor] < next_id):
+            next_id = run[cursor]
+    return next_id
+
+
+def follow_hops(index, swaps, id, visited, tolerance=0.01):
+    """
+    Follow the chain of hops starting at a swap, adding every hop to the visited set.
+
+    :param index: Hop index built by build_hop_index
+    :param swaps: List of swap records, whose positions are their swap IDs
+    :param id: Swap ID the chain starts at
     :param visited: Set containing visited swaps
-    :return: True if the interaction should be added to the visited set, False otherwise
-    """
-    return (
-        other_id != id
-        and other_swap["kind"] == "interaction"
-        and other_swap["sell_token"] == swap["buy_token"]
-        and is_within_tolerance(swap["buy_amount"], other_swap["sell_amount"])
-        and other_id not in visited
-    )
+    :param tolerance: Tolerance value to check against (default: 0.01)
+    """
+    next_id = find_next_hop(index, id, swaps[id], visited, tolerance)
+    while next_id is not None:
+        visited.add(next_id)
+        id = next_id
+        next_id = find_next_hop(index, id, swaps[id], visited, tolerance)
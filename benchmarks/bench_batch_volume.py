@@ -0,0 +1,128 @@
+"""
+Compares the columnar batch volume engine with computing settlements one at a time, on synthetic swaps.
+
+Run from the root of the repository:
+
+    python -m benchmarks.bench_batch_volume --settlements 100000
+"""
+import argparse
+import math
+import random
+import time
+
+from api.src import compute_cow
+from api.src.batch_volume import compute_cowiness_columnar
+from api.src.records import token_table
+from benchmarks.synthetic import make_swaps
+
+
+def make_settlements(rng, count, tokens, hops):
+    """
+    Builds settlements of 2 to 12 swaps over a shared pool of tokens, with settlement prices covering every token.
+    """
+    prices = {}
+    settlements = []
+    for index in range(count):
+        swaps = make_swaps(rng, rng.randint(2, 12), tokens, hops)
+        usd_prices = {}
+        for swap in swaps:
+            for token in [
+                token_table.lowercase[swap.sell_token],
+                token_table.lowercase[swap.buy_token],
+            ]:
+                if token not in prices:
+                    prices[token] = {
+                        "name": token,
+                        "decimals": str(rng.choice([6, 8, 18])),
+                        "priceUsd": rng.uniform(0.01, 3000),
+                        "amount": 0,
+                    }
+                usd_prices[token] = prices[token]
+        settlements.append((f"0x{index:064x}", swaps, usd_prices))
+    return settlements
+
+
+def compute_one_at_a_time(settlements):
+    """
+    The per-settlement path of compute_cowiness_detailed once swaps and prices are known.
+    """
+    results = []
+    for tx_hash, swaps, usd_prices in settlements:
+        volume_in, volume_out = compute_cow.compute_volume(swaps)
+        volume_in_usd = compute_cow.calculate_usd_volume(0, volume_in, usd_prices)
+        volume_out_usd = compute_cow.calculate_usd_volume(0, volume_out, usd_prices)
+        try:
+            results.append(
+                {
+                    "tx_hash": tx_hash,
+                    "result": compute_cow.build_cowiness_result(
+                        tx_hash, volume_in_usd, volume_out_usd
+                    ),
+                }
+            )
+        except ZeroDivisionError as e:
+            results.append({"tx_hash": tx_hash, "error": str(e)})
+    return results
+
+
+def same_result(expected, actual):
+    if "error" in expected or "error" in actual:
+        return expected.get("error") == actual.get("error")
+    expected, actual = expected["result"], actual["result"]
+    for key in ["total_volume_in_usd", "total_volume_out_usd", "cow_value"]:
+        if not math.isclose(expected[key], actual[key], rel_tol=1e-9, abs_tol=1e-9):
+            return False
+    for key in ["volume_in_usd", "volume_out_usd"]:
+        if expected[key].keys() != actual[key].keys():
+            return False
+        for token, volume in expected[key].items():
+            if not math.isclose(
+                volume["usd_value"], actual[key][token]["usd_value"], rel_tol=1e-9
+            ):
+                return False
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the columnar batch volume engine."
+    )
+    parser.add_argument(
+        "--settlements", type=int, default=100000, help="Settlements per batch."
+    )
+    parser.add_argument("--tokens", type=int, default=500, help="Distinct tokens.")
+    parser.add_argument(
+        "--hops", type=int, default=3, help="Maximum hops of a multi-hop swap."
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    args = parser.parse_args()
+
+    settlements = make_settlements(
+        random.Random(args.seed), args.settlements, args.tokens, args.hops
+    )
+
+    start = time.perf_counter()
+    expected = compute_one_at_a_time(settlements)
+    before = time.perf_counter() - start
+
+    start = time.perf_counter()
+    columns = compute_cowiness_columnar(settlements)
+    after = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = columns.results()
+    materialize = time.perf_counter() - start
+
+    mismatches = sum(not same_result(e, a) for e, a in zip(expected, actual))
+    print(f"settlements:          {args.settlements}")
+    print(
+        f"one at a time:        {before:.2f}s ({args.settlements / before:,.0f} settlements/sec)"
+    )
+    print(
+        f"columnar:             {after:.2f}s ({args.settlements / after:,.0f} settlements/sec)"
+    )
+    print(f"speedup:              {before / after:.1f}x")
+    print(
+        f"  + result dicts:     {materialize:.2f}s ({before / (after + materialize):.1f}x overall)"
+    )
+    print(f"mismatched results:   {mismatches}")
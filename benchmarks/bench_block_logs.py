@@ -0,0 +1,86 @@
+"""
+Compares fetching settlements by block range with eth_getLogs against fetching one receipt per settlement, over a
+stub JSON-RPC server holding synthetic settlements. The server rejects eth_getLogs calls matching more than
+--max-logs logs, as hosted nodes do, and answers each request after --latency milliseconds.
+
+Checks that both ways give every settlement the same swaps and volumes, and reports RPC calls and time taken.
+
+Run from the root of the repository:
+
+    python -m benchmarks.bench_block_logs --settlements 500
+"""
+import argparse
+import random
+import time
+
+from web3 import Web3
+
+from api.src import block_logs, compute_cow, extract
+from api.src.graph_engine import build_flow_graph
+from api.src.web3 import get_receipt_from_txhash, get_w3
+from benchmarks.stub_node import StubNode, place_settlements
+from benchmarks.synthetic import make_settlement
+
+
+def volumes(receipt, orders):
+    processed_logs = extract.decode_receipt_logs(receipt)
+    swaps = extract.build_swaps(processed_logs, orders)
+    return (
+        swaps,
+        compute_cow.compute_volume(swaps),
+        build_flow_graph(processed_logs, orders).compute_volume(),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark block range log fetching against per-settlement receipts."
+    )
+    parser.add_argument("--settlements", type=int, default=500)
+    parser.add_argument("--blocks", type=int, default=20000, help="Blocks spanned.")
+    parser.add_argument(
+        "--max-logs", type=int, default=10000, help="Most logs per eth_getLogs call."
+    )
+    parser.add_argument(
+        "--latency", type=float, default=20, help="Milliseconds per request."
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    settlements = [
+        make_settlement(rng, rng.randint(1, 20), rng.randint(1, 20), 30, 2, noise=2)
+        for _ in range(args.settlements)
+    ]
+    chain_logs, receipts = place_settlements(rng, settlements, args.blocks)
+    orders = {
+        tx_hash: settlement_orders
+        for tx_hash, (_, settlement_orders) in zip(receipts, settlements)
+    }
+    node = StubNode(chain_logs, receipts, args.max_logs, args.latency / 1000)
+    server = node.serve()
+    get_w3().provider = Web3.HTTPProvider(f"http://127.0.0.1:{server.server_port}")
+    print(f"{len(receipts)} settlements, {len(chain_logs)} logs")
+
+    start = time.perf_counter()
+    by_range = block_logs.get_settlement_receipts(0, args.blocks - 1)
+    range_seconds = time.perf_counter() - start
+    range_calls = node.calls.pop("eth_getLogs")
+
+    start = time.perf_counter()
+    by_receipt = {tx_hash: get_receipt_from_txhash(tx_hash) for tx_hash in receipts}
+    receipt_seconds = time.perf_counter() - start
+    receipt_calls = node.calls.pop("eth_getTransactionReceipt")
+
+    same = sum(
+        volumes(by_range.get(tx_hash), orders[tx_hash])
+        == volumes(receipt, orders[tx_hash])
+        for tx_hash, receipt in by_receipt.items()
+        if tx_hash in by_range
+    )
+    print(f"same swaps and volumes: {same}/{len(receipts)}")
+    print(f"eth_getLogs:                {range_calls:>6} calls {range_seconds:>8.2f}s")
+    print(
+        f"eth_getTransactionReceipt:  {receipt_calls:>6} calls {receipt_seconds:>8.2f}s"
+    )
+    server.shutdown()
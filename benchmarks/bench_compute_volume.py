@@ -0,0 +1,75 @@
+"""
+Benchmarks compute_volume on synthetic settlements with a growing number of interactions.
+
+Run from the root of the repository:
+
+    python -m benchmarks.bench_compute_volume --sizes 10 100 1000
+"""
+import argparse
+import random
+import time
+
+from api.src import compute_cow, cowiness
+from api.utils.helpers import add_to_volume, is_within_tolerance
+from benchmarks.synthetic import make_swaps
+
+
+def compute_volume_scan(swaps):
+    """
+    The previous compute_volume: scans every swap for the next hop of each interaction and links one hop only.
+    """
+    volume_in = {}
+    volume_out = {}
+    visited = set()
+    for id, swap in enumerate(swaps):
+        if swap.kind == "trade":
+            add_to_volume(volume_in, swap.sell_token, swap.sell_amount)
+        elif swap.kind == "interaction":
+            if id not in visited:
+                add_to_volume(volume_out, swap.sell_token, swap.sell_amount)
+                for other_id, other_swap in enumerate(swaps):
+                    if (
+                        other_id != id
+                        and other_swap.kind == "interaction"
+                        and other_swap.sell_token == swap.buy_token
+                        and is_within_tolerance(swap.buy_amount, other_swap.sell_amount)
+                        and other_id not in visited
+                    ):
+                        visited.add(other_id)
+                        break
+    return volume_in, volume_out
+
+
+def seconds_per_call(compute_volume, swaps, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        compute_volume(swaps)
+    return (time.perf_counter() - start) / rounds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark compute_volume.")
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[10, 100, 1000],
+        help="Swaps per settlement.",
+    )
+    parser.add_argument("--rounds", type=int, default=5, help="Calls per measurement.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"{'swaps':>6} {'scan':>12} {'compute_cow':>12} {'cowiness':>12}")
+    for size in args.sizes:
+        swaps = make_swaps(rng, size)
+        timings = [
+            seconds_per_call(compute_volume, swaps, args.rounds) * 1000
+            for compute_volume in [
+                compute_volume_scan,
+                compute_cow.compute_volume,
+                cowiness.compute_volume,
+            ]
+        ]
+        print(f"{len(swaps):>6}" + "".join(f"{t:>10.3f}ms" for t in timings))
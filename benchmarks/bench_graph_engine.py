@@ -0,0 +1,100 @@
+"""
+Compares the graph engine with the swaps engine on synthetic settlements: how many get the expected volume out,
+including the shapes limitations.md lists as failing, and how long each takes from receipt to volumes on a
+settlement of about 500 logs.
+
+Run from the root of the repository:
+
+    python -m benchmarks.bench_graph_engine --settlements 200
+"""
+import argparse
+import random
+import time
+
+from api.src import compute_cow, extract
+from api.src.graph_engine import build_flow_graph, decode_flow_logs
+from benchmarks.synthetic import make_routed_settlement, make_settlement
+
+
+def swaps_engine(receipt, orders):
+    processed_logs = extract.decode_receipt_logs(receipt)
+    return compute_cow.compute_volume(extract.build_swaps(processed_logs, orders))
+
+
+def graph_engine(receipt, orders):
+    return build_flow_graph(decode_flow_logs(receipt), orders).compute_volume()
+
+
+ENGINES = {"swaps": swaps_engine, "graph": graph_engine}
+
+
+def count_correct(settlements):
+    """
+    Returns the number of settlements each engine gets the expected volume out of, and the number it fails on.
+    """
+    counts = {}
+    for name, engine in ENGINES.items():
+        correct = failed = 0
+        for receipt, orders, expected in settlements:
+            try:
+                _, volume_out = engine(receipt, orders)
+            except RuntimeError:
+                failed += 1
+                continue
+            correct += volume_out == expected
+        counts[name] = (correct, failed)
+    return counts
+
+
+def milliseconds_per_call(fn, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - start) / rounds * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the graph engine against the swaps engine."
+    )
+    parser.add_argument(
+        "--settlements", type=int, default=200, help="Settlements per shape."
+    )
+    parser.add_argument("--rounds", type=int, default=20, help="Timed calls.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    shapes = {
+        "pool to pool routes, up to 4 hops": lambda: make_routed_settlement(
+            rng, trades=rng.randint(1, 20), routes=rng.randint(1, 8)
+        ),
+        "one intermediary, refunds, 30+ logs": lambda: make_routed_settlement(
+            rng, trades=rng.randint(5, 20), routes=rng.randint(4, 10), intermediary=True
+        ),
+    }
+
+    print(f"{'shape':<38}{'swaps ok/failed':>18}{'graph ok/failed':>18}")
+    for shape, make in shapes.items():
+        settlements = [make() for _ in range(args.settlements)]
+        counts = count_correct(settlements)
+        print(
+            f"{shape:<38}"
+            + "".join(f"{f'{ok}/{failed}':>18}" for ok, failed in counts.values())
+        )
+
+    # Where routes share tokens, a token bought by one and sold by another cancels out in the graph engine only
+    same = 0
+    for _ in range(args.settlements):
+        receipt, orders = make_settlement(
+            rng, rng.randint(1, 20), rng.randint(1, 20), 50, rng.randint(1, 4)
+        )
+        same += swaps_engine(receipt, orders)[1] == graph_engine(receipt, orders)[1]
+    print(f"same volume out on other settlements: {same}/{args.settlements}")
+
+    # 100 trades and 50 interactions of one hop make 3 + 4 logs each
+    receipt, orders = make_settlement(rng, 100, 50, 30, 1)
+    print(f"\n{len(receipt['logs'])} logs, decoded and reconciled in:")
+    for name, engine in ENGINES.items():
+        timing = milliseconds_per_call(lambda: engine(receipt, orders), args.rounds)
+        print(f"  {name:<8}{timing:.2f}ms")
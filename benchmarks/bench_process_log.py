@@ -0,0 +1,166 @@
+"""
+Benchmarks log decoding throughput of extract.process_log on a synthetic receipt.
+
+Run from the root of the repository:
+
+    python -m benchmarks.bench_process_log --logs 1200
+"""
+import argparse
+import random
+import time
+
+import web3.exceptions
+from eth_abi import encode_abi
+from hexbytes import HexBytes
+from web3.datastructures import AttributeDict
+
+from api.src import extract
+from utils.create_contracts import get_erc20_contract, get_settlement_contract
+from benchmarks.synthetic import (
+    INTERACTION_TOPIC,
+    TRADE_TOPIC,
+    TRANSFER_TOPIC,
+    UNKNOWN_TOPICS,
+    random_address,
+    topic_address,
+)
+
+SETTLEMENT = extract.SETTLEMENT_ADDRESS
+
+
+def make_log(rng, index):
+    """
+    Builds a random log shaped like the ones found in settlement receipts.
+    """
+    roll = rng.random()
+    if roll < 0.05:
+        address = SETTLEMENT
+        topics = [TRADE_TOPIC, topic_address(random_address(rng))]
+        data = encode_abi(
+            ["address", "address", "uint256", "uint256", "uint256", "bytes"],
+            [
+                random_address(rng),
+                random_address(rng),
+                rng.getrandbits(96),
+                rng.getrandbits(96),
+                rng.getrandbits(64),
+                rng.randbytes(56),
+            ],
+        )
+    elif roll < 0.10:
+        address = SETTLEMENT
+        topics = [INTERACTION_TOPIC, topic_address(random_address(rng))]
+        data = encode_abi(["uint256", "bytes4"], [0, rng.randbytes(4)])
+    elif roll < 0.50:
+        address = random_address(rng)
+        topics = [
+            TRANSFER_TOPIC,
+            topic_address(random_address(rng)),
+            topic_address(random_address(rng)),
+        ]
+        data = encode_abi(["uint256"], [rng.getrandbits(96)])
+    else:
+        address = random_address(rng)
+        topics = [rng.choice(UNKNOWN_TOPICS)]
+        data = rng.randbytes(128)
+
+    return AttributeDict(
+        {
+            "address": address,
+            "topics": [HexBytes(topic) for topic in topics],
+            "data": "0x" + data.hex(),
+            "logIndex": index,
+            "transactionIndex": 0,
+            "transactionHash": HexBytes(bytes(32)),
+            "blockHash": HexBytes(bytes(32)),
+            "blockNumber": 0,
+        }
+    )
+
+
+def try_process_settlement_trade(log):
+    return get_settlement_contract().events.Trade().processLog(log)
+
+
+def try_process_settlement_interaction(log):
+    return get_settlement_contract().events.Interaction().processLog(log)
+
+
+def try_process_erc20_transfer(log):
+    return get_erc20_contract().events.Transfer().processLog(log)
+
+
+def process_log_cascade(log):
+    """
+    The original decoder: tries every event in turn and relies on MismatchedABI to move on.
+    """
+    processed_log = None
+    for decode in [
+        try_process_settlement_trade,
+        try_process_settlement_interaction,
+        try_process_erc20_transfer,
+    ]:
+        try:
+            processed_log = decode(log)
+        except web3.exceptions.MismatchedABI:
+            continue
+        break
+    return processed_log
+
+
+def web3_decoders():
+    """
+    The topic registry decoding each event with web3's processLog, as before EventDecoder.
+    """
+    return {
+        topic: (address, topic_count, decode.event.processLog)
+        for topic, (address, topic_count, decode) in extract.get_log_decoders().items()
+    }
+
+
+def logs_per_second(decode, logs, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        # Every round starts with no cached address checksums, as a receipt of all new addresses would
+        extract.checksum_address.cache_clear()
+        for log in logs:
+            decode(log)
+    elapsed = time.perf_counter() - start
+    return len(logs) * rounds / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark settlement log decoding.")
+    parser.add_argument("--logs", type=int, default=1200, help="Logs per receipt.")
+    parser.add_argument(
+        "--rounds", type=int, default=5, help="Passes over the receipt."
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    logs = [make_log(rng, index) for index in range(args.logs)]
+
+    registry = web3_decoders()
+    cascade = logs_per_second(process_log_cascade, logs, args.rounds)
+    processlog = logs_per_second(
+        lambda log: extract.process_log(log, registry), logs, args.rounds
+    )
+    words = logs_per_second(extract.process_log, logs, args.rounds)
+
+    # The cascade also decodes ERC721 transfers and settlement events from other addresses, which the registry skips
+    decoded = [extract.process_log(log) for log in logs]
+    identical = all(
+        processed == extract.process_log(log, registry)
+        for processed, log in zip(decoded, logs)
+    ) and all(
+        processed == process_log_cascade(log)
+        for processed, log in zip(decoded, logs)
+        if processed is not None
+    )
+    print(f"logs per receipt: {args.logs}")
+    print(f"try/except cascade:         {cascade:,.0f} logs/sec")
+    print(f"topic registry, processLog: {processlog:,.0f} logs/sec")
+    print(f"topic registry, words:      {words:,.0f} logs/sec")
+    print(f"speedup:                    {words / cascade:.1f}x")
+    print(f"identical output:           {identical}")
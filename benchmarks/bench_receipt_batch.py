@@ -0,0 +1,84 @@
+"""
+Compares fetching receipts one eth_getTransactionReceipt request at a time, sequentially and from a thread pool, with
+JSON-RPC batches of several sizes, over a stub JSON-RPC node holding synthetic settlements. The node answers each
+request after --latency milliseconds and fails a --fail-rate share of receipt calls, which batches retry.
+
+Checks that batched receipts equal the ones web3 returns, and reports requests made and receipts per second.
+
+Run from the root of the repository:
+
+    python -m benchmarks.bench_receipt_batch --receipts 1000
+"""
+import argparse
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from web3 import Web3
+
+from api.src.web3 import ReceiptClient, get_receipt_from_txhash, get_w3
+from benchmarks.stub_node import StubNode, place_settlements
+from benchmarks.synthetic import make_settlement
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def report(name, node, count, seconds):
+    print(f"{name:<22}{node.requests:>9} requests{count / seconds:>10.1f} receipts/sec")
+    node.requests = 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark JSON-RPC batch receipts against one request per receipt."
+    )
+    parser.add_argument("--receipts", type=int, default=1000)
+    parser.add_argument(
+        "--batch-sizes", type=int, nargs="+", default=[10, 50, 100, 500]
+    )
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument(
+        "--latency", type=float, default=20, help="Milliseconds per request."
+    )
+    parser.add_argument(
+        "--fail-rate", type=float, default=0.01, help="Share of failed receipt calls."
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    settlements = [
+        make_settlement(rng, rng.randint(1, 10), rng.randint(1, 10), 30, 2)
+        for _ in range(args.receipts)
+    ]
+    _, receipts = place_settlements(rng, settlements, args.receipts * 10)
+    node = StubNode([], receipts, latency=args.latency / 1000)
+    server = node.serve()
+    url = f"http://127.0.0.1:{server.server_port}"
+    get_w3().provider = Web3.HTTPProvider(url)
+    tx_hashes = list(receipts)
+    print(f"{len(tx_hashes)} receipts, {args.latency:g}ms per request")
+
+    expected, seconds = timed(
+        lambda: {tx_hash: get_receipt_from_txhash(tx_hash) for tx_hash in tx_hashes}
+    )
+    report("one per request", node, len(tx_hashes), seconds)
+
+    with ThreadPoolExecutor(args.threads) as executor:
+        _, seconds = timed(
+            lambda: list(executor.map(get_receipt_from_txhash, tx_hashes))
+        )
+    report(f"one per request, {args.threads}x", node, len(tx_hashes), seconds)
+
+    node.fail_rate = args.fail_rate
+    for batch_size in args.batch_sizes:
+        client = ReceiptClient(url, batch_size=batch_size)
+        batched, seconds = timed(lambda: client.get_receipts(tx_hashes))
+        report(f"batches of {batch_size}", node, len(tx_hashes), seconds)
+        if batched != expected:
+            missing = len(set(expected) - set(batched))
+            print(f"  {missing} receipts missing or differing from web3's")
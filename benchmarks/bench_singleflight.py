@@ -0,0 +1,104 @@
+"""
+Load test of concurrent requests for the same settlement, with and without coalescing them into one computation.
+
+For each concurrency level, that many threads compute the cowiness of one synthetic settlement at the same moment,
+with every cache emptied first. Upstreams are stubs answering each request after --latency milliseconds: a
+JSON-RPC node for the receipt, and an orderbook and a subgraph for the orders and token prices. Reports the upstream
+requests made and the wall time of each level.
+
+Run from the root of the repository:
+
+    python -m benchmarks.bench_singleflight --concurrency 1 8 64
+"""
+import argparse
+import random
+import threading
+import time
+
+from web3 import Web3
+
+from utils import instance_collect, order_prices
+from utils.aio import run_with_session
+from api.src import compute_cow
+from api.src.web3 import get_w3, receipt_cache
+from benchmarks.stub_node import StubNode, StubServices, place_settlements
+from benchmarks.synthetic import make_settlement
+
+
+def compute_uncoalesced(tx_hash):
+    return run_with_session(compute_cow.compute_cowiness_detailed_async, tx_hash, None)
+
+
+def run_level(compute, tx_hash, concurrency):
+    """
+    Computes the settlement from concurrency threads released together, on empty caches. Returns the results and
+    the wall time.
+    """
+    compute_cow.get_result_store().cache.clear()
+    instance_collect.orderbook_client.cache.clear()
+    order_prices.token_price_cache.clear()
+    receipt_cache.clear()
+
+    barrier = threading.Barrier(concurrency + 1)
+    results = [None] * concurrency
+
+    def run(index):
+        barrier.wait()
+        results[index] = compute(tx_hash)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Load test concurrent requests for one settlement."
+    )
+    parser.add_argument(
+        "--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64]
+    )
+    parser.add_argument("--trades", type=int, default=20)
+    parser.add_argument(
+        "--latency", type=float, default=50, help="Milliseconds per request."
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    settlement = make_settlement(rng, args.trades, args.trades, 30, 2)
+    _, receipts = place_settlements(rng, [settlement], 1000)
+    tx_hash = next(iter(receipts))
+
+    node = StubNode([], receipts, latency=args.latency / 1000)
+    node_server = node.serve()
+    get_w3().provider = Web3.HTTPProvider(f"http://127.0.0.1:{node_server.server_port}")
+    services = StubServices({tx_hash: settlement[1]}, latency=args.latency / 1000)
+    services_server = services.serve()
+    url = f"http://127.0.0.1:{services_server.server_port}"
+    instance_collect.orderbook_client.orderbook_url = url
+    order_prices.COWSWAP_SUBGRAPH_URL = url
+
+    print(f"{args.trades} trades, {args.latency:g}ms per upstream request")
+    print(f"{'concurrency':>11}{'':>4}{'requests':>18}{'seconds':>18}")
+    print(f"{'':>15}{'alone':>9}{'coalesced':>11}{'alone':>8}{'coalesced':>11}")
+    for concurrency in args.concurrency:
+        row = []
+        for compute in [compute_uncoalesced, compute_cow.compute_cowiness_detailed]:
+            node.calls.clear()
+            services.requests = 0
+            results, seconds = run_level(compute, tx_hash, concurrency)
+            if any(result != results[0] for result in results):
+                print("  results differ between concurrent requests")
+            row.append((sum(node.calls.values()) + services.requests, seconds))
+        (alone, alone_seconds), (coalesced, coalesced_seconds) = row
+        print(
+            f"{concurrency:>11}{'':>4}{alone:>9}{coalesced:>11}"
+            f"{alone_seconds:>8.2f}{coalesced_seconds:>11.2f}"
+        )
+    print(f"single-flight: {compute_cow.computations.stats()}")
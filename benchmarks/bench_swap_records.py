@@ -0,0 +1,83 @@
+"""
+Compares the memory held by the swaps of many settlements as per-swap dicts and as swap records.
+
+Run from the root of the repository:
+
+    python -m benchmarks.bench_swap_records --settlements 100000
+"""
+import argparse
+import random
+import tracemalloc
+
+from api.src.records import Swap
+from benchmarks.synthetic import make_swaps
+
+
+def as_dicts(swaps_per_settlement):
+    """
+    The swaps in the previous dict shape, with a fresh address string per swap as decoded from the logs.
+    """
+    settlements = []
+    for swaps in swaps_per_settlement:
+        dicts = {}
+        for id, swap in enumerate(swaps):
+            swap = swap.to_dict()
+            swap["sell_token"] = "".join(swap["sell_token"])
+            swap["buy_token"] = "".join(swap["buy_token"])
+            dicts[id] = swap
+        settlements.append(dicts)
+    return settlements
+
+
+def measure(build):
+    """
+    Returns what build() returns with the bytes and blocks it keeps allocated. Every block is an object the
+    allocator and the garbage collector have to handle.
+    """
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    built = build()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, "filename")
+    return (
+        built,
+        sum(stat.size_diff for stat in stats),
+        sum(stat.count_diff for stat in stats),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the memory of swap records against swap dicts."
+    )
+    parser.add_argument(
+        "--settlements", type=int, default=100000, help="Settlements held in memory."
+    )
+    parser.add_argument("--tokens", type=int, default=500, help="Distinct tokens.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    settlements = [
+        make_swaps(rng, rng.randint(2, 12), args.tokens)
+        for _ in range(args.settlements)
+    ]
+    swaps = sum(map(len, settlements))
+
+    # Both copies share the amounts of the generated swaps, as both would share the decoded log arguments
+    dicts, dicts_bytes, dicts_blocks = measure(lambda: as_dicts(settlements))
+    del dicts
+    records, records_bytes, records_blocks = measure(
+        lambda: [[Swap(*swap) for swap in swaps] for swaps in settlements]
+    )
+
+    print(f"settlements:      {args.settlements}")
+    print(f"swaps:            {swaps}")
+    print(
+        f"dicts:            {dicts_bytes / swaps:.0f} bytes/swap, {dicts_blocks / swaps:.1f} blocks/swap"
+    )
+    print(
+        f"records:          {records_bytes / swaps:.0f} bytes/swap, {records_blocks / swaps:.1f} blocks/swap"
+    )
+    print(f"memory saved:     {1 - records_bytes / dicts_bytes:.0%}")
@@ -0,0 +1,40 @@
+import pytest
+from web3 import Web3
+
+from api.src.web3 import get_w3
+from utils import instance_collect, order_prices
+from benchmarks.stub_node import StubNode, StubServices, place_settlements
+
+
+@pytest.fixture
+def serve_upstreams(monkeypatch):
+    """
+    Returns a function that places synthetic settlements over a number of blocks, serves them from a stub node and
+    stub orderbook and subgraph, and points the computation at those for the rest of the test. The function returns
+    the node and the services, to check the calls they were made.
+    """
+    servers = []
+
+    def serve(rng, settlements, blocks):
+        chain_logs, receipts = place_settlements(rng, settlements, blocks)
+        node = StubNode(chain_logs, receipts)
+        services = StubServices(
+            {tx_hash: orders for tx_hash, (_, orders) in zip(receipts, settlements)},
+            price_trades=True,
+        )
+        node_server = node.serve()
+        services_server = services.serve()
+        servers.extend([node_server, services_server])
+        url = f"http://127.0.0.1:{services_server.server_port}"
+        monkeypatch.setattr(
+            get_w3(),
+            "provider",
+            Web3.HTTPProvider(f"http://127.0.0.1:{node_server.server_port}"),
+        )
+        monkeypatch.setattr(instance_collect.orderbook_client, "orderbook_url", url)
+        monkeypatch.setattr(order_prices, "COWSWAP_SUBGRAPH_URL", url)
+        return node, services
+
+    yield serve
+    for server in servers:
+        server.shutdown()
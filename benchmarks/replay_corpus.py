@@ -0,0 +1,56 @@
+"""
+Records the upstream responses of settlements into a corpus, or replays the CoW computation over it with zero network.
+
+Run from the root of the repository:
+
+    python -m benchmarks.replay_corpus record hashes.txt --corpus corpus
+    python -m benchmarks.replay_corpus replay hashes.txt --corpus corpus
+
+hashes.txt holds one settlement tx hash per line.
+"""
+import argparse
+import json
+import time
+
+from utils import replay
+from api.src.compute_cow import compute_cowiness_detailed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Record or replay the upstream responses of settlements."
+    )
+    parser.add_argument("mode", choices=[replay.RECORD, replay.REPLAY])
+    parser.add_argument("hashes", help="File with one settlement tx hash per line.")
+    parser.add_argument("--corpus", default="corpus", help="Corpus directory.")
+    parser.add_argument("--output", help="Write per-settlement results as JSON here.")
+    args = parser.parse_args()
+
+    replay.configure(args.mode, args.corpus)
+    with open(args.hashes) as f:
+        tx_hashes = [line.strip() for line in f if line.strip()]
+
+    results = {}
+    timings = []
+    failures = 0
+    for tx_hash in tx_hashes:
+        start = time.perf_counter()
+        try:
+            results[tx_hash] = compute_cowiness_detailed(tx_hash)
+        except Exception as e:
+            results[tx_hash] = {"error": str(e)}
+            failures += 1
+        timings.append(time.perf_counter() - start)
+
+    timings.sort()
+    total = sum(timings)
+    print(f"{args.mode}: {len(tx_hashes)} settlements, {failures} failed")
+    if len(timings) > 0:
+        print(
+            f"total {total:.2f}s, {len(timings) / total:.1f} settlements/sec, "
+            f"p50 {timings[len(timings) // 2] * 1000:.2f}ms, "
+            f"p99 {timings[int(len(timings) * 0.99)] * 1000:.2f}ms"
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
@@ -0,0 +1,162 @@
+"""
+Times the settlement decode and volume computation hot paths on synthetic settlements, and emits the results as JSON.
+
+Run from the root of the repository:
+
+    python -m benchmarks.run --output bench.json
+
+Each stage is timed in isolation over several rounds, then run once more under tracemalloc to record its peak
+memory and the number of allocated blocks still alive when it returns.
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from api.src import compute_cow, cowiness, extract, graph_engine
+from api.src.records import Transfer
+from benchmarks.synthetic import make_settlement, make_usd_prices
+
+# (trades, interactions, tokens, hops) of each scenario
+SCENARIOS = {
+    "small": (10, 10, 10, 2),
+    "medium": (50, 100, 30, 3),
+    "large": (200, 1000, 100, 4),
+}
+
+
+def measure(stage, rounds):
+    """
+    Returns timing and allocation statistics of calling stage.
+    """
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        stage()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    stage()
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename"))
+
+    return {
+        "mean_ms": sum(timings) / len(timings) * 1000,
+        "min_ms": min(timings) * 1000,
+        "max_ms": max(timings) * 1000,
+        "peak_kib": peak / 1024,
+        "retained_blocks": blocks,
+    }
+
+
+def run_scenario(rng, trades, interactions, tokens, hops, rounds):
+    """
+    Builds a synthetic settlement of the given size and returns the statistics of every stage on it.
+    """
+    receipt, orders = make_settlement(rng, trades, interactions, tokens, hops)
+    processed_logs = extract.decode_receipt_logs(receipt)
+    swaps = extract.build_swaps(processed_logs, orders)
+    volume_in, volume_out = compute_cow.compute_volume(swaps)
+    usd_prices = make_usd_prices([volume_in, volume_out])
+    accumulators = [
+        {
+            "ins": [Transfer(swap.buy_token, swap.buy_amount)],
+            "outs": [Transfer(swap.sell_token, swap.sell_amount)],
+        }
+        for swap in swaps
+        if swap.kind == "interaction"
+    ]
+
+    def process_logs():
+        for log in receipt["logs"]:
+            extract.process_log(log)
+
+    def collapse_interactions():
+        for accumulator in accumulators:
+            extract.collapse_interaction_transfers(
+                accumulator, "0x", 0, b"\x02\x2c\x0d\x9f"
+            )
+
+    stages = {
+        "process_log": process_logs,
+        "build_swaps": lambda: extract.build_swaps(processed_logs, orders),
+        "collapse_interaction_transfers": collapse_interactions,
+        "compute_volume[compute_cow]": lambda: compute_cow.compute_volume(swaps),
+        "compute_volume[cowiness]": lambda: cowiness.compute_volume(swaps),
+        "decode_flow_logs": lambda: graph_engine.decode_flow_logs(receipt),
+        "compute_volume[graph]": lambda: graph_engine.build_flow_graph(
+            processed_logs, orders
+        ).compute_volume(),
+        "calculate_usd_volume": lambda: (
+            compute_cow.calculate_usd_volume(0, volume_in, usd_prices),
+            compute_cow.calculate_usd_volume(0, volume_out, usd_prices),
+        ),
+    }
+
+    results = {name: measure(stage, rounds) for name, stage in stages.items()}
+
+    return {
+        "params": {
+            "trades": trades,
+            "interactions": interactions,
+            "tokens": tokens,
+            "hops": hops,
+            "logs": len(receipt["logs"]),
+            "swaps": len(swaps),
+        },
+        "stages": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the settlement decode and volume computation hot paths."
+    )
+    parser.add_argument(
+        "--scenarios",
+        nargs="+",
+        default=list(SCENARIOS),
+        choices=list(SCENARIOS),
+        help="Predefined settlement sizes to run.",
+    )
+    parser.add_argument(
+        "--custom",
+        type=int,
+        nargs=4,
+        metavar=("TRADES", "INTERACTIONS", "TOKENS", "HOPS"),
+        help="Also run a settlement of this size.",
+    )
+    parser.add_argument("--rounds", type=int, default=5, help="Timed calls per stage.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    parser.add_argument("--output", help="Write the JSON results to this file.")
+    args = parser.parse_args()
+
+    scenarios = {name: SCENARIOS[name] for name in args.scenarios}
+    if args.custom:
+        scenarios["custom"] = tuple(args.custom)
+
+    rng = random.Random(args.seed)
+    results = {
+        name: run_scenario(rng, *size, args.rounds) for name, size in scenarios.items()
+    }
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "rounds": args.rounds,
+        "scenarios": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,344 @@
+"""
+Stub upstreams serving synthetic settlements over HTTP, for the benchmarks and checks that fetch from them: an
+Ethereum JSON-RPC node, and the orderbook and subgraph.
+"""
+import bisect
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from eth_utils import keccak
+from hexbytes import HexBytes
+from web3.datastructures import AttributeDict
+
+from benchmarks.synthetic import SETTLEMENT, random_address, topic_address
+
+SETTLEMENT_EVENT_TOPIC = keccak(text="Settlement(address)")
+# Timestamp of the stub node's block 0, each block coming BLOCK_TIME seconds after the previous one
+GENESIS_TIMESTAMP = 1_600_000_000
+BLOCK_TIME = 12
+
+
+def block_timestamp(number):
+    return GENESIS_TIMESTAMP + BLOCK_TIME * number
+
+
+def place_settlements(rng, settlements, blocks):
+    """
+    Spreads the receipts of synthetic settlements over a range of blocks, giving each a tx hash and closing it
+    with a Settlement event. Returns all logs in chain order and the receipts keyed by tx hash.
+    """
+    placed = sorted(rng.randrange(blocks) for _ in settlements)
+    chain_logs = []
+    receipts = {}
+    for index, ((receipt, _), block) in enumerate(zip(settlements, placed)):
+        tx_hash = HexBytes(rng.randbytes(32))
+        logs = list(receipt["logs"]) + [
+            AttributeDict(
+                {
+                    "address": SETTLEMENT,
+                    "topics": [
+                        HexBytes(SETTLEMENT_EVENT_TOPIC),
+                        topic_address(random_address(rng)),
+                    ],
+                    "data": "0x",
+                }
+            )
+        ]
+        tx_logs = []
+        for log in logs:
+            tx_logs.append(
+                {
+                    "address": log["address"],
+                    "topics": [topic.hex() for topic in log["topics"]],
+                    "data": log["data"],
+                    "logIndex": hex(len(chain_logs) + len(tx_logs)),
+                    "transactionIndex": hex(index),
+                    "transactionHash": tx_hash.hex(),
+                    "blockHash": "0x" + bytes(32).hex(),
+                    "blockNumber": hex(block),
+                    "removed": False,
+                }
+            )
+        chain_logs += tx_logs
+        receipts[tx_hash.hex()] = {
+            "transactionHash": tx_hash.hex(),
+            "transactionIndex": hex(index),
+            "blockNumber": hex(block),
+            "status": "0x1",
+            "logs": tx_logs,
+        }
+    return chain_logs, receipts
+
+
+def matches(log, filter_params):
+    """
+    Returns whether a log matches an eth_getLogs filter, whose address and topics may each be a list of
+    alternatives.
+    """
+    if "address" in filter_params:
+        addresses = filter_params["address"]
+        addresses = addresses if isinstance(addresses, list) else [addresses]
+        if log["address"].lower() not in [address.lower() for address in addresses]:
+            return False
+    for position, expected in enumerate(filter_params.get("topics", [])):
+        if expected is None:
+            continue
+        if position >= len(log["topics"]):
+            return False
+        expected = expected if isinstance(expected, list) else [expected]
+        if log["topics"][position].lower() not in [topic.lower() for topic in expected]:
+            return False
+    return True
+
+
+class StubNode:
+    """
+    Serves eth_getLogs and eth_getTransactionReceipt over given logs and receipts, alone or in JSON-RPC batches,
+    counting calls and HTTP requests. eth_getBlockByNumber answers the number and timestamp of blocks up to the last
+    one holding a log, mined every BLOCK_TIME seconds.
+
+    eth_getLogs calls matching more than max_logs logs are rejected, each HTTP request is answered after latency
+    seconds, and a fail_rate share of receipt calls fail as a node behind a load balancer sometimes does.
+    """
+
+    def __init__(
+        self, chain_logs, receipts, max_logs=10000, latency=0, fail_rate=0, seed=0
+    ):
+        self.chain_logs = chain_logs
+        self.log_blocks = [int(log["blockNumber"], 16) for log in chain_logs]
+        self.receipts = receipts
+        self.max_logs = max_logs
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.rng = random.Random(seed)
+        self.calls = {}
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def handle(self, request):
+        method, params = request["method"], request["params"]
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            failed = self.rng.random() < self.fail_rate
+        if method == "eth_getTransactionReceipt":
+            if failed:
+                return {"error": {"code": -32000, "message": "header not found"}}
+            return {"result": self.receipts.get(params[0])}
+        if method == "eth_getBlockByNumber":
+            latest = self.log_blocks[-1] if self.log_blocks else 0
+            number = latest if params[0] == "latest" else int(params[0], 16)
+            if number > latest:
+                return {"result": None}
+            return {
+                "result": {
+                    "number": hex(number),
+                    "timestamp": hex(block_timestamp(number)),
+                    "hash": "0x" + number.to_bytes(32, "big").hex(),
+                }
+            }
+        if method != "eth_getLogs":
+            return {"error": {"code": -32601, "message": f"{method} not supported"}}
+
+        filter_params = params[0]
+        start, end = int(filter_params["fromBlock"], 16), int(
+            filter_params["toBlock"], 16
+        )
+        logs = [
+            log
+            for log in self.chain_logs[
+                bisect.bisect_left(self.log_blocks, start) : bisect.bisect_right(
+                    self.log_blocks, end
+                )
+            ]
+            if matches(log, filter_params)
+        ]
+        if len(logs) > self.max_logs:
+            return {
+                "error": {
+                    "code": -32005,
+                    "message": f"query returned more than {self.max_logs} results",
+                }
+            }
+        return {"result": logs}
+
+    def respond(self, request):
+        return {"jsonrpc": "2.0", "id": request["id"], **self.handle(request)}
+
+    def serve(self):
+        """
+        Starts serving on a free local port in a background thread, and returns the server.
+        """
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                request = json.loads(
+                    self.rfile.read(int(self.headers["Content-Length"]))
+                )
+                with node.lock:
+                    node.requests += 1
+                time.sleep(node.latency)
+                if isinstance(request, list):
+                    response = [node.respond(entry) for entry in request]
+                else:
+                    response = node.respond(request)
+                body = json.dumps(response).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+class StubServices:
+    """
+    Serves the orders of settlements as the orderbook does, and settlement trades and token prices as the subgraph
+    does, counting requests by kind, and the connections they came on.
+
+    orders maps each tx hash to the orders of its trades keyed by UID. With price_trades, the subgraph returns a
+    trade priced at price_usd per token for every order, otherwise settlements have no priced trades and every
+    token price is queried. Orders whose UID is in order_statuses are answered with that HTTP status instead, and
+    the subgraph has no price for the tokens in unpriced_tokens.
+    """
+
+    def __init__(
+        self,
+        orders,
+        latency=0,
+        price_trades=False,
+        price_usd=1.5,
+        order_statuses=None,
+        unpriced_tokens=(),
+    ):
+        self.orders = orders
+        self.by_uid = {
+            uid: order
+            for tx_orders in orders.values()
+            for uid, order in tx_orders.items()
+        }
+        self.latency = latency
+        self.price_trades = price_trades
+        self.price_usd = price_usd
+        self.order_statuses = order_statuses or {}
+        self.unpriced_tokens = {token.lower() for token in unpriced_tokens}
+        self.calls = {}
+        self.requests = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    def count(self, kind):
+        with self.lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+
+    def token(self, address):
+        address = address.lower()
+        return {"address": address, "decimals": "18", "id": address, "name": address}
+
+    def trade(self, order):
+        return {
+            "sellAmount": order["sellAmount"],
+            "sellAmountUsd": str(int(order["sellAmount"]) / 10**18 * self.price_usd),
+            "buyAmount": order["buyAmount"],
+            "buyAmountUsd": str(int(order["buyAmount"]) / 10**18 * self.price_usd),
+            "sellToken": self.token(order["sellToken"]),
+            "buyToken": self.token(order["buyToken"]),
+        }
+
+    def order_trades(self, order):
+        return [self.trade(order)] if self.price_trades and order is not None else []
+
+    def get(self, path):
+        """
+        Returns the status and body answering an orderbook request.
+        """
+        parts = path.split("/")
+        if parts[-1] == "orders":
+            self.count("settlement_orders")
+            return 200, list(self.orders.get(parts[-2], {}).values())
+        self.count("order")
+        uid = parts[-1]
+        if uid in self.order_statuses:
+            return self.order_statuses[uid], {"errorType": "Stubbed"}
+        if uid not in self.by_uid:
+            return 404, {"errorType": "NotFound"}
+        return 200, self.by_uid[uid]
+
+    def post(self, request):
+        """
+        Returns the body answering a subgraph query.
+        """
+        query, variables = request["query"], request["variables"]
+        if "settlement(id" in query:
+            self.count("settlement_trades")
+            trades = [
+                {"order": {"id": uid, "trades": self.order_trades(order)}}
+                for uid, order in self.orders.get(variables["id"], {}).items()
+            ]
+            return {"data": {"settlement": {"trades": trades}}}
+        if "order(id" in query:
+            self.count("order_trades")
+            order = self.by_uid.get(variables["id"])
+            return {"data": {"order": {"trades": self.order_trades(order)}}}
+        self.count("token_prices")
+        return {
+            "data": {
+                alias: {"priceUsd": str(self.price_usd), **self.token(token)}
+                if token.lower() not in self.unpriced_tokens
+                else None
+                for alias, token in variables.items()
+                if alias != "blockNumber"
+            }
+        }
+
+    def serve(self):
+        """
+        Starts serving on a free local port in a background thread, and returns the server.
+        """
+        services = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                with services.lock:
+                    services.connections += 1
+
+            def respond(self, status, response):
+                with services.lock:
+                    services.requests += 1
+                time.sleep(services.latency)
+                body = json.dumps(response).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self.respond(*services.get(self.path))
+
+            def do_POST(self):
+                request = json.loads(
+                    self.rfile.read(int(self.headers["Content-Length"]))
+                )
+                self.respond(200, services.post(request))
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
@@ -0,0 +1,258 @@
+"""
+Generators of synthetic settlements of controlled size for the benchmarks.
+"""
+from eth_abi import encode_abi
+from eth_utils import keccak
+from hexbytes import HexBytes
+from web3 import Web3
+from web3.constants import ADDRESS_ZERO
+from web3.datastructures import AttributeDict
+
+from api.src.records import Swap, token_table
+
+SETTLEMENT = "0x9008D19f58AAbD9eD0D60971565AA8510560ab41"
+TRADE_TOPIC = keccak(
+    text="Trade(address,address,address,uint256,uint256,uint256,bytes)"
+)
+INTERACTION_TOPIC = keccak(text="Interaction(address,uint256,bytes4)")
+TRANSFER_TOPIC = keccak(text="Transfer(address,address,uint256)")
+# Uniswap V2 Sync and Swap events, the bulk of the unrelated logs in a settlement
+UNKNOWN_TOPICS = [
+    keccak(text="Sync(uint112,uint112)"),
+    keccak(text="Swap(address,uint256,uint256,uint256,uint256,address)"),
+]
+
+
+def random_address(rng):
+    return Web3.toChecksumAddress("0x" + rng.randbytes(20).hex())
+
+
+def topic_address(address):
+    return HexBytes(bytes(12) + bytes.fromhex(address[2:]))
+
+
+class ReceiptBuilder:
+    """
+    Appends logs to a synthetic receipt in the shape web3 returns them.
+    """
+
+    def __init__(self, block_number=17000000):
+        self.block_number = block_number
+        self.logs = []
+
+    def add_log(self, address, topics, data):
+        self.logs.append(
+            AttributeDict(
+                {
+                    "address": address,
+                    "topics": [HexBytes(topic) for topic in topics],
+                    "data": "0x" + data.hex(),
+                    "logIndex": len(self.logs),
+                    "transactionIndex": 0,
+                    "transactionHash": HexBytes(bytes(32)),
+                    "blockHash": HexBytes(bytes(32)),
+                    "blockNumber": self.block_number,
+                }
+            )
+        )
+
+    def trade(self, owner, sell_token, buy_token, sell_amount, buy_amount, uid):
+        self.add_log(
+            SETTLEMENT,
+            [TRADE_TOPIC, topic_address(owner)],
+            encode_abi(
+                ["address", "address", "uint256", "uint256", "uint256", "bytes"],
+                [sell_token, buy_token, sell_amount, buy_amount, 0, uid],
+            ),
+        )
+
+    def interaction(self, target, selector=b"\x02\x2c\x0d\x9f"):
+        self.add_log(
+            SETTLEMENT,
+            [INTERACTION_TOPIC, topic_address(target)],
+            encode_abi(["uint256", "bytes4"], [0, selector]),
+        )
+
+    def transfer(self, token, from_, to, value):
+        self.add_log(
+            token,
+            [TRANSFER_TOPIC, topic_address(from_), topic_address(to)],
+            encode_abi(["uint256"], [value]),
+        )
+
+    def unknown(self, rng):
+        self.add_log(
+            random_address(rng), [rng.choice(UNKNOWN_TOPICS)], rng.randbytes(64)
+        )
+
+    def receipt(self):
+        return AttributeDict({"blockNumber": self.block_number, "logs": self.logs})
+
+
+def add_trades(rng, builder, trades, token_addresses):
+    """
+    Adds the Trade logs and the transfers in of random trades to the builder. Returns the orders keyed by UID and
+    the transfers out, which the settlement makes last.
+    """
+    orders = {}
+    trade_transfers_in = []
+    trade_transfers_out = []
+    for index in range(trades):
+        owner = random_address(rng)
+        sell_token, buy_token = rng.sample(token_addresses, 2)
+        sell_amount = rng.randint(10**15, 10**21)
+        buy_amount = rng.randint(10**15, 10**21)
+        uid = index.to_bytes(56, "big")
+        builder.trade(owner, sell_token, buy_token, sell_amount, buy_amount, uid)
+        orders["0x" + uid.hex()] = {
+            "uid": "0x" + uid.hex(),
+            "sellToken": sell_token,
+            "buyToken": buy_token,
+            "sellAmount": str(sell_amount),
+            "buyAmount": str(buy_amount),
+            "isLiquidityOrder": False,
+            "receiver": ADDRESS_ZERO,
+        }
+        trade_transfers_in.append((sell_token, owner, SETTLEMENT, sell_amount))
+        trade_transfers_out.append((buy_token, SETTLEMENT, owner, buy_amount))
+
+    for transfer in trade_transfers_in:
+        builder.transfer(*transfer)
+    return orders, trade_transfers_out
+
+
+def make_settlement(rng, trades=10, interactions=10, tokens=20, hops=2, noise=1):
+    """
+    Builds the receipt of a settlement and the orders of its trades.
+
+    Trades sell and buy random tokens out of a pool of tokens. Interactions swap through chains of up to hops
+    pools, each pool transfer emitting `noise` unrelated logs. Returns the receipt and the orders keyed by UID.
+    """
+    token_addresses = [random_address(rng) for _ in range(tokens)]
+    builder = ReceiptBuilder()
+    orders, trade_transfers_out = add_trades(rng, builder, trades, token_addresses)
+
+    remaining = interactions
+    while remaining > 0:
+        depth = min(rng.randint(1, hops), remaining)
+        path = rng.sample(token_addresses, depth + 1)
+        amount = rng.randint(10**15, 10**21)
+        for sell_token, buy_token in zip(path, path[1:]):
+            pool = random_address(rng)
+            buy_amount = amount * rng.randint(90, 110) // 100
+            builder.transfer(sell_token, SETTLEMENT, pool, amount)
+            builder.transfer(buy_token, pool, SETTLEMENT, buy_amount)
+            for _ in range(noise):
+                builder.unknown(rng)
+            builder.interaction(pool)
+            amount = buy_amount
+        remaining -= depth
+
+    for transfer in trade_transfers_out:
+        builder.transfer(*transfer)
+
+    return builder.receipt(), orders
+
+
+def make_routed_settlement(
+    rng, trades=10, routes=5, tokens=20, hops=4, intermediary=False, noise=1
+):
+    """
+    Builds the receipt of a settlement whose external liquidity takes the shapes compute_volume fails on, as
+    listed in limitations.md.
+
+    Each route swaps through up to hops pools that pay each other directly. With intermediary, every route goes
+    through one address called once, which also refunds part of what it is sent. Routes sell tokens of the first half
+    of the token pool and buy tokens of the second half, so what the settlement sends to external liquidity is
+    known. Returns the receipt, the orders keyed by UID and that volume out keyed by lowercase token.
+    """
+    token_addresses = [random_address(rng) for _ in range(tokens)]
+    sell_tokens = token_addresses[: tokens // 2]
+    buy_tokens = token_addresses[tokens // 2 :]
+    builder = ReceiptBuilder()
+    orders, trade_transfers_out = add_trades(rng, builder, trades, token_addresses)
+
+    volume_out = {}
+    router = random_address(rng)
+    for _ in range(routes):
+        depth = rng.randint(1, hops)
+        path = [rng.choice(sell_tokens)]
+        path += rng.sample(token_addresses, depth - 1) + [rng.choice(buy_tokens)]
+        pools = [random_address(rng) for _ in range(depth)]
+        amount = rng.randint(10**15, 10**21)
+        refund = amount * rng.randint(0, 30) // 100 if intermediary else 0
+        key = path[0].lower()
+        volume_out[key] = volume_out.get(key, 0) + amount - refund
+
+        if intermediary:
+            builder.transfer(path[0], SETTLEMENT, router, amount)
+            builder.transfer(path[0], router, pools[0], amount - refund)
+        else:
+            builder.transfer(path[0], SETTLEMENT, pools[0], amount)
+        for index, token in enumerate(path[1:]):
+            amount = amount * rng.randint(90, 110) // 100
+            last = index == depth - 1
+            receiver = pools[index + 1] if not last else router
+            if last and not intermediary:
+                receiver = SETTLEMENT
+            builder.transfer(token, pools[index], receiver, amount)
+            for _ in range(noise):
+                builder.unknown(rng)
+        if intermediary:
+            builder.transfer(path[-1], router, SETTLEMENT, amount)
+            if refund > 0:
+                builder.transfer(path[0], router, SETTLEMENT, refund)
+        else:
+            builder.interaction(pools[0])
+    if intermediary:
+        builder.interaction(router)
+
+    for transfer in trade_transfers_out:
+        builder.transfer(*transfer)
+
+    return builder.receipt(), orders, volume_out
+
+
+def make_swaps(rng, size, tokens=50, hops=4):
+    """
+    Builds a list of at least size swap records of a settlement, where interactions form multi-hop chains of up to
+    hops.
+    """
+    token_ids = [token_table.intern(f"0x{index:040x}") for index in range(tokens)]
+    swaps = []
+    while len(swaps) < size:
+        path = rng.sample(token_ids, rng.randint(2, hops + 1))
+        amount = rng.randint(10**18, 10**24)
+        swaps.append(
+            Swap(
+                kind="trade",
+                sell_token=path[0],
+                sell_amount=amount,
+                buy_token=path[-1],
+                buy_amount=amount,
+            )
+        )
+        for sell_token, buy_token in zip(path, path[1:]):
+            buy_amount = amount * rng.randint(90, 110) // 100
+            swaps.append(
+                Swap(
+                    kind="interaction",
+                    sell_token=sell_token,
+                    sell_amount=amount,
+                    buy_token=buy_token,
+                    buy_amount=buy_amount,
+                )
+            )
+            amount = buy_amount
+    return swaps
+
+
+def make_usd_prices(volume_dicts):
+    """
+    Returns settlement prices covering every token of the given volume dictionaries.
+    """
+    return {
+        token: {"name": token, "decimals": "18", "priceUsd": 1.0, "amount": 0}
+        for volume_dict in volume_dicts
+        for token in volume_dict
+    }
@@ -0,0 +1,50 @@
+"""
+Checks that admission control counts a request for the slots of its weight, with threads and on an event loop.
+
+Run from the root of the repository:
+
+    python -m pytest benchmarks/test_admission.py
+"""
+import asyncio
+import threading
+import time
+
+import pytest
+
+from utils.admission import AdmissionController, AsyncAdmissionController, Rejected
+
+
+def test_weight_takes_slots_until_released():
+    admission = AdmissionController(limit=4, queue_size=1, queue_timeout=0.2)
+    assert admission.acquire(8) == 4
+    with pytest.raises(Rejected) as error:
+        admission.acquire()
+    assert error.value.status == 503
+
+    threading.Timer(0.05, admission.release, [4]).start()
+    assert admission.acquire(3) == 3
+    assert admission.stats() == {"active": 3, "queued": 0}
+
+
+def test_async_weight_takes_slots_until_released():
+    async def main():
+        admission = AsyncAdmissionController(limit=4, queue_size=1, queue_timeout=0.2)
+        weight = await admission.acquire(3)
+        with pytest.raises(Rejected) as error:
+            await admission.acquire(2)
+        assert error.value.status == 503
+
+        # One request waits for the slots of the first, and the next finds the queue full
+        waiting = asyncio.ensure_future(admission.acquire(2))
+        await asyncio.sleep(0.01)
+        with pytest.raises(Rejected) as error:
+            await admission.acquire()
+        assert error.value.status == 429
+
+        start = time.perf_counter()
+        await admission.release(weight)
+        assert await waiting == 2
+        assert time.perf_counter() - start < 0.1
+        assert admission.stats() == {"active": 2, "queued": 0}
+
+    asyncio.run(main())
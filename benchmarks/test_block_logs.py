@@ -0,0 +1,57 @@
+"""
+Checks against stub upstreams that settlements are found by timestamp, and that a batch given the time range it was
+mined in fetches its receipts by block range, with the results of fetching them one receipt at a time.
+
+Run from the root of the repository:
+
+    python -m pytest benchmarks/test_block_logs.py
+"""
+import random
+
+import pytest
+
+from api.src import block_logs, compute_cow
+from api.src.web3 import get_block, receipt_cache
+from benchmarks.stub_node import block_timestamp
+from benchmarks.synthetic import make_settlement
+
+
+@pytest.fixture
+def node(serve_upstreams):
+    rng = random.Random(2)
+    settlements = [make_settlement(rng, 3, 4, 6, 2) for _ in range(12)]
+    node, _ = serve_upstreams(rng, settlements, 500)
+    return node
+
+
+def test_block_at_timestamp(node):
+    latest = get_block("latest")
+    for number in [0, 1, 137, latest["number"]]:
+        assert block_logs.block_at_timestamp(block_timestamp(number), latest) == number
+        assert (
+            block_logs.block_at_timestamp(block_timestamp(number) - 5, latest) == number
+        )
+    assert (
+        block_logs.block_at_timestamp(block_timestamp(latest["number"]) + 1, latest)
+        == latest["number"] + 1
+    )
+
+
+def test_batch_in_time_range_fetches_no_receipts(node):
+    tx_hashes = list(node.receipts)
+    blocks = [int(receipt["blockNumber"], 16) for receipt in node.receipts.values()]
+    compute_cow.get_result_store().cache.clear()
+    receipt_cache.clear()
+    by_receipt = compute_cow.compute_cowiness_batch(tx_hashes, engine="swaps")
+    assert node.calls.pop("eth_getTransactionReceipt") > 0
+
+    compute_cow.get_result_store().cache.clear()
+    receipt_cache.clear()
+    by_range = compute_cow.compute_cowiness_batch(
+        tx_hashes,
+        engine="swaps",
+        time_range=(block_timestamp(blocks[0]), block_timestamp(blocks[-1])),
+    )
+    assert "eth_getTransactionReceipt" not in node.calls
+    assert node.calls["eth_getLogs"] == len(block_logs.SETTLEMENT_LOG_FILTERS)
+    assert by_range == by_receipt
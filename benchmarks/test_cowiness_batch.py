@@ -0,0 +1,94 @@
+"""
+Checks against stub upstreams that computing a batch of settlements with the columnar engine gives the results of
+computing them one at a time.
+
+Run from the root of the repository:
+
+    python -m pytest benchmarks/test_cowiness_batch.py
+"""
+import math
+import random
+
+import pytest
+
+from api.src import compute_cow
+from utils import order_prices
+from benchmarks.synthetic import make_settlement
+
+UNKNOWN_TX_HASH = "0x" + "ee" * 32
+
+
+@pytest.fixture
+def upstreams(serve_upstreams):
+    rng = random.Random(1)
+    settlements = [
+        make_settlement(rng, trades, interactions, 6, 3)
+        for trades, interactions in [(1, 0), (3, 2), (5, 8), (10, 4), (20, 12)]
+    ]
+    node, services = serve_upstreams(rng, settlements, 1000)
+    return list(node.receipts), services
+
+
+def assert_same_result(expected, actual):
+    assert expected.keys() == actual.keys()
+    for key, value in expected.items():
+        if isinstance(value, float):
+            assert math.isclose(value, actual[key], rel_tol=1e-9, abs_tol=1e-9)
+        elif isinstance(value, dict) and key.startswith("volume"):
+            assert value.keys() == actual[key].keys()
+            for token, volume in value.items():
+                assert_same_result(volume, actual[key][token])
+        else:
+            assert value == actual[key]
+
+
+def test_batch_matches_one_at_a_time(upstreams):
+    upstreams, _ = upstreams
+    tx_hashes = upstreams + [UNKNOWN_TX_HASH, upstreams[0]]
+    batch = compute_cow.compute_cowiness_batch(tx_hashes, engine="swaps")
+    assert [entry["tx_hash"] for entry in batch] == tx_hashes
+    assert "error" in batch[-2]
+
+    compute_cow.get_result_store().cache.clear()
+    for tx_hash, entry in zip(upstreams, batch):
+        expected = compute_cow.compute_cowiness_detailed(tx_hash, "swaps")
+        assert_same_result(expected, entry["result"])
+    assert batch[-1] == batch[0]
+
+
+def unprice_first_token(tx_hashes, services):
+    """
+    Has every token priced with a subgraph query, which has no price for a token of the first settlement, and
+    returns that token.
+    """
+    services.price_trades = False
+    token = next(iter(services.orders[tx_hashes[0]].values()))["sellToken"].lower()
+    services.unpriced_tokens = {token}
+    compute_cow.get_result_store().cache.clear()
+    order_prices.token_price_cache.clear()
+    return token
+
+
+def test_unpriced_token_fails_its_settlements_only(upstreams):
+    tx_hashes, services = upstreams
+    token = unprice_first_token(tx_hashes, services)
+
+    batch = compute_cow.compute_cowiness_batch(tx_hashes, engine="swaps")
+    for tx_hash, entry in zip(tx_hashes, batch):
+        tokens = {
+            order[side].lower()
+            for order in services.orders[tx_hash].values()
+            for side in ("sellToken", "buyToken")
+        }
+        if token in tokens:
+            assert entry["error"] == f"missing USD price for token {token}"
+        else:
+            assert entry["result"]["total_volume_in_usd"] > 0
+
+
+def test_unpriced_token_fails_a_detailed_computation(upstreams):
+    tx_hashes, services = upstreams
+    token = unprice_first_token(tx_hashes, services)
+
+    with pytest.raises(ValueError, match=f"missing USD price for token {token}"):
+        compute_cow.compute_cowiness_detailed(tx_hashes[0], "swaps")
@@ -0,0 +1,127 @@
+"""
+Checks against an in-memory MongoDB that the ETL syncs settlements from its watermark, and that it stores computed
+cowiness and queues failed computations for a retry until they succeed or run out of attempts.
+
+Run from the root of the repository:
+
+    python -m pytest benchmarks/test_etl.py
+"""
+import pytest
+
+from etl import etl
+
+mongomock = pytest.importorskip("mongomock")
+
+
+def subgraph_settlement(id, timestamp):
+    return {"id": id, "txHash": f"0x{id}", "firstTradeTimestamp": str(timestamp)}
+
+
+def result(cow_value):
+    return {
+        "cow_value": cow_value,
+        "total_volume_in_usd": 10.0,
+        "total_volume_out_usd": 5.0,
+        "volume_in_usd": {},
+        "volume_out_usd": {},
+    }
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = mongomock.MongoClient().db
+    monkeypatch.setattr(etl, "get_collection", lambda: db.settlements)
+    return db
+
+
+@pytest.fixture
+def subgraph(monkeypatch):
+    settlements = []
+
+    def fetch_settlements(cursor):
+        return [
+            settlement
+            for settlement in settlements
+            if int(settlement["firstTradeTimestamp"]) >= cursor
+        ][: etl.SUBGRAPH_PAGE_SIZE]
+
+    monkeypatch.setattr(etl, "SUBGRAPH_PAGE_SIZE", 3)
+    monkeypatch.setattr(etl, "fetch_settlements", fetch_settlements)
+    return settlements
+
+
+def test_sync_resumes_from_the_watermark(db, subgraph):
+    subgraph.extend(
+        subgraph_settlement(id, timestamp)
+        for id, timestamp in [("a", 10), ("b", 10), ("c", 20), ("d", 30), ("e", 30)]
+    )
+    assert etl.sync_settlements() == 5
+    assert etl.get_watermark() == 30
+
+    subgraph.append(subgraph_settlement("f", 40))
+    assert etl.sync_settlements() == 1
+    assert etl.get_watermark() == 40
+    assert db.settlements.count_documents({}) == 6
+
+
+def test_sync_fails_on_a_page_of_one_timestamp(db, subgraph):
+    subgraph.extend(subgraph_settlement(id, 10) for id in "abc")
+    with pytest.raises(RuntimeError):
+        etl.sync_settlements()
+
+
+def test_failed_computations_are_retried(db, monkeypatch):
+    db.settlements.insert_many(
+        [
+            {"_id": id, "txHash": f"0x{id}", "firstTradeTimestamp": 1_690_000_000}
+            for id in "ab"
+        ]
+    )
+    failing = {"0xb"}
+    batches = []
+
+    def compute_cowiness_batch(tx_hashes, max_workers, time_range):
+        batches.append(tx_hashes)
+        return [
+            {"error": "upstream timeout"}
+            if tx_hash in failing
+            else {"result": result(0.5)}
+            for tx_hash in tx_hashes
+        ]
+
+    monkeypatch.setattr(etl, "compute_cowiness_batch", compute_cowiness_batch)
+    assert etl.compute_settlements() == 2
+    settlement = db.settlements.find_one({"_id": "a"})
+    assert settlement["cowiness"]["cowValue"] == 0.5
+    assert settlement["rolledUp"] is True
+    assert db[etl.MONGODB_DAILY_COLLECTION_NAME].count_documents({}) == 1
+    retry = db.settlements.find_one({"_id": "b"})["cowinessRetry"]
+    assert (retry["attempts"], retry["error"]) == (1, "upstream timeout")
+    # Not due yet
+    assert etl.compute_settlements() == 0
+
+    db.settlements.update_one(
+        {"_id": "b"}, {"$set": {"cowinessRetry.nextAttemptAt": 0}}
+    )
+    failing.clear()
+    assert etl.compute_settlements() == 1
+    settlement = db.settlements.find_one({"_id": "b"})
+    assert "cowinessRetry" not in settlement
+    assert settlement["cowiness"]["cowValue"] == 0.5
+    assert batches == [["0xa", "0xb"], ["0xb"]]
+
+
+def test_exhausted_settlements_are_not_retried(db, monkeypatch):
+    db.settlements.insert_one(
+        {
+            "_id": "a",
+            "txHash": "0xa",
+            "firstTradeTimestamp": 1_690_000_000,
+            "cowinessRetry": {
+                "attempts": etl.ETL_COMPUTE_MAX_ATTEMPTS,
+                "nextAttemptAt": 0,
+            },
+        }
+    )
+    monkeypatch.setattr(etl, "compute_cowiness_batch", None)
+    assert etl.compute_settlements() == 0
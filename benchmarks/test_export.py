@@ -0,0 +1,48 @@
+"""
+Checks against an in-memory MongoDB that an export reads the computed settlements of its time range in order, and
+that an export resumed from the cursor of any row continues right after it.
+
+Run from the root of the repository:
+
+    python -m pytest benchmarks/test_export.py
+"""
+import pytest
+
+from api.src.export import ExportStore, decode_cursor
+
+mongomock = pytest.importorskip("mongomock")
+
+
+@pytest.fixture
+def store():
+    collection = mongomock.MongoClient().db.settlements
+    collection.insert_many(
+        [
+            {
+                "_id": id,
+                "txHash": f"0x{id}",
+                "firstTradeTimestamp": timestamp,
+                "cowiness": {"cowValue": 0.5},
+            }
+            for id, timestamp in [("c", 10), ("a", 10), ("b", 20), ("d", 30), ("e", 40)]
+        ]
+        # Not computed yet
+        + [{"_id": "f", "txHash": "0xf", "firstTradeTimestamp": 20}]
+    )
+    return ExportStore(collection, batch_size=2)
+
+
+def test_rows_are_in_time_order(store):
+    assert [row["txHash"] for row in store.rows(10, 40)] == ["0xa", "0xc", "0xb", "0xd"]
+
+
+def test_export_resumes_after_any_row(store):
+    rows = list(store.rows(0, 100))
+    for index, row in enumerate(rows):
+        resumed = store.rows(0, 100, decode_cursor(row["cursor"]))
+        assert list(resumed) == rows[index + 1 :]
+
+
+def test_malformed_cursor():
+    with pytest.raises(ValueError):
+        decode_cursor("not a cursor")
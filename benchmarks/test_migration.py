@@ -0,0 +1,72 @@
+"""
+Checks against an in-memory MongoDB that the migration brings settlements stored by earlier versions of the ETL to
+the current layout, and leaves current ones as they are.
+
+Run from the root of the repository:
+
+    python -m pytest benchmarks/test_migration.py
+"""
+import pytest
+
+from etl.db.schema import settlement_document
+from etl.migrate import migrate_settlements
+
+mongomock = pytest.importorskip("mongomock")
+
+TX_HASH = "0x" + "ab" * 32
+
+
+@pytest.fixture
+def collection():
+    return mongomock.MongoClient().db.settlements
+
+
+def test_first_etl_document_gets_its_timestamp(collection):
+    # As inserted by the first ETL: the Subgraph settlement with its trades, keyed by its id
+    collection.insert_one(
+        {
+            "_id": "s1",
+            "txHash": "0x" + "AB" * 32,
+            "trades": [{"timestamp": "1690000000"}, {"timestamp": "1690000000"}],
+        }
+    )
+    assert migrate_settlements(collection, page_size=10) == 1
+    assert collection.find_one({"_id": "s1"}) == {
+        "_id": "s1",
+        "txHash": TX_HASH,
+        "firstTradeTimestamp": 1690000000,
+    }
+
+
+def test_string_timestamp_and_missing_tokens_are_migrated(collection):
+    cowiness = {
+        "cowValue": 0.5,
+        "totalVolumeInUsd": 2.0,
+        "totalVolumeOutUsd": 1.0,
+        "volumeInUsd": {"0xAA": {}},
+        "volumeOutUsd": {"0xbb": {}},
+    }
+    collection.insert_one(
+        {
+            "_id": "s2",
+            "txHash": TX_HASH,
+            "firstTradeTimestamp": "1690000000",
+            "cowiness": cowiness,
+        }
+    )
+    assert migrate_settlements(collection, page_size=10) == 1
+    document = collection.find_one({"_id": "s2"})
+    assert document["firstTradeTimestamp"] == 1690000000
+    assert document["tokens"] == ["0xaa", "0xbb"]
+
+
+def test_current_documents_are_skipped(collection):
+    collection.insert_many(
+        [
+            settlement_document(
+                {"id": f"s{i}", "txHash": TX_HASH, "firstTradeTimestamp": "1690000000"}
+            )
+            for i in range(25)
+        ]
+    )
+    assert migrate_settlements(collection, page_size=10) == 0
@@ -0,0 +1,67 @@
+"""
+Checks the orderbook client against a stub orderbook: orders are cached once returned, and failed lookups raise
+without caching anything.
+
+Run from the root of the repository:
+
+    python -m pytest benchmarks/test_orderbook_client.py
+"""
+import asyncio
+import random
+
+import aiohttp
+import pytest
+
+from utils.instance_collect import OrderbookClient, OrderNotFound
+from benchmarks.stub_node import StubServices
+from benchmarks.synthetic import make_settlement
+
+TX_HASH = "0x" + "ab" * 32
+_, ORDERS = make_settlement(random.Random(0), trades=4, interactions=0)
+OIDS = list(ORDERS)
+# The orderbook fails on the first order, and does not know the second
+FAILING_OID = OIDS[0]
+UNKNOWN_OID = "0x" + "ff" * 56
+
+
+@pytest.fixture
+def services():
+    services = StubServices({TX_HASH: ORDERS}, order_statuses={FAILING_OID: 500})
+    server = services.serve()
+    services.url = f"http://127.0.0.1:{server.server_port}"
+    yield services
+    server.shutdown()
+
+
+def with_session(fetch, *args):
+    async def main():
+        async with aiohttp.ClientSession() as session:
+            return await fetch(session, *args)
+
+    return asyncio.run(main())
+
+
+def test_returned_order_is_cached(services):
+    client = OrderbookClient(services.url)
+    assert with_session(client.fetch_order_async, OIDS[1]) == ORDERS[OIDS[1]]
+    assert with_session(client.fetch_order_async, OIDS[1]) == ORDERS[OIDS[1]]
+    assert services.calls == {"order": 1}
+
+
+@pytest.mark.parametrize("oid, status", [(FAILING_OID, 500), (UNKNOWN_OID, 404)])
+def test_failed_lookup_raises_and_is_not_cached(services, oid, status):
+    client = OrderbookClient(services.url)
+    for _ in range(2):
+        with pytest.raises(OrderNotFound) as error:
+            with_session(client.fetch_order_async, oid)
+        assert error.value.status == status
+    assert oid not in client.cache
+    assert services.calls == {"order": 2}
+
+
+def test_settlement_orders_are_cached(services):
+    client = OrderbookClient(services.url)
+    assert with_session(client.fetch_orders_for_tx_async, TX_HASH) == ORDERS
+    for oid in OIDS:
+        assert with_session(client.fetch_order_async, oid) == ORDERS[oid]
+    assert services.calls == {"settlement_orders": 1}
@@ -0,0 +1,83 @@
+"""
+Checks against an in-memory MongoDB that settlements are summed into the hourly and daily rollups once each, whether
+rolled up as they are stored or rebuilt from every computed settlement.
+
+Run from the root of the repository:
+
+    python -m pytest benchmarks/test_rollups.py
+"""
+import pytest
+
+from etl.db.rollups import (
+    DAY,
+    HOUR,
+    WEEK,
+    read_rollups,
+    rebuild_rollups,
+    roll_up_pending,
+)
+
+mongomock = pytest.importorskip("mongomock")
+
+START = 1_690_070_400  # a Sunday, 00:00 UTC
+
+
+def settlement(id, timestamp, cow_value, volume_in, volume_out, **fields):
+    return {
+        "_id": id,
+        "txHash": "0x" + id.rjust(64, "0"),
+        "firstTradeTimestamp": timestamp,
+        "cowiness": {
+            "cowValue": cow_value,
+            "totalVolumeInUsd": volume_in,
+            "totalVolumeOutUsd": volume_out,
+        },
+        **fields,
+    }
+
+
+@pytest.fixture
+def db():
+    db = mongomock.MongoClient().db
+    db.settlements.insert_many(
+        [
+            settlement("1", START + 10, 0.5, 100.0, 50.0, rolledUp=False),
+            settlement("2", START + 20, 0.0, 40.0, 40.0, rolledUp=False),
+            settlement("3", START + HOUR + 5, 1.0, 10.0, 0.0, rolledUp=False),
+            # Computed before rollups were maintained, so never flagged
+            settlement("4", START + DAY + 5, 0.25, 8.0, 6.0),
+            # Not computed yet
+            {"_id": "5", "txHash": "0x05", "firstTradeTimestamp": START + 30},
+        ]
+    )
+    return db
+
+
+def totals(db, interval):
+    return {
+        bucket["start"]: (bucket["settlements"], bucket["volumeInUsd"])
+        for bucket in read_rollups(
+            db.hourly, db.daily, interval, START, START + 2 * DAY
+        )["buckets"]
+    }
+
+
+def test_pending_settlements_are_rolled_up_once(db):
+    assert roll_up_pending(db.settlements, db.hourly, db.daily, page_size=2) == 3
+    # A crash after the rollups were written but before the flags were cleared leaves the settlement pending
+    db.settlements.update_one({"_id": "1"}, {"$set": {"rolledUp": False}})
+    assert roll_up_pending(db.settlements, db.hourly, db.daily) == 1
+
+    assert totals(db, HOUR) == {START: (2, 140.0), START + HOUR: (1, 10.0)}
+    assert totals(db, DAY) == {START: (3, 150.0)}
+
+
+def test_rebuild_adds_every_computed_settlement(db):
+    roll_up_pending(db.settlements, db.hourly, db.daily)
+    for _ in range(2):
+        rebuild_rollups(db.settlements, db.hourly, db.daily, page_size=2)
+        assert totals(db, DAY) == {START: (3, 150.0), START + DAY: (1, 8.0)}
+        assert totals(db, WEEK) == {
+            START - 6 * DAY: (3, 150.0),
+            START + DAY: (1, 8.0),
+        }
@@ -0,0 +1,42 @@
+"""
+Checks against stub upstreams that computing a settlement prices its trades with one subgraph query, however many
+orders it settles, and that computations reuse the connections of those before them.
+
+Run from the root of the repository:
+
+    python -m pytest benchmarks/test_subgraph_queries.py
+"""
+import random
+
+import pytest
+
+from api.src import compute_cow
+from benchmarks.synthetic import make_settlement
+
+
+@pytest.fixture
+def upstreams(serve_upstreams):
+    rng = random.Random(0)
+    settlements = [make_settlement(rng, trades, 4, 10, 2) for trades in (1, 5, 30)]
+    node, services = serve_upstreams(rng, settlements, 1000)
+    return list(node.receipts), services
+
+
+def test_one_subgraph_query_prices_a_settlement(upstreams):
+    tx_hashes, services = upstreams
+    for tx_hash in tx_hashes:
+        before = services.calls.get("settlement_trades", 0)
+        result = compute_cow.compute_cowiness_detailed(tx_hash, "swaps")
+        assert result["total_volume_in_usd"] > 0
+        assert services.calls["settlement_trades"] == before + 1
+    assert "order_trades" not in services.calls
+
+
+def test_computations_reuse_connections(upstreams):
+    tx_hashes, services = upstreams
+    compute_cow.get_result_store().cache.clear()
+    for tx_hash in tx_hashes:
+        compute_cow.compute_cowiness_detailed(tx_hash, "swaps")
+    # Each computation queries the subgraph at least, over the session every computation shares
+    assert services.requests >= len(tx_hashes)
+    assert services.connections < len(tx_hashes)
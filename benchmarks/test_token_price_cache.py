@@ -0,0 +1,36 @@
+"""
+Checks that the token price cache keeps the metadata of tokens whose prices it evicted, so their prices are fetched
+again without it.
+
+Run from the root of the repository:
+
+    python -m pytest benchmarks/test_token_price_cache.py
+"""
+from utils.order_prices import TokenPriceCache, get_token_prices_query
+
+TOKENS = ["0x" + "aa" * 20, "0x" + "bb" * 20]
+
+
+def token(address, price_usd):
+    return {
+        "address": address,
+        "id": address,
+        "name": address[-4:],
+        "decimals": "18",
+        "priceUsd": price_usd,
+    }
+
+
+def test_evicted_price_keeps_token_metadata():
+    cache = TokenPriceCache(maxsize=1)
+    cache.set(100, TOKENS[0], token(TOKENS[0], "1.5"))
+    assert cache.get(100, TOKENS[0])["priceUsd"] == "1.5"
+
+    # Caching a price of another token evicts the first token's price, but not its metadata
+    cache.set(100, TOKENS[1], token(TOKENS[1], "2"))
+    assert cache.get(100, TOKENS[0]) is None
+    assert cache.tokens[TOKENS[0]]["decimals"] == "18"
+    assert TOKENS[0] not in cache.blocks
+
+    query = get_token_prices_query(TOKENS, cache.tokens)
+    assert "decimals" not in query
@@ -0,0 +1,322 @@
+"""
+Computes the cowiness of every historical settlement on a process pool, storing results in MongoDB like the ETL
+does, and checkpointing progress so an interrupted backfill resumes where it stopped.
+
+Run it like the ETL, with the same environment:
+
+    python etl/backfill.py --source subgraph --workers 16
+
+With --source mongo, settlements already synced by the ETL that have no cowiness are computed. With --source
+subgraph, settlements are paged from the Subgraph and stored with their cowiness, skipping those already computed.
+"""
+import argparse
+import datetime
+import json
+import math
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+# Imports resolve from the repository root, whichever directory this is run from
+if __name__ == "__main__":
+    sys.path[0] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+
+from api.src.compute_cow import compute_cowiness_batch
+from etl.db.rollups import roll_up_pending
+from etl.db.schema import PENDING_PROJECTION, cowiness_fields, settlement_document
+from etl.etl import (
+    SUBGRAPH_PAGE_SIZE,
+    cowiness_update,
+    fetch_settlements,
+    get_collection,
+    get_daily_collection,
+    get_hourly_collection,
+    retry_update,
+)
+
+
+def compute_cowiness_summaries(tx_hashes, time_range):
+    """
+    Computes the cowiness of settlements mined in the (start, end) time range in a worker process as one batch, and
+    returns for each the fields to store and None, or None and the error.
+    """
+    return [
+        (cowiness_fields(entry["result"]), None)
+        if "result" in entry
+        else (None, entry["error"])
+        for entry in compute_cowiness_batch(tx_hashes, time_range=time_range)
+    ]
+
+
+def ignore_interrupt():
+    # Ctrl-C is handled by the main process, which lets running computations finish
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def mongo_pages(cursor, page_size):
+    """
+    Yields pages of (settlement, None) for the stored settlements without cowiness, in (firstTradeTimestamp, _id)
+    order after the cursor, each with the cursor to resume after it.
+    """
+    while True:
+        query = {"cowiness": {"$exists": False}}
+        if cursor is not None:
+            timestamp, id = cursor
+            query["$or"] = [
+                {"firstTradeTimestamp": {"$gt": timestamp}},
+                {"firstTradeTimestamp": timestamp, "_id": {"$gt": id}},
+            ]
+        settlements = list(
+            get_collection()
+            .find(query, PENDING_PROJECTION)
+            .sort([("firstTradeTimestamp", 1), ("_id", 1)])
+            .limit(page_size)
+        )
+        if len(settlements) == 0:
+            return
+
+        cursor = [settlements[-1]["firstTradeTimestamp"], settlements[-1]["_id"]]
+        yield [(settlement, None) for settlement in settlements], cursor
+        if len(settlements) < page_size:
+            return
+
+
+def subgraph_pages(cursor, page_size):
+    """
+    Yields pages of (settlement, fields) for the Subgraph settlements from the cursor timestamp on, each with the
+    cursor to resume after it. Settlements already computed are left out, and the fields are written to their
+    document.
+
+    Like the ETL sync, pages start at the last timestamp seen, and settlements sharing it are skipped.
+    """
+    timestamp = int(cursor[0]) if cursor is not None else 0
+    seen = set()
+    while True:
+        settlements = fetch_settlements(timestamp, page_size)
+        if len(settlements) == 0:
+            return
+        last_timestamp = int(settlements[-1]["firstTradeTimestamp"])
+        if len(settlements) == page_size and last_timestamp == timestamp:
+            raise RuntimeError(
+                f"more than {page_size} settlements at timestamp {timestamp}, increase --page-size"
+            )
+
+        new = [settlement for settlement in settlements if settlement["id"] not in seen]
+        seen = {
+            settlement["id"]
+            for settlement in settlements
+            if int(settlement["firstTradeTimestamp"]) == last_timestamp
+        }
+        stored = {
+            document["_id"]: document
+            for document in get_collection().find(
+                {"_id": {"$in": [settlement["id"] for settlement in new]}},
+                {"cowinessRetry": 1, "cowiness.cowValue": 1},
+            )
+        }
+
+        page = []
+        for settlement in new:
+            fields = settlement_document(settlement)
+            id = fields.pop("_id")
+            document = stored.get(id, {"_id": id})
+            if "cowiness" in document:
+                continue
+            page.append(({**fields, **document}, fields))
+        yield page, [last_timestamp, None]
+
+        timestamp = last_timestamp
+        if len(settlements) < page_size:
+            return
+
+
+PAGES = {"mongo": mongo_pages, "subgraph": subgraph_pages}
+
+
+def load_checkpoint(path, source):
+    """
+    Returns the checkpoint saved at path, or a new one if there is none.
+    """
+    if not os.path.exists(path):
+        return {"source": source, "cursor": None, "processed": 0, "failed": 0}
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if checkpoint["source"] != source:
+        raise SystemExit(
+            f"{path} is a checkpoint of a {checkpoint['source']} backfill, pass --reset to start over"
+        )
+    return checkpoint
+
+
+def save_checkpoint(path, checkpoint):
+    # Written to a temporary file first so a crash never leaves a truncated checkpoint
+    checkpoint["updatedAt"] = int(time.time())
+    with open(path + ".tmp", "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(path + ".tmp", path)
+
+
+def write_page(page, cursor, results, checkpoint, path):
+    """
+    Stores the results of a page in one bulk write, rolls them up, and saves the checkpoint after it.
+    Waits for the page's computations to finish.
+    """
+    operations = []
+    failed = 0
+    for (settlement, fields), (computed, error) in zip(page, results):
+        if computed is not None:
+            operations.append(cowiness_update(settlement, computed, fields))
+        else:
+            operations.append(retry_update(settlement, error, fields))
+            failed += 1
+
+    if len(operations) > 0:
+        get_collection().bulk_write(operations, ordered=False)
+    roll_up_pending(get_collection(), get_hourly_collection(), get_daily_collection())
+
+    checkpoint["cursor"] = cursor
+    checkpoint["processed"] += len(page)
+    checkpoint["failed"] += failed
+    save_checkpoint(path, checkpoint)
+
+
+class Progress:
+    """
+    Reports the throughput of a backfill and the time left. The time left is estimated from the settlements left
+    when they are known, and otherwise from how far the cursor timestamp has come toward now.
+    """
+
+    def __init__(self, checkpoint, remaining=None):
+        self.start = time.time()
+        self.processed = checkpoint["processed"]
+        self.remaining = remaining
+        cursor = checkpoint["cursor"]
+        self.first_timestamp = int(cursor[0]) if cursor is not None else None
+
+    def report(self, checkpoint):
+        processed = checkpoint["processed"] - self.processed
+        elapsed = time.time() - self.start
+        rate = processed / max(elapsed, 1e-9)
+        timestamp = int(checkpoint["cursor"][0])
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamp
+
+        eta = None
+        if self.remaining is not None and rate > 0:
+            eta = max(self.remaining - processed, 0) / rate
+        elif self.remaining is None and timestamp > self.first_timestamp:
+            done = timestamp - self.first_timestamp
+            eta = elapsed * (time.time() - timestamp) / done
+
+        print(
+            f"{checkpoint['processed']} settlements ({checkpoint['failed']} failed), "
+            f"{rate:.1f} settlements/sec, up to firstTradeTimestamp {timestamp}, "
+            f"ETA {datetime.timedelta(seconds=int(eta)) if eta is not None else '?'}"
+        )
+
+
+def backfill(source, workers, page_size, path):
+    """
+    Computes and stores the cowiness of every settlement of the source after the checkpoint at path.
+
+    The next page is always queued on the pool while the current one finishes, so workers do not wait on page
+    boundaries. On Ctrl-C, computations already running finish and the checkpoint stays at the last stored page.
+    """
+    checkpoint = load_checkpoint(path, source)
+    remaining = None
+    if source == "mongo":
+        remaining = get_collection().count_documents({"cowiness": {"$exists": False}})
+    progress = Progress(checkpoint, remaining)
+    print(
+        f"Backfilling {source} settlements with {workers} workers"
+        + (f", resuming after {checkpoint['cursor']}" if checkpoint["cursor"] else "")
+    )
+
+    # Workers are spawned rather than forked, so they open their own MongoDB and HTTP clients instead of inheriting
+    # the parent's, which are not fork-safe
+    with ProcessPoolExecutor(
+        workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=ignore_interrupt,
+    ) as executor:
+        in_flight = deque()
+        try:
+            for page, cursor in PAGES[source](checkpoint["cursor"], page_size):
+                # Each worker computes its share of the page as one batch, fetching the receipts of the time range
+                # its share was mined in by block range, as pages are in timestamp order
+                size = max(math.ceil(len(page) / workers), 1)
+                shares = [
+                    page[start : start + size] for start in range(0, len(page), size)
+                ]
+                results = chain.from_iterable(
+                    executor.map(
+                        compute_cowiness_summaries,
+                        [
+                            [settlement["txHash"] for settlement, _ in share]
+                            for share in shares
+                        ],
+                        [
+                            (
+                                share[0][0]["firstTradeTimestamp"],
+                                share[-1][0]["firstTradeTimestamp"],
+                            )
+                            for share in shares
+                        ],
+                    )
+                )
+                in_flight.append((page, cursor, results))
+                if len(in_flight) > 1:
+                    write_page(*in_flight.popleft(), checkpoint, path)
+                    progress.report(checkpoint)
+            while len(in_flight) > 0:
+                write_page(*in_flight.popleft(), checkpoint, path)
+                progress.report(checkpoint)
+        except KeyboardInterrupt:
+            executor.shutdown(wait=False, cancel_futures=True)
+            print(f"Interrupted, run again to resume from {path}")
+            raise SystemExit(130)
+
+    print(f"Backfill done: {checkpoint['processed']} settlements")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compute the cowiness of every historical settlement."
+    )
+    parser.add_argument(
+        "--source",
+        choices=list(PAGES),
+        default="mongo",
+        help="Page settlements without cowiness from MongoDB, or all settlements from the Subgraph.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Worker processes computing settlements.",
+    )
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        default=SUBGRAPH_PAGE_SIZE,
+        help="Settlements per page, each stored in one bulk write.",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        default="backfill_checkpoint.json",
+        help="File the progress is saved to and resumed from.",
+    )
+    parser.add_argument(
+        "--reset", action="store_true", help="Ignore an existing checkpoint."
+    )
+    args = parser.parse_args()
+
+    if args.reset and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    backfill(args.source, args.workers, args.page_size, args.checkpoint)
@@ -0,0 +1,238 @@
+from .schema import COMPUTED, ROLLUP_PROJECTION
+
+HOUR = 3600
+DAY = 24 * HOUR
+WEEK = 7 * DAY
+# Unix time 0 is a Thursday, weeks start on the following Monday
+WEEK_OFFSET = 4 * DAY
+
+INTERVALS = {"hour": HOUR, "day": DAY, "week": WEEK}
+
+# Summed fields of a rollup document
+ROLLUP_FIELDS = [
+    "settlements",
+    "cowValueSum",
+    "cowVolumeUsd",
+    "volumeInUsd",
+    "volumeOutUsd",
+]
+
+
+def bucket_start(timestamp, interval):
+    """
+    Returns the start of the hour, day or week (in seconds) containing the timestamp.
+    """
+    if interval == WEEK:
+        return timestamp - (timestamp - WEEK_OFFSET) % WEEK
+    return timestamp - timestamp % interval
+
+
+def bucket_totals(entries, interval):
+    """
+    Sums (timestamp, cowiness) entries, where cowiness is the summary stored on a settlement document, into the
+    totals of each bucket, keyed by bucket start.
+    """
+    buckets = {}
+    for timestamp, cowiness in entries:
+        start = bucket_start(int(timestamp), interval)
+        totals = buckets.setdefault(start, dict.fromkeys(ROLLUP_FIELDS, 0))
+        totals["settlements"] += 1
+        totals["cowValueSum"] += cowiness["cowValue"]
+        totals["cowVolumeUsd"] += (
+            cowiness["totalVolumeInUsd"] - cowiness["totalVolumeOutUsd"]
+        )
+        totals["volumeInUsd"] += cowiness["totalVolumeInUsd"]
+        totals["volumeOutUsd"] += cowiness["totalVolumeOutUsd"]
+    return buckets
+
+
+def rollup_operations(entries, interval):
+    """
+    Returns one upsert per bucket incrementing its rollup document with the given (timestamp, cowiness) entries.
+    """
+    # The API reads rollups without writing them, so pymongo is only imported here
+    from pymongo import UpdateOne
+
+    return [
+        UpdateOne(
+            {"_id": start},
+            {"$inc": totals, "$setOnInsert": {"interval": interval}},
+            upsert=True,
+        )
+        for start, totals in bucket_totals(entries, interval).items()
+    ]
+
+
+def update_rollups(hourly_collection, daily_collection, entries):
+    """
+    Adds settlements, as (timestamp, cowiness) entries, to the hourly and daily rollups.
+    """
+    if len(entries) == 0:
+        return
+    for collection, interval in [(hourly_collection, HOUR), (daily_collection, DAY)]:
+        collection.bulk_write(rollup_operations(entries, interval), ordered=False)
+
+
+def bucket_ranges(field, starts, interval):
+    return {
+        "$or": [{field: {"$gte": start, "$lt": start + interval}} for start in starts]
+    }
+
+
+def rebuild_buckets(
+    settlements_collection, hourly_collection, daily_collection, timestamps
+):
+    """
+    Recomputes the hourly rollups of the hours containing the given timestamps from the settlements in them, then
+    the daily rollups of their days from their hourly rollups. Unlike adding to them, rebuilding buckets can be
+    repeated without counting a settlement twice.
+    """
+    from pymongo import ReplaceOne
+
+    hours = sorted({bucket_start(int(timestamp), HOUR) for timestamp in timestamps})
+    if len(hours) == 0:
+        return
+    settlements = settlements_collection.find(
+        {
+            **bucket_ranges("firstTradeTimestamp", hours, HOUR),
+            **COMPUTED,
+        },
+        ROLLUP_PROJECTION,
+    )
+    totals = bucket_totals(
+        (
+            (settlement["firstTradeTimestamp"], settlement["cowiness"])
+            for settlement in settlements
+        ),
+        HOUR,
+    )
+    hourly_collection.bulk_write(
+        [
+            ReplaceOne(
+                {"_id": start},
+                {
+                    "interval": HOUR,
+                    **totals.get(start, dict.fromkeys(ROLLUP_FIELDS, 0)),
+                },
+                upsert=True,
+            )
+            for start in hours
+        ],
+        ordered=False,
+    )
+
+    days = sorted({bucket_start(start, DAY) for start in hours})
+    totals = {start: dict.fromkeys(ROLLUP_FIELDS, 0) for start in days}
+    for document in hourly_collection.find(bucket_ranges("_id", days, DAY)):
+        day_totals = totals[bucket_start(document["_id"], DAY)]
+        for field in ROLLUP_FIELDS:
+            day_totals[field] += document.get(field, 0)
+    daily_collection.bulk_write(
+        [
+            ReplaceOne({"_id": start}, {"interval": DAY, **totals[start]}, upsert=True)
+            for start in days
+        ],
+        ordered=False,
+    )
+
+
+def roll_up_pending(
+    settlements_collection, hourly_collection, daily_collection, page_size=1000
+):
+    """
+    Adds every settlement stored with rolledUp false to the rollups by rebuilding the buckets it falls in, then
+    marks it rolled up. Returns the number of settlements rolled up.
+
+    The flag is set false in the same write that stores a settlement's cowiness, so settlements whose rollup was
+    interrupted, even by a crash, are still pending on the next call.
+    """
+    rolled_up = 0
+    while True:
+        pending = list(
+            settlements_collection.find(
+                {"rolledUp": False}, {"firstTradeTimestamp": 1}
+            ).limit(page_size)
+        )
+        if len(pending) == 0:
+            return rolled_up
+        rebuild_buckets(
+            settlements_collection,
+            hourly_collection,
+            daily_collection,
+            [settlement["firstTradeTimestamp"] for settlement in pending],
+        )
+        settlements_collection.update_many(
+            {"_id": {"$in": [settlement["_id"] for settlement in pending]}},
+            {"$set": {"rolledUp": True}},
+        )
+        rolled_up += len(pending)
+
+
+def summarize_bucket(start, interval, totals):
+    settlements = totals["settlements"]
+    volume_in = totals["volumeInUsd"]
+    return {
+        "start": start,
+        "end": start + interval,
+        "settlements": settlements,
+        "averageCowiness": totals["cowValueSum"] / settlements if settlements else None,
+        "volumeWeightedCowiness": totals["cowVolumeUsd"] / volume_in
+        if volume_in
+        else None,
+        "cowVolumeUsd": totals["cowVolumeUsd"],
+        "volumeInUsd": volume_in,
+        "volumeOutUsd": totals["volumeOutUsd"],
+    }
+
+
+def read_rollups(hourly_collection, daily_collection, interval, start, end):
+    """
+    Returns the aggregates of every hour, day or week between the start and end timestamps, and over the whole range.
+
+    The range is widened to whole buckets. Weeks are summed from daily rollups, and buckets without settlements
+    are left out.
+    """
+    range_start = bucket_start(start, interval)
+    range_end = bucket_start(end - 1, interval) + interval
+    collection = hourly_collection if interval == HOUR else daily_collection
+    documents = collection.find({"_id": {"$gte": range_start, "$lt": range_end}})
+
+    buckets = {}
+    for document in documents:
+        totals = buckets.setdefault(
+            bucket_start(document["_id"], interval), dict.fromkeys(ROLLUP_FIELDS, 0)
+        )
+        for field in ROLLUP_FIELDS:
+            totals[field] += document.get(field, 0)
+
+    total = dict.fromkeys(ROLLUP_FIELDS, 0)
+    for totals in buckets.values():
+        for field in ROLLUP_FIELDS:
+            total[field] += totals[field]
+
+    return {
+        "buckets": [
+            summarize_bucket(bucket, interval, totals)
+            for bucket, totals in sorted(buckets.items())
+        ],
+        "total": summarize_bucket(range_start, range_end - range_start, total),
+    }
+
+
+def rebuild_rollups(
+    settlements_collection, hourly_collection, daily_collection, page_size=1000
+):
+    """
+    Recomputes the hourly and daily rollups from every settlement with stored cowiness, for settlements computed
+    before rollups were maintained.
+    """
+    hourly_collection.delete_many({})
+    daily_collection.delete_many({})
+
+    entries = []
+    for settlement in settlements_collection.find(COMPUTED, ROLLUP_PROJECTION):
+        entries.append((settlement["firstTradeTimestamp"], settlement["cowiness"]))
+        if len(entries) == page_size:
+            update_rollups(hourly_collection, daily_collection, entries)
+            entries = []
+    update_rollups(hourly_collection, daily_collection, entries)
@@ -0,0 +1,139 @@
+"""
+Storage layout of the settlements collection, its indexes, and the projections reads use.
+
+A settlement document holds:
+
+    _id                  Subgraph settlement id
+    txHash               lowercase transaction hash
+    firstTradeTimestamp  Unix timestamp of the settlement's trades, as an integer
+    blockNumber          block of the settlement, once its cowiness is computed
+    tokens               lowercase addresses of the tokens it bought or sold, once its cowiness is computed
+    cowiness             CoW value and USD volumes, once computed
+    rolledUp             false from when its cowiness is stored until it is added to the rollups
+    cowinessRetry        attempts, next attempt time and last error while its cowiness fails to compute
+"""
+# Cowiness totals of a settlement, kept in the index answering rollup reads without fetching documents
+COWINESS_TOTALS = [
+    ("cowiness.cowValue", 1),
+    ("cowiness.totalVolumeInUsd", 1),
+    ("cowiness.totalVolumeOutUsd", 1),
+]
+
+# Keys and options of each index of the settlements collection
+SETTLEMENT_INDEXES = [
+    # Lookups by transaction hash
+    ([("txHash", 1)], {"name": "txHash"}),
+    # Time ranges, read in (firstTradeTimestamp, _id) order by exports and backfills
+    (
+        [("firstTradeTimestamp", 1), ("_id", 1)],
+        {"name": "firstTradeTimestamp_id"},
+    ),
+    ([("blockNumber", 1)], {"name": "blockNumber", "sparse": True}),
+    # Time ranges of computed settlements rolled up by hour, covering ROLLUP_PROJECTION
+    (
+        [("firstTradeTimestamp", 1), *COWINESS_TOTALS],
+        {"name": "firstTradeTimestamp_cowiness"},
+    ),
+    # Settlements waiting to be added to the rollups, only indexed while they wait
+    (
+        [("rolledUp", 1)],
+        {"name": "rolledUp_pending", "partialFilterExpression": {"rolledUp": False}},
+    ),
+    # Settlements trading a token over a time range
+    (
+        [("tokens", 1), ("firstTradeTimestamp", 1)],
+        {"name": "tokens_firstTradeTimestamp"},
+    ),
+]
+
+# Fields read to compute a settlement's cowiness
+PENDING_PROJECTION = {"txHash": 1, "firstTradeTimestamp": 1, "cowinessRetry": 1}
+# Fields read to add a settlement to the rollups. It leaves out _id, which is not in the index answering it.
+ROLLUP_PROJECTION = {
+    "_id": 0,
+    "firstTradeTimestamp": 1,
+    **{field: 1 for field, _ in COWINESS_TOTALS},
+}
+# Matches computed settlements from the cowiness totals index, where "cowiness" itself is not indexed
+COMPUTED = {"cowiness.cowValue": {"$type": "number"}}
+# Fields read to export a settlement's cowiness. The per-token volumes are not indexed, so exports read documents in
+# (firstTradeTimestamp, _id) index order.
+EXPORT_PROJECTION = {"txHash": 1, "firstTradeTimestamp": 1, "cowiness": 1}
+
+
+def create_settlement_indexes(collection):
+    """
+    Creates the indexes of the settlements collection that are missing. Existing ones are left as they are.
+    """
+    # The API reads settlements without creating indexes, so pymongo is only imported here
+    from pymongo import IndexModel
+
+    collection.create_indexes(
+        [IndexModel(keys, **options) for keys, options in SETTLEMENT_INDEXES]
+    )
+
+
+def settlement_document(settlement):
+    """
+    Returns the document fields of a settlement as the Subgraph returns it. The timestamps of its trades are left
+    out, since all trades of a settlement share the timestamp of its transaction.
+    """
+    return {
+        "_id": settlement["id"],
+        "txHash": settlement["txHash"].lower(),
+        "firstTradeTimestamp": int(settlement["firstTradeTimestamp"]),
+    }
+
+
+def cowiness_fields(result):
+    """
+    Returns the document fields storing a detailed cowiness result: the part of the result kept under cowiness, the
+    tokens traded, and the block number when the result has it.
+    """
+    fields = {
+        "cowiness": {
+            "cowValue": result["cow_value"],
+            "totalVolumeInUsd": result["total_volume_in_usd"],
+            "totalVolumeOutUsd": result["total_volume_out_usd"],
+            "volumeInUsd": result["volume_in_usd"],
+            "volumeOutUsd": result["volume_out_usd"],
+        },
+        "tokens": tokens_traded(result["volume_in_usd"], result["volume_out_usd"]),
+    }
+    # Results stored before block numbers were part of them have none
+    if result.get("block_number") is not None:
+        fields["blockNumber"] = result["block_number"]
+    return fields
+
+
+def tokens_traded(volume_in_usd, volume_out_usd):
+    return sorted({token.lower() for token in [*volume_in_usd, *volume_out_usd]})
+
+
+def migration_update(document):
+    """
+    Returns the $set and $unset bringing a settlement document stored in an earlier layout to the current one, or
+    None if it is current.
+    """
+    set_fields = {}
+    unset_fields = {}
+    if isinstance(document.get("firstTradeTimestamp"), str):
+        set_fields["firstTradeTimestamp"] = int(document["firstTradeTimestamp"])
+    elif "firstTradeTimestamp" not in document and document.get("trades"):
+        # Documents inserted by the first ETL only have the timestamps of their trades, which are all the same
+        set_fields["firstTradeTimestamp"] = int(document["trades"][0]["timestamp"])
+    if "txHash" in document and document["txHash"] != document["txHash"].lower():
+        set_fields["txHash"] = document["txHash"].lower()
+    if "trades" in document:
+        unset_fields["trades"] = ""
+    if "cowiness" in document and "tokens" not in document:
+        set_fields["tokens"] = tokens_traded(
+            document["cowiness"]["volumeInUsd"], document["cowiness"]["volumeOutUsd"]
+        )
+
+    update = {}
+    if set_fields:
+        update["$set"] = set_fields
+    if unset_fields:
+        update["$unset"] = unset_fields
+    return update or None
@@ -1,49 +1,269 @@
-import os
+import time
 import requests
+from pymongo import UpdateOne
+from api.src.compute_cow import compute_cowiness_batch
 from schedule import every
-from db.mongo import connect
-from dotenv import load_dotenv
+from etl.db.mongo import connect
+from etl.db.rollups import roll_up_pending
+from etl.db.schema import (
+    PENDING_PROJECTION,
+    cowiness_fields,
+    create_settlement_indexes,
+    settlement_document,
+)
+from utils.config import config
 
-# Load .env file from the main folder
-load_dotenv(os.path.join(os.path.dirname(__file__), "..", ".env"))
+# Get settings, with the .env file of the main folder loaded
+MONGODB_URI = config.get("MONGODB_URI")
+MONGODB_DB_NAME = config.get("MONGODB_DB_NAME")
+MONGODB_COLLECTION_NAME = config.get("MONGODB_COLLECTION_NAME")
+MONGODB_STATE_COLLECTION_NAME = config.get("MONGODB_STATE_COLLECTION_NAME", "etl_state")
+MONGODB_HOURLY_COLLECTION_NAME = config.get(
+    "MONGODB_HOURLY_COLLECTION_NAME", "cowiness_hourly"
+)
+MONGODB_DAILY_COLLECTION_NAME = config.get(
+    "MONGODB_DAILY_COLLECTION_NAME", "cowiness_daily"
+)
+SUBGRAPH_ENDPOINT = config.get("SUBGRAPH_ENDPOINT")
+SUBGRAPH_PAGE_SIZE = config.get_int("SUBGRAPH_PAGE_SIZE", 1000)
+ETL_COMPUTE_WORKERS = config.get_int("ETL_COMPUTE_WORKERS", 4)
+ETL_COMPUTE_BATCH_SIZE = config.get_int("ETL_COMPUTE_BATCH_SIZE", 100)
+ETL_COMPUTE_MAX_ATTEMPTS = config.get_int("ETL_COMPUTE_MAX_ATTEMPTS", 5)
+ETL_COMPUTE_RETRY_DELAY = config.get_int("ETL_COMPUTE_RETRY_DELAY", 60)
 
-# Get environment variables
-MONGODB_URI = os.environ.get("MONGODB_URI")
-MONGODB_DB_NAME = os.environ.get("MONGODB_DB_NAME")
-MONGODB_COLLECTION_NAME = os.environ.get("MONGODB_COLLECTION_NAME")
-SUBGRAPH_ENDPOINT = os.environ.get("SUBGRAPH_ENDPOINT")
 
+WATERMARK_ID = "settlements"
 
-# Access the desired collection
-collection = connect(MONGODB_URI, MONGODB_DB_NAME, MONGODB_COLLECTION_NAME)
 
-# Define GraphQL query
+def create_collection():
+    collection = connect(MONGODB_URI, MONGODB_DB_NAME, MONGODB_COLLECTION_NAME)
+    # Indexes are only built when missing, so this is quick once they exist
+    create_settlement_indexes(collection)
+    return collection
+
+
+def get_collection():
+    # Connected on first use, so processes that only compute, like backfill workers, never connect
+    return config.client("settlements_collection", create_collection)
+
+
+def get_state_collection():
+    # The sync high-watermark is kept in a state collection next to the settlements
+    return get_collection().database[MONGODB_STATE_COLLECTION_NAME]
+
+
+def get_hourly_collection():
+    # Hourly and daily aggregates of stored cowiness, keyed by bucket start timestamp
+    return get_collection().database[MONGODB_HOURLY_COLLECTION_NAME]
+
+
+def get_daily_collection():
+    return get_collection().database[MONGODB_DAILY_COLLECTION_NAME]
+
+
+# Define GraphQL query, paging through settlements in timestamp order from the watermark
 query = """
-{
-  settlements(first: 10) {
+query GetSettlements($first: Int!, $cursor: BigInt!) {
+  settlements(
+    first: $first
+    orderBy: firstTradeTimestamp
+    orderDirection: asc
+    where: { firstTradeTimestamp_gte: $cursor }
+  ) {
     id
     txHash
-    trades {
-      timestamp
-    }
+    firstTradeTimestamp
   }
 }
 """
 
 
-# Define data pulling and uploading task
-def etl_task():
-    # Send POST request to GraphQL endpoint
-    response = requests.post(SUBGRAPH_ENDPOINT, json={"query": query})
+def get_watermark():
+    """
+    Returns the firstTradeTimestamp up to which settlements have been synced, or 0 before the first sync.
+    """
+    state = get_state_collection().find_one({"_id": WATERMARK_ID})
+    return state["firstTradeTimestamp"] if state is not None else 0
+
+
+def set_watermark(timestamp):
+    get_state_collection().update_one(
+        {"_id": WATERMARK_ID}, {"$set": {"firstTradeTimestamp": timestamp}}, upsert=True
+    )
+
+
+def fetch_settlements(cursor, first=SUBGRAPH_PAGE_SIZE):
+    """
+    Returns the next page of settlements whose first trade is at or after the cursor timestamp.
+    """
+    variables = {"first": first, "cursor": str(cursor)}
+    response = requests.post(
+        SUBGRAPH_ENDPOINT, json={"query": query, "variables": variables}
+    )
+    return response.json()["data"]["settlements"]
 
-    # Extract settlement data from JSON response
-    settlements = response.json()["data"]["settlements"]
 
-    # Insert data into MongoDB
+def upsert_settlements(settlements):
+    """
+    Writes a page of settlements in a single unordered bulk write of upserts and returns the number of new ones.
+    """
+    operations = []
     for settlement in settlements:
-        settlement["_id"] = settlement.pop("id")
-        print(f"Inserted settlement {settlement['_id']}")
-        collection.insert_one(settlement)
+        document = settlement_document(settlement)
+        operations.append(
+            UpdateOne({"_id": document["_id"]}, {"$set": document}, upsert=True)
+        )
+    result = get_collection().bulk_write(operations, ordered=False)
+    return result.upserted_count
+
+
+def sync_settlements():
+    """
+    Pages through all settlements after the watermark until caught up, and returns the number of new settlements.
+
+    Pages start at the last timestamp seen, so settlements sharing that timestamp are fetched again rather than
+    missed; the upserts make that harmless.
+    """
+    cursor = get_watermark()
+    inserted = 0
+    start = time.time()
+
+    while True:
+        settlements = fetch_settlements(cursor)
+        if len(settlements) == 0:
+            break
+
+        inserted += upsert_settlements(settlements)
+        last_timestamp = int(settlements[-1]["firstTradeTimestamp"])
+        if len(settlements) == SUBGRAPH_PAGE_SIZE and last_timestamp == cursor:
+            raise RuntimeError(
+                f"more than {SUBGRAPH_PAGE_SIZE} settlements at timestamp {cursor}, increase SUBGRAPH_PAGE_SIZE"
+            )
+        cursor = last_timestamp
+        set_watermark(cursor)
+
+        if len(settlements) < SUBGRAPH_PAGE_SIZE:
+            break
+
+    elapsed = time.time() - start
+    print(
+        f"Inserted {inserted} settlements in {elapsed:.1f}s "
+        f"({inserted / max(elapsed, 1e-9):.1f} settlements/sec), synced up to {cursor}"
+    )
+    return inserted
+
+
+def find_pending_settlements(now):
+    """
+    Returns the next batch of settlements without cowiness that are due, either new or waiting for a retry.
+    """
+    return list(
+        get_collection()
+        .find(
+            {
+                "cowiness": {"$exists": False},
+                "cowinessRetry.nextAttemptAt": {"$not": {"$gt": now}},
+                "cowinessRetry.attempts": {"$not": {"$gte": ETL_COMPUTE_MAX_ATTEMPTS}},
+            },
+            PENDING_PROJECTION,
+        )
+        .limit(ETL_COMPUTE_BATCH_SIZE)
+    )
+
+
+def cowiness_update(settlement, computed, fields=None):
+    """
+    Returns the update storing computed cowiness, as cowiness_fields returns it, on a settlement document, flagged
+    as not rolled up yet. With settlement fields, the document is written with them, and created if missing.
+    """
+    return UpdateOne(
+        {"_id": settlement["_id"]},
+        {
+            "$set": {**(fields or {}), **computed, "rolledUp": False},
+            "$unset": {"cowinessRetry": ""},
+        },
+        upsert=fields is not None,
+    )
+
+
+def retry_update(settlement, error, fields=None):
+    """
+    Returns the update queueing a settlement whose cowiness failed to compute for a retry with exponential backoff.
+    Settlement fields are written as with cowiness_update.
+    """
+    attempts = settlement.get("cowinessRetry", {}).get("attempts", 0) + 1
+    print(
+        f"Failed computing cowiness of {settlement['_id']} (attempt {attempts}): {error}"
+    )
+    return UpdateOne(
+        {"_id": settlement["_id"]},
+        {
+            "$set": {
+                **(fields or {}),
+                "cowinessRetry": {
+                    "attempts": attempts,
+                    "nextAttemptAt": int(time.time())
+                    + ETL_COMPUTE_RETRY_DELAY * 2 ** (attempts - 1),
+                    "error": str(error),
+                },
+            }
+        },
+        upsert=fields is not None,
+    )
+
+
+def settlement_update(settlement, entry):
+    """
+    Returns the update storing the cowiness computed for a settlement, given its compute_cowiness_batch entry.
+
+    Failures are queued for a retry with exponential backoff, until ETL_COMPUTE_MAX_ATTEMPTS is reached.
+    """
+    if "error" in entry:
+        return retry_update(settlement, entry["error"])
+    return cowiness_update(settlement, cowiness_fields(entry["result"]))
+
+
+def compute_settlements():
+    """
+    Computes the cowiness of every pending settlement, a batch at a time, and returns the number processed.
+
+    Each batch is computed with compute_cowiness_batch, which fetches the receipts of the time range the batch was
+    mined in by block range, or in JSON-RPC batches when it is too wide, and computes the volumes of the whole batch
+    at once. Once a batch is written, the buckets of the settlements it stored are
+    rebuilt in the hourly and daily rollups, along with those of any settlement a crash left out of them.
+    """
+    processed = 0
+    start = time.time()
+
+    while True:
+        settlements = find_pending_settlements(int(time.time()))
+        if len(settlements) == 0:
+            break
+        timestamps = [settlement["firstTradeTimestamp"] for settlement in settlements]
+        entries = compute_cowiness_batch(
+            [settlement["txHash"] for settlement in settlements],
+            max_workers=ETL_COMPUTE_WORKERS,
+            time_range=(min(timestamps), max(timestamps)),
+        )
+        operations = list(map(settlement_update, settlements, entries))
+        get_collection().bulk_write(operations, ordered=False)
+        roll_up_pending(
+            get_collection(), get_hourly_collection(), get_daily_collection()
+        )
+        processed += len(operations)
+
+    elapsed = time.time() - start
+    print(
+        f"Computed cowiness of {processed} settlements in {elapsed:.1f}s "
+        f"({processed / max(elapsed, 1e-9):.1f} settlements/sec)"
+    )
+    return processed
+
+
+# Define data pulling and uploading task
+def etl_task():
+    sync_settlements()
+    compute_settlements()
 
 
 # Schedule the task to run every 5 minutes
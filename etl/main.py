@@ -1,5 +1,12 @@
+import os
+import sys
 import time
-from .etl import etl_task
+
+# Imports resolve from the repository root, whichever directory this is run from
+if __name__ == "__main__":
+    sys.path[0] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+from etl.etl import etl_task
 from schedule import run_pending
 
 # Run the task indefinitely
@@ -0,0 +1,148 @@
+"""
+Brings the settlements stored by earlier versions of the ETL to the current storage layout (etl/db/schema.py), and
+creates the indexes of the settlements collection.
+
+Run it like the ETL, with the same environment, before starting the new ETL:
+
+    python etl/migrate.py --block-numbers --rollups
+
+Settlements are rewritten page by page, so a migration stopped midway can be run again; documents already in the
+current layout are skipped. With --block-numbers, the block number of settlements computed before it was stored is
+read from their receipts, fetched in JSON-RPC batches. With --rollups, the hourly and daily rollups are rebuilt from
+every computed settlement, adding those computed before the ETL maintained them.
+"""
+import argparse
+import os
+import sys
+import time
+
+# Imports resolve from the repository root, whichever directory this is run from
+if __name__ == "__main__":
+    sys.path[0] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+from pymongo import UpdateOne
+from api.src.web3 import get_receipt_client
+from etl.db.mongo import connect
+from etl.db.rollups import rebuild_rollups
+from etl.db.schema import create_settlement_indexes, migration_update
+from utils.config import config
+
+# Fields migration_update needs, without the trade timestamps being migrated away
+MIGRATION_PROJECTION = {
+    "txHash": 1,
+    "firstTradeTimestamp": 1,
+    "trades": {"$slice": 1},
+    "tokens": {"$slice": 1},
+    "cowiness.volumeInUsd": 1,
+    "cowiness.volumeOutUsd": 1,
+}
+
+
+def pages(collection, query, projection, page_size):
+    """
+    Yields pages of the documents matching query in _id order.
+    """
+    last_id = None
+    while True:
+        page_query = query if last_id is None else {**query, "_id": {"$gt": last_id}}
+        documents = list(
+            collection.find(page_query, projection).sort("_id", 1).limit(page_size)
+        )
+        if len(documents) == 0:
+            return
+        yield documents
+        last_id = documents[-1]["_id"]
+
+
+def migrate_settlements(collection, page_size):
+    """
+    Rewrites the settlement documents in an earlier layout, and returns the number rewritten.
+    """
+    migrated = 0
+    for documents in pages(collection, {}, MIGRATION_PROJECTION, page_size):
+        operations = []
+        for document in documents:
+            update = migration_update(document)
+            if update is not None:
+                operations.append(UpdateOne({"_id": document["_id"]}, update))
+        if len(operations) > 0:
+            collection.bulk_write(operations, ordered=False)
+        migrated += len(operations)
+        print(f"Migrated {migrated} settlements, up to {documents[-1]['_id']}")
+    return migrated
+
+
+def add_block_numbers(collection, page_size):
+    """
+    Stores the block number of computed settlements that have none, read from their receipts. Returns the number
+    of settlements updated.
+    """
+    updated = 0
+    query = {"cowiness": {"$exists": True}, "blockNumber": {"$exists": False}}
+    for documents in pages(collection, query, {"txHash": 1}, page_size):
+        receipts = get_receipt_client().get_receipts(
+            [document["txHash"] for document in documents]
+        )
+        operations = [
+            UpdateOne(
+                {"_id": document["_id"]},
+                {"$set": {"blockNumber": receipts[document["txHash"]]["blockNumber"]}},
+            )
+            for document in documents
+            if document["txHash"] in receipts
+        ]
+        if len(operations) > 0:
+            collection.bulk_write(operations, ordered=False)
+        updated += len(operations)
+        print(f"Added the block number of {updated} settlements")
+    return updated
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Migrate stored settlements to the current storage layout."
+    )
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        default=1000,
+        help="Settlements read and written per page.",
+    )
+    parser.add_argument(
+        "--block-numbers",
+        action="store_true",
+        help="Read missing block numbers from the receipts of computed settlements.",
+    )
+    parser.add_argument(
+        "--rollups",
+        action="store_true",
+        help="Rebuild the hourly and daily rollups from every computed settlement.",
+    )
+    args = parser.parse_args()
+
+    collection = connect(
+        config.get("MONGODB_URI"),
+        config.get("MONGODB_DB_NAME"),
+        config.get("MONGODB_COLLECTION_NAME"),
+    )
+    start = time.time()
+    migrated = migrate_settlements(collection, args.page_size)
+    if args.block_numbers:
+        add_block_numbers(collection, args.page_size)
+    # Built after the documents are rewritten, so each index is built once over the final values
+    create_settlement_indexes(collection)
+    if args.rollups:
+        rebuild_rollups(
+            collection,
+            collection.database[
+                config.get("MONGODB_HOURLY_COLLECTION_NAME", "cowiness_hourly")
+            ],
+            collection.database[
+                config.get("MONGODB_DAILY_COLLECTION_NAME", "cowiness_daily")
+            ],
+            args.page_size,
+        )
+        print("Rebuilt the hourly and daily rollups")
+    print(
+        f"Migration done: {migrated} settlements rewritten and indexes created in {time.time() - start:.1f}s"
+    )
@@ -0,0 +1,130 @@
+import asyncio
+import threading
+
+from . import metrics
+
+
+class Rejected(Exception):
+    """
+    Raised when a request is not admitted, with the status to answer and the seconds after which to retry.
+    """
+
+    def __init__(self, status, message, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Admits requests taking at most limit slots at a time. Up to queue_size more wait, in arrival order, for at most
+    queue_timeout seconds each.
+
+    A request takes as many slots as its weight, the threads it keeps busy, up to limit so it can always be admitted
+    once the others are done. A request arriving with the queue full is rejected at once with 429, and one that
+    waited queue_timeout without being admitted with 503, both asking to retry after retry_after seconds. A spike
+    is then answered quickly instead of piling up requests that time out.
+    """
+
+    def __init__(self, limit, queue_size, queue_timeout, retry_after=1):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.active = 0
+        self._queue = []
+        self._condition = threading.Condition()
+
+    def acquire(self, weight=1):
+        """
+        Waits until the request is admitted, raising Rejected if it is not. Returns the slots it took, to release.
+        """
+        weight = min(weight, self.limit)
+        with self._condition:
+            if self.active + weight <= self.limit and len(self._queue) == 0:
+                self.active += weight
+                return weight
+            ticket = self._enqueue()
+            try:
+                with metrics.span("admission_wait"):
+                    admitted = self._condition.wait_for(
+                        lambda: self._admits(ticket, weight), self.queue_timeout
+                    )
+            finally:
+                self._dequeue(ticket)
+            return self._admit(admitted, weight)
+
+    def release(self, weight=1):
+        with self._condition:
+            self.active -= weight
+            self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            return {"active": self.active, "queued": len(self._queue)}
+
+    def _enqueue(self):
+        if len(self._queue) >= self.queue_size:
+            metrics.count_rejected_request("queue_full")
+            raise Rejected(429, "Too many requests", self.retry_after)
+        ticket = object()
+        self._queue.append(ticket)
+        return ticket
+
+    def _admits(self, ticket, weight):
+        return self.active + weight <= self.limit and self._queue[0] is ticket
+
+    def _dequeue(self, ticket):
+        self._queue.remove(ticket)
+        # The next request in line may be admitted now
+        self._condition.notify_all()
+
+    def _admit(self, admitted, weight):
+        if not admitted:
+            metrics.count_rejected_request("queue_timeout")
+            raise Rejected(503, "Server busy", self.retry_after)
+        self.active += weight
+        return weight
+
+
+class AsyncAdmissionController(AdmissionController):
+    """
+    An AdmissionController for requests served on an event loop, where waiting requests await their turn instead
+    of blocking a thread. It must only be used from one event loop.
+    """
+
+    def __init__(self, limit, queue_size, queue_timeout, retry_after=1):
+        super().__init__(limit, queue_size, queue_timeout, retry_after)
+        self._condition = asyncio.Condition()
+
+    async def acquire(self, weight=1):
+        """
+        Waits until the request is admitted, raising Rejected if it is not. Returns the slots it took, to release.
+        """
+        weight = min(weight, self.limit)
+        async with self._condition:
+            if self.active + weight <= self.limit and len(self._queue) == 0:
+                self.active += weight
+                return weight
+            ticket = self._enqueue()
+            try:
+                with metrics.span("admission_wait"):
+                    await asyncio.wait_for(
+                        self._condition.wait_for(lambda: self._admits(ticket, weight)),
+                        self.queue_timeout,
+                    )
+                admitted = True
+            except asyncio.TimeoutError:
+                admitted = False
+            finally:
+                self._dequeue(ticket)
+            return self._admit(admitted, weight)
+
+    async def release(self, weight=1):
+        async with self._condition:
+            self.active -= weight
+            self._condition.notify_all()
+
+    def stats(self):
+        return {"active": self.active, "queued": len(self._queue)}
@@ -0,0 +1,89 @@
+import asyncio
+import atexit
+import concurrent.futures
+import contextvars
+import threading
+
+from .config import config
+
+
+def create_session(limit=None):
+    """
+    Creates an HTTP session whose connection pool caps the number of concurrent upstream requests, at
+    UPSTREAM_CONCURRENCY unless a limit is given.
+    """
+    # aiohttp takes a large share of the import time, and is only needed once a computation runs
+    import aiohttp
+
+    if limit is None:
+        limit = config.get_int("UPSTREAM_CONCURRENCY", 16)
+    return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=limit))
+
+
+class SessionLoop:
+    """
+    An event loop running on a daemon thread with one HTTP session, shared by every coroutine run on it, so
+    connections to the orderbook and subgraph are kept alive from one computation to the next.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="session-loop", daemon=True
+        )
+        self.thread.start()
+        # The limit is read here, as this may run while the config lock is held, which would block the loop reading it
+        limit = config.get_int("UPSTREAM_CONCURRENCY", 16)
+        self.session = self.submit(self.open_session, limit).result()
+        atexit.register(self.close)
+
+    async def open_session(self, limit):
+        # Created on the loop, which its connections are bound to
+        return create_session(limit)
+
+    def submit(self, fn, *args):
+        """
+        Starts the coroutine function fn with the given arguments on the loop, in a copy of the caller's context so
+        its timings add up on the caller's request, and returns a concurrent.futures.Future of its result.
+        """
+        future = concurrent.futures.Future()
+
+        def done(task):
+            if task.cancelled():
+                future.cancel()
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+
+        def start():
+            self.loop.create_task(fn(*args)).add_done_callback(done)
+
+        self.loop.call_soon_threadsafe(start, context=contextvars.copy_context())
+        return future
+
+    def run(self, fn, *args):
+        """
+        Runs the coroutine function fn with the shared session and the given arguments, and returns its result.
+        """
+        if threading.current_thread() is self.thread:
+            raise RuntimeError("run_with_session cannot wait on the session loop")
+        return self.submit(fn, self.session, *args).result()
+
+    def close(self):
+        """
+        Closes the session and stops the loop.
+        """
+        self.submit(self.session.close).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def get_session_loop():
+    return config.client("session_loop", SessionLoop)
+
+
+def run_with_session(fn, *args):
+    """
+    Runs the coroutine function fn with the process's shared session and the given arguments, and returns its result.
+    """
+    return get_session_loop().run(fn, *args)
@@ -0,0 +1,60 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    A thread-safe mapping bounded to maxsize entries that evicts the least recently used entry first.
+
+    on_evict, if given, is called with the key and value of every evicted entry, after the cache lock is released.
+    """
+
+    def __init__(self, maxsize=1024, on_evict=None):
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Returns the value cached for key and marks it as recently used, otherwise returns default.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        """
+        Caches value for key, evicting the least recently used entry when full.
+        """
+        evicted = []
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                evicted.append(self._entries.popitem(last=False))
+        if self.on_evict is not None:
+            for evicted_key, evicted_value in evicted:
+                self.on_evict(evicted_key, evicted_value)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._entries.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
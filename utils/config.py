@@ -0,0 +1,55 @@
+import os
+import threading
+
+from dotenv import load_dotenv
+
+
+class Config:
+    """
+    Settings of the API, the ETL and the tools, read from the environment with the repository's .env file loaded
+    once on first read, and the clients built from them, each created on first use.
+
+    Modules read the settings they need into constants at import, which loads the .env file. Clients connecting to
+    MongoDB or the node are only built on first use, so importing a module connects to nothing, and processes only
+    pay for the clients the code they run needs.
+    """
+
+    def __init__(self, env_file):
+        self.env_file = env_file
+        self._loaded = False
+        self._clients = {}
+        # Creating a client may create the clients it depends on
+        self._lock = threading.RLock()
+
+    def load(self):
+        """
+        Loads the .env file into the environment, once. Variables already set keep their value.
+        """
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    load_dotenv(self.env_file)
+                    self._loaded = True
+
+    def get(self, name, default=None):
+        self.load()
+        return os.environ.get(name, default)
+
+    def get_int(self, name, default):
+        return int(self.get(name, default))
+
+    def client(self, name, create):
+        """
+        Returns the client registered under name, creating it with create on first use.
+        """
+        try:
+            return self._clients[name]
+        except KeyError:
+            pass
+        with self._lock:
+            if name not in self._clients:
+                self._clients[name] = create()
+            return self._clients[name]
+
+
+config = Config(os.path.join(os.path.dirname(__file__), "..", ".env"))
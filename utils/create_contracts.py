@@ -1,14 +1,38 @@
-from ..api.src.web3 import get_receipt_from_txhash, create_contract
+from utils.config import config
+from api.src.web3 import create_contract
+
+SETTLEMENT_ADDRESS = "0x9008D19f58AAbD9eD0D60971565AA8510560ab41"
+
+# topic0 of the events decoded, the keccak hash of their signature, so logs can be told apart without building
+# the contracts
+TRADE_TOPIC = bytes.fromhex(
+    "a07a543ab8a018198e99ca0184c93fe9050a79400a0a723441f84de1d972cc17"
+)
+INTERACTION_TOPIC = bytes.fromhex(
+    "ed99827efb37016f2275f98c4bcf71c7551c75d59e9b450f79fa32e60be672c2"
+)
+SETTLEMENT_TOPIC = bytes.fromhex(
+    "40338ce1a7c49204f0099533b1e9a7ee0a3d261f84974ab7af36105b8c4e9db4"
+)
+TRANSFER_TOPIC = bytes.fromhex(
+    "ddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef"
+)
 
 
 def create_settlement_contract():
     return create_contract(
-        "0x9008D19f58AAbD9eD0D60971565AA8510560ab41",
+        SETTLEMENT_ADDRESS,
         [
             {
                 "anonymous": False,
                 "inputs": [
-                    # Settlement contract ABI inputs
+                    {"indexed": True, "name": "owner", "type": "address"},
+                    {"indexed": False, "name": "sellToken", "type": "address"},
+                    {"indexed": False, "name": "buyToken", "type": "address"},
+                    {"indexed": False, "name": "sellAmount", "type": "uint256"},
+                    {"indexed": False, "name": "buyAmount", "type": "uint256"},
+                    {"indexed": False, "name": "feeAmount", "type": "uint256"},
+                    {"indexed": False, "name": "orderUid", "type": "bytes"},
                 ],
                 "name": "Trade",
                 "type": "event",
@@ -16,11 +40,21 @@ def create_settlement_contract():
             {
                 "anonymous": False,
                 "inputs": [
-                    # Settlement contract ABI inputs
+                    {"indexed": True, "name": "target", "type": "address"},
+                    {"indexed": False, "name": "value", "type": "uint256"},
+                    {"indexed": False, "name": "selector", "type": "bytes4"},
                 ],
                 "name": "Interaction",
                 "type": "event",
             },
+            {
+                "anonymous": False,
+                "inputs": [
+                    {"indexed": True, "name": "solver", "type": "address"},
+                ],
+                "name": "Settlement",
+                "type": "event",
+            },
         ],
     )
 
@@ -32,10 +66,20 @@ def create_erc20_contract():
             {
                 "anonymous": False,
                 "inputs": [
-                    # ERC20 contract ABI inputs
+                    {"indexed": True, "name": "from", "type": "address"},
+                    {"indexed": True, "name": "to", "type": "address"},
+                    {"indexed": False, "name": "value", "type": "uint256"},
                 ],
                 "name": "Transfer",
                 "type": "event",
             }
         ],
     )
+
+
+def get_settlement_contract():
+    return config.client("settlement_contract", create_settlement_contract)
+
+
+def get_erc20_contract():
+    return config.client("erc20_contract", create_erc20_contract)
@@ -1,5 +1,4 @@
-from eth_abi import encode_abi, decode_abi
-from web3.constants import ADDRESS_ZERO
+ADDRESS_ZERO = "0x0000000000000000000000000000000000000000"
 
 
 def normalize_receiver(receiver, owner):
@@ -25,9 +24,6 @@ def normalize_token(token):
 
 def transferUid(address, from_, to, value):
     """
-    Encodes a transfer UID with the given parameters and returns the encoded data.
+    Returns a transfer UID for the given parameters, equal for addresses differing only in case.
     """
-    return encode_abi(
-        ["address", "address", "address", "uint256"],
-        [address, from_, to, value],
-    )
+    return (address.lower(), from_.lower(), to.lower(), value)
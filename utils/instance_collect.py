@@ -1,12 +1,79 @@
-import os
+from . import metrics
+from .cache import LRUCache
+from .config import config
 
-import requests
-from dotenv import load_dotenv
 
-load_dotenv(os.path.join(os.path.dirname(__file__), "..", ".env"))
+class OrderNotFound(LookupError):
+    """
+    Raised when the orderbook does not answer an order lookup with the order.
+    """
 
+    def __init__(self, oid, status):
+        super().__init__(f"orderbook answered {status} for order {oid}")
+        self.oid = oid
+        self.status = status
 
-def fetch_order(oid):
-    orderbook_url = os.getenv("ORDERBOOK_URL")
-    url = orderbook_url + f"/api/v1/orders/{oid}"
-    return requests.get(url).json()
+
+class OrderbookClient:
+    """
+    Looks up orders on the CoW orderbook API over the aiohttp session it is given.
+
+    Settled orders are immutable, so every order seen is kept in a bounded LRU keyed by order UID.
+    """
+
+    def __init__(self, orderbook_url, maxsize=4096):
+        self.orderbook_url = orderbook_url
+        self.cache = LRUCache(maxsize)
+
+    def order_url(self, oid):
+        return self.orderbook_url + f"/api/v1/orders/{oid}"
+
+    def tx_orders_url(self, tx_hash):
+        return self.orderbook_url + f"/api/v1/transactions/{tx_hash}/orders"
+
+    def cache_orders(self, orders):
+        """
+        Caches a list of orders as returned by the orderbook and returns them keyed by UID.
+        """
+        by_uid = {}
+        for order in orders:
+            oid = order["uid"].lower()
+            self.cache.set(oid, order)
+            by_uid[oid] = order
+        return by_uid
+
+    async def fetch_order_async(self, session, oid):
+        """
+        Returns the order with the given UID, using the given aiohttp session on a cache miss. Raises OrderNotFound if
+        the orderbook does not return it, in which case nothing is cached.
+        """
+        order = self.cache.get(oid)
+        if order is None:
+            metrics.count_upstream_call("orderbook")
+            async with session.get(self.order_url(oid)) as response:
+                if response.status != 200:
+                    raise OrderNotFound(oid, response.status)
+                order = await response.json(content_type=None)
+            self.cache.set(oid, order)
+        return order
+
+    async def fetch_orders_for_tx_async(self, session, tx_hash):
+        """
+        Returns all orders settled in the given transaction keyed by UID, in a single request with the given aiohttp
+        session.
+        """
+        metrics.count_upstream_call("orderbook")
+        async with session.get(self.tx_orders_url(tx_hash)) as response:
+            if response.status != 200:
+                return {}
+            orders = await response.json(content_type=None)
+        return self.cache_orders(orders)
+
+
+orderbook_client = OrderbookClient(
+    config.get("ORDERBOOK_URL"), maxsize=config.get_int("ORDER_CACHE_SIZE", 4096)
+)
+
+
+async def fetch_order_async(session, oid):
+    return await orderbook_client.fetch_order_async(session, oid)
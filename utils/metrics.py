@@ -0,0 +1,124 @@
+import contextvars
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from prometheus_client import Counter as PrometheusCounter
+from prometheus_client import Histogram
+
+UPSTREAMS = ["rpc", "orderbook", "subgraph"]
+
+STAGE_SECONDS = Histogram(
+    "cowiness_stage_seconds",
+    "Time spent in each stage of a cowiness computation.",
+    ["stage"],
+)
+UPSTREAM_CALLS = PrometheusCounter(
+    "cowiness_upstream_calls",
+    "Calls made to each upstream service.",
+    ["upstream"],
+)
+COALESCED_CALLS = PrometheusCounter(
+    "cowiness_coalesced_calls",
+    "Calls that waited on an identical call in progress and shared its result.",
+    ["call"],
+)
+REJECTED_REQUESTS = PrometheusCounter(
+    "cowiness_rejected_requests",
+    "API requests rejected by admission control, by reason.",
+    ["reason"],
+)
+UPSTREAM_CALLS_PER_REQUEST = Histogram(
+    "cowiness_upstream_calls_per_request",
+    "Calls made to each upstream service while serving one API request.",
+    ["upstream"],
+    buckets=[0, 1, 2, 5, 10, 20, 50, 100, 200, 500, float("inf")],
+)
+
+# Timings of the API request being served in the current thread or task
+current_request = contextvars.ContextVar("current_request", default=None)
+
+
+class RequestMetrics:
+    """
+    Total time per stage and number of upstream calls of one API request. Stages running concurrently each count
+    their own wall time.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.upstream_calls = Counter()
+        self._lock = threading.Lock()
+
+    def add_stage(self, stage, seconds):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+    def add_upstream_call(self, upstream):
+        with self._lock:
+            self.upstream_calls[upstream] += 1
+
+    def server_timing(self):
+        """
+        Returns the stage timings as a Server-Timing header value, with durations in milliseconds.
+        """
+        with self._lock:
+            stages = list(self.stages.items())
+        return ", ".join(
+            f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in stages
+        )
+
+
+@contextmanager
+def span(stage):
+    """
+    Times the enclosed block as the given stage, in the stage histogram and on the current request.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.labels(stage).observe(elapsed)
+        request = current_request.get()
+        if request is not None:
+            request.add_stage(stage, elapsed)
+
+
+def count_upstream_call(upstream):
+    UPSTREAM_CALLS.labels(upstream).inc()
+    request = current_request.get()
+    if request is not None:
+        request.add_upstream_call(upstream)
+
+
+def count_coalesced_call(call):
+    COALESCED_CALLS.labels(call).inc()
+
+
+def count_rejected_request(reason):
+    REJECTED_REQUESTS.labels(reason).inc()
+
+
+def start_request():
+    """
+    Starts collecting the metrics of a new request in the current context, and returns them with the token to pass
+    to finish_request.
+    """
+    request = RequestMetrics()
+    return request, current_request.set(request)
+
+
+def finish_request(request, token):
+    """
+    Records the upstream calls of a request and stops collecting its metrics. Requests that computed nothing, such
+    as metrics scrapes, are left out of the per-request histogram.
+    """
+    current_request.reset(token)
+    if len(request.stages) == 0:
+        return
+    for upstream in UPSTREAMS:
+        UPSTREAM_CALLS_PER_REQUEST.labels(upstream).observe(
+            request.upstream_calls[upstream]
+        )
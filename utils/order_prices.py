@@ -1,43 +1,190 @@
-import os
-import requests
-from dotenv import load_dotenv
+import threading
+from bisect import bisect_left
 
-load_dotenv(os.path.join(os.path.dirname(__file__), "..", ".env"))
+from . import metrics, replay
+from .aio import run_with_session
+from .cache import LRUCache
+from .config import config
 
-COWSWAP_SUBGRAPH_URL = os.environ.get("SUBGRAPH_ENDPOINT")
+COWSWAP_SUBGRAPH_URL = config.get("SUBGRAPH_ENDPOINT")
 
 
-def get_usd_prices_for_order(order_id):
-    query = """
-    query GetOrder($id: ID!) {
-      order(id: $id) {
+TRADE_PRICES_FRAGMENT = """
+fragment TradePrices on Trade {
+  buyAmount
+  buyAmountUsd
+  sellAmount
+  sellAmountUsd
+  sellToken {
+    address
+    decimals
+    name
+    id
+  }
+  buyToken {
+    address
+    decimals
+    id
+    name
+  }
+}
+"""
+
+ORDER_TRADES_QUERY = (
+    """
+query GetOrder($id: ID!) {
+  order(id: $id) {
+    trades {
+      ...TradePrices
+    }
+  }
+}
+"""
+    + TRADE_PRICES_FRAGMENT
+)
+
+# The trades of every order of the settlement are nested in the settlement query, so pricing a settlement
+# takes one subgraph round-trip however many trades it has
+SETTLEMENT_TRADES_QUERY = (
+    """
+query GetTx($id: ID!) {
+  settlement(id: $id){
+    trades {
+      order {
+        id
         trades {
-          buyAmount
-          buyAmountUsd
-          sellAmount
-          sellAmountUsd
-          sellToken {
-            address
-            decimals
-            name
-            id
-          }
-          buyToken {
-            address
-            decimals
-            id
-            name
-          }
+          ...TradePrices
         }
       }
     }
+  }
+}
+"""
+    + TRADE_PRICES_FRAGMENT
+)
+
+TOKEN_FIELDS = """
+    address
+    id
+    name
+    decimals
+"""
+
+
+class TokenPriceCache:
     """
+    Caches token USD prices by (token, block) in a bounded LRU, with the cached blocks of each token, which
+    evicting a price forgets. Token metadata (address, id, name, decimals) never changes, so it is kept in a
+    separate map that never expires, and prices of a token with known metadata are fetched without it.
 
-    variables = {"id": order_id}
-    response = requests.post(
-        COWSWAP_SUBGRAPH_URL, json={"query": query, "variables": variables}
+    With a block_window above zero, a price missing for a block is served from the nearest cached block at most
+    block_window blocks away, so neighbouring settlements share lookups.
+    """
+
+    def __init__(self, maxsize=8192, block_window=0):
+        self.block_window = block_window
+        self.prices = LRUCache(maxsize, on_evict=self.forget)
+        self.tokens = {}
+        self.blocks = {}
+        # Reentrant, as setting a price evicts others and forgets them under the same lock
+        self._lock = threading.RLock()
+
+    def get(self, blockNumber, token):
+        """
+        Returns the cached price of the token at the block with its metadata, or None if it has to be fetched.
+        """
+        metadata = self.tokens.get(token)
+        if metadata is None:
+            return None
+
+        price = self.prices.get((token, blockNumber))
+        if price is None and self.block_window > 0:
+            price = self.get_nearest(blockNumber, token)
+        if price is None:
+            return None
+        return {**metadata, "priceUsd": price}
+
+    def get_nearest(self, blockNumber, token):
+        with self._lock:
+            blocks = self.blocks.get(token, [])
+            position = bisect_left(blocks, blockNumber)
+            candidates = sorted(
+                blocks[max(position - 1, 0) : position + 1],
+                key=lambda block: abs(block - blockNumber),
+            )
+        for block in candidates:
+            if abs(block - blockNumber) > self.block_window:
+                break
+            price = self.prices.get((token, block))
+            if price is not None:
+                return price
+            # The price was evicted from the LRU while its block was being read, forget it too
+            self.forget((token, block), price)
+        return None
+
+    def set(self, blockNumber, token, data):
+        """
+        Caches a token as returned by the subgraph at the given block.
+        """
+        with self._lock:
+            self.tokens[token] = {field: data[field] for field in TOKEN_FIELDS.split()}
+            blocks = self.blocks.setdefault(token, [])
+            position = bisect_left(blocks, blockNumber)
+            if position == len(blocks) or blocks[position] != blockNumber:
+                blocks.insert(position, blockNumber)
+            self.prices.set((token, blockNumber), data["priceUsd"])
+
+    def forget(self, key, price):
+        """
+        Forgets the block of an evicted price. The token's metadata is kept.
+        """
+        token, blockNumber = key
+        with self._lock:
+            blocks = self.blocks.get(token)
+            if blocks is None:
+                return
+            position = bisect_left(blocks, blockNumber)
+            if position < len(blocks) and blocks[position] == blockNumber:
+                del blocks[position]
+            if len(blocks) == 0:
+                del self.blocks[token]
+
+    def clear(self):
+        with self._lock:
+            self.prices.clear()
+            self.tokens.clear()
+            self.blocks.clear()
+
+
+token_price_cache = TokenPriceCache(
+    maxsize=config.get_int("PRICE_CACHE_SIZE", 8192),
+    block_window=config.get_int("PRICE_BLOCK_WINDOW", 0),
+)
+
+
+def get_token_prices_query(tokens, known_tokens):
+    """
+    Builds one query fetching the prices of all given tokens at a block, aliased t0, t1, ..., and only asking for
+    the metadata of tokens not in known_tokens.
+    """
+    arguments = ["$blockNumber: Int!"]
+    selections = []
+    for index, token in enumerate(tokens):
+        fields = "priceUsd" if token in known_tokens else "priceUsd" + TOKEN_FIELDS
+        arguments.append(f"$t{index}: String!")
+        selections.append(
+            f"  t{index}: token(id: $t{index}, block: {{ number: $blockNumber }}) {{\n"
+            f"    {fields.strip()}\n"
+            f"  }}"
+        )
+    return (
+        f"query GetTokenPrices({', '.join(arguments)}) {{\n"
+        + "\n".join(selections)
+        + "\n}"
     )
-    data = response.json()["data"]["order"]["trades"]
+
+
+def get_token_prices_from_trades(data):
     token_prices = {}
 
     for trade in data:
@@ -66,7 +213,7 @@ def get_usd_prices_for_order(order_id):
                 / 10 ** int(trade["sellToken"]["decimals"]),
             }
         else:
-            token_prices[sell_token_address]["amount"] += trade["sellAmount"]
+            token_prices[sell_token_address]["amount"] += sell_token_amount
 
         if buy_token_address not in token_prices:
             token_prices[buy_token_address] = {
@@ -77,32 +224,50 @@ def get_usd_prices_for_order(order_id):
                 / 10 ** int(trade["buyToken"]["decimals"]),
             }
         else:
-            token_prices[buy_token_address]["amount"] += trade["buyAmount"]
+            token_prices[buy_token_address]["amount"] += buy_token_amount
 
     return token_prices
 
 
+def get_usd_prices_for_order(order_id):
+    return run_with_session(get_usd_prices_for_order_async, order_id)
+
+
+async def get_usd_prices_for_order_async(session, order_id):
+    variables = {"id": order_id}
+    metrics.count_upstream_call("subgraph")
+    async with session.post(
+        COWSWAP_SUBGRAPH_URL,
+        json={"query": ORDER_TRADES_QUERY, "variables": variables},
+    ) as response:
+        data = (await response.json(content_type=None))["data"]["order"]["trades"]
+    return get_token_prices_from_trades(data)
+
+
 def get_usd_prices_for_tx(tx_hash):
-    query = """
-    query GetTx($id: ID!) {
-      settlement(id: $id){
-        trades {
-          order {
-            id
-          }
-        }
-      }
-      }"""
-    variables = {"id": tx_hash}
-    response = requests.post(
-        COWSWAP_SUBGRAPH_URL, json={"query": query, "variables": variables}
-    )
+    return run_with_session(get_usd_prices_for_tx_async, tx_hash)
+
+
+async def get_usd_prices_for_tx_async(session, tx_hash):
+    async def fetch_settlement_trades():
+        variables = {"id": tx_hash}
+        metrics.count_upstream_call("subgraph")
+        async with session.post(
+            COWSWAP_SUBGRAPH_URL,
+            json={"query": SETTLEMENT_TRADES_QUERY, "variables": variables},
+        ) as response:
+            return (await response.json(content_type=None))["data"]["settlement"][
+                "trades"
+            ]
+
+    with replay.scope(tx_hash), metrics.span("settlement_prices"):
+        data = await replay.replayable_async(
+            "settlement_trades", tx_hash, fetch_settlement_trades
+        )
 
-    data = response.json()["data"]["settlement"]["trades"]
     token_prices = {}
     for trade in data:
-        order_id = trade["order"]["id"]
-        order_prices = get_usd_prices_for_order(order_id)
+        order_prices = get_token_prices_from_trades(trade["order"]["trades"])
         for token_address, order_elem in order_prices.items():
             if token_address not in token_prices:
                 token_prices[token_address] = order_elem
@@ -112,20 +277,61 @@ def get_usd_prices_for_tx(tx_hash):
 
 
 def get_usd_price_for_token(blockNumber, tokenAddress):
-    query = """
-    query GetTokenPrice($blockNumber: Int!, $tokenAddress: String!) {
-      token(id: $tokenAddress, block: { number: $blockNumber }) {
-        address
-        id
-        name
-        priceUsd
-        decimals
-      }
-    }
+    return get_usd_prices_for_tokens(blockNumber, [tokenAddress])[tokenAddress]
+
+
+def get_usd_prices_for_tokens(blockNumber, tokens):
+    return run_with_session(get_usd_prices_for_tokens_async, blockNumber, tokens)
+
+
+async def get_usd_prices_for_tokens_async(session, blockNumber, tokens):
     """
-    variables = {"blockNumber": blockNumber, "tokenAddress": tokenAddress}
-    response = requests.post(
-        COWSWAP_SUBGRAPH_URL, json={"query": query, "variables": variables}
-    )
-    data = response.json()["data"]["token"]
-    return data
+    Returns the price and metadata of each given token at the block, keyed like tokens. Tokens missing from the
+    price cache are fetched together in one aliased query.
+    """
+    if replay.mode == replay.REPLAY:
+        return {
+            token: replay.load("token_price", f"{blockNumber}:{token.lower()}")
+            for token in tokens
+        }
+
+    prices = {}
+    missing = []
+    for token in tokens:
+        price = token_price_cache.get(blockNumber, token.lower())
+        if price is not None:
+            prices[token] = price
+        elif token.lower() not in missing:
+            missing.append(token.lower())
+
+    if len(missing) > 0:
+        variables = {"blockNumber": blockNumber}
+        variables.update({f"t{index}": token for index, token in enumerate(missing)})
+        # Metadata is only queried for tokens it is not known for, and taken from here for the others
+        known_tokens = {}
+        for token in missing:
+            metadata = token_price_cache.tokens.get(token)
+            if metadata is not None:
+                known_tokens[token] = metadata
+        query = get_token_prices_query(missing, known_tokens)
+        metrics.count_upstream_call("subgraph")
+        async with session.post(
+            COWSWAP_SUBGRAPH_URL, json={"query": query, "variables": variables}
+        ) as response:
+            data = (await response.json(content_type=None))["data"]
+
+        fetched = {}
+        for index, token in enumerate(missing):
+            token_data = data[f"t{index}"]
+            if token_data is None:
+                continue
+            fetched[token] = {**known_tokens.get(token, {}), **token_data}
+            token_price_cache.set(blockNumber, token, fetched[token])
+
+        for token in tokens:
+            if token not in prices:
+                prices[token] = fetched.get(token.lower())
+
+    for token in tokens:
+        replay.record("token_price", f"{blockNumber}:{token.lower()}", prices[token])
+    return prices
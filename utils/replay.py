@@ -0,0 +1,146 @@
+import contextvars
+import gzip
+import json
+import os
+from contextlib import contextmanager
+
+from hexbytes import HexBytes
+
+from .config import config
+
+LIVE = "live"
+RECORD = "record"
+REPLAY = "replay"
+
+# In record mode upstream responses are saved to the corpus, in replay mode they are served from it with zero network
+mode = config.get("UPSTREAM_MODE", LIVE)
+corpus_dir = config.get("UPSTREAM_CORPUS_DIR", "corpus")
+
+# Corpus of the settlement being computed in the current thread or task
+current_corpus = contextvars.ContextVar("current_corpus", default=None)
+
+
+class ReplayMiss(KeyError):
+    """
+    Raised in replay mode when a response was not recorded in the corpus.
+    """
+
+
+def configure(new_mode, new_corpus_dir=None):
+    """
+    Switches the upstream mode, and optionally the corpus directory.
+    """
+    global mode, corpus_dir
+    if new_mode not in [LIVE, RECORD, REPLAY]:
+        raise ValueError(f"unknown upstream mode {new_mode}")
+    mode = new_mode
+    if new_corpus_dir is not None:
+        corpus_dir = new_corpus_dir
+
+
+def is_active():
+    return mode != LIVE
+
+
+class Corpus:
+    """
+    The upstream responses of one settlement, stored as a gzipped JSON file named after its tx hash.
+
+    Responses are grouped by kind (receipt, order, settlement_trades, token_price) and keyed within their kind.
+    """
+
+    def __init__(self, tx_hash):
+        self.tx_hash = tx_hash.lower()
+        self.path = os.path.join(corpus_dir, f"{self.tx_hash}.json.gz")
+        self.entries = {}
+        if os.path.exists(self.path):
+            with gzip.open(self.path, "rt") as f:
+                self.entries = json.load(f, object_hook=decode_value)
+
+    def load(self, kind, key):
+        try:
+            return self.entries[kind][str(key)]
+        except KeyError:
+            raise ReplayMiss(f"{kind} {key} not recorded for {self.tx_hash}")
+
+    def record(self, kind, key, value):
+        self.entries.setdefault(kind, {})[str(key)] = value
+
+    def save(self):
+        os.makedirs(corpus_dir, exist_ok=True)
+        with gzip.open(self.path, "wt") as f:
+            json.dump(self.entries, f, default=encode_value, separators=(",", ":"))
+
+
+def encode_value(value):
+    """
+    Encodes the web3 types found in receipts for JSON.
+    """
+    from web3.datastructures import AttributeDict
+
+    if isinstance(value, AttributeDict):
+        return {"__attributedict__": dict(value)}
+    if isinstance(value, (bytes, bytearray)):
+        return {"__hexbytes__": HexBytes(value).hex()}
+    raise TypeError(f"can't record value of type {type(value)}")
+
+
+def decode_value(value):
+    from web3.datastructures import AttributeDict
+
+    if "__attributedict__" in value:
+        return AttributeDict(value["__attributedict__"])
+    if "__hexbytes__" in value:
+        return HexBytes(value["__hexbytes__"])
+    return value
+
+
+@contextmanager
+def scope(tx_hash):
+    """
+    Makes the corpus of the given settlement current. In record mode the corpus is saved on exit; nested scopes of
+    the same settlement share the outer corpus.
+    """
+    corpus = current_corpus.get()
+    if not is_active() or (corpus is not None and corpus.tx_hash == tx_hash.lower()):
+        yield corpus
+        return
+
+    corpus = Corpus(tx_hash)
+    token = current_corpus.set(corpus)
+    try:
+        yield corpus
+    finally:
+        current_corpus.reset(token)
+        if mode == RECORD:
+            corpus.save()
+
+
+def load(kind, key):
+    """
+    Returns a response recorded in the current corpus.
+    """
+    corpus = current_corpus.get()
+    if corpus is None:
+        raise ReplayMiss(f"{kind} {key} requested outside of a settlement scope")
+    return corpus.load(kind, key)
+
+
+def record(kind, key, value):
+    """
+    Records a response in the current corpus when recording, and returns it.
+    """
+    corpus = current_corpus.get()
+    if mode == RECORD and corpus is not None:
+        corpus.record(kind, key, value)
+    return value
+
+
+async def replayable_async(kind, key, fetch):
+    """
+    Returns the response of the coroutine function fetch, recording it in record mode and serving it from the
+    corpus instead of calling fetch in replay mode.
+    """
+    if mode == REPLAY:
+        return load(kind, key)
+    return record(kind, key, await fetch())
@@ -0,0 +1,128 @@
+import asyncio
+import threading
+
+from . import metrics
+
+
+class Call:
+    """
+    A call in progress, whose result or error is shared with the callers waiting on it.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time. Callers asking for a key while its call is in progress wait for it and
+    share its result or error instead of making the call again.
+
+    Nothing is kept once a call returns, so a later caller makes a new call. Keeping results is left to the caches
+    and stores around the call.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.coalesced = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args):
+        """
+        Returns fn(*args), or the result of the call in progress for key, raising its error if it failed.
+        """
+        with self._lock:
+            call = self._in_flight.get(key)
+            if call is None:
+                call = self._in_flight[key] = Call()
+                self.calls += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            metrics.count_coalesced_call(self.name)
+            with metrics.span("coalesced_wait"):
+                call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            call.done.set()
+
+    def stats(self):
+        """
+        Returns the number of calls made and of callers that shared a call in progress.
+        """
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "coalesced": self.coalesced,
+                "in_flight": len(self._in_flight),
+            }
+
+
+class AsyncSingleFlight:
+    """
+    A SingleFlight for coroutines on one event loop: callers asking for a key while its call is in progress await
+    it and share its result or error.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.coalesced = 0
+        self._in_flight = {}
+
+    async def do(self, key, fn, *args):
+        """
+        Returns await fn(*args), or the result of the call in progress for key, raising its error if it failed.
+        """
+        call = self._in_flight.get(key)
+        if call is not None:
+            self.coalesced += 1
+            metrics.count_coalesced_call(self.name)
+            with metrics.span("coalesced_wait"):
+                # A waiter going away does not cancel the call the others wait on
+                return await asyncio.shield(call)
+
+        call = self._in_flight[key] = asyncio.get_running_loop().create_future()
+        # The error of a call nobody waited on is not reported as never retrieved
+        call.add_done_callback(lambda call: call.cancelled() or call.exception())
+        self.calls += 1
+        try:
+            result = await fn(*args)
+            call.set_result(result)
+            return result
+        except Exception as e:
+            call.set_exception(e)
+            raise
+        finally:
+            del self._in_flight[key]
+            # A cancelled call cancels its waiters too
+            if not call.done():
+                call.cancel()
+
+    def stats(self):
+        """
+        Returns the number of calls made and of callers that shared a call in progress.
+        """
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._in_flight),
+        }